@@ -0,0 +1,240 @@
+"""
+قياس أداء المسارات الساخنة بدون Telegram حقيقي:
+
+    python -m bench                          # قاعدة في الذاكرة (يتطلب mongomock)
+    python -m bench --mongo mongodb://localhost:27017 --latency 0.08 --iterations 200
+    python -m bench --json out.json --compare base.json
+
+المعالجات الحقيقية (main.prepare_application) تُشغَّل عبر Application.process_update مع Bot API وهمي
+(bench/fake_api.py). لكل مسار: p50/p95/p99 وعدد استدعاءات القاعدة واستدعاءات Bot API لكل تحديث
+(مسار المعالج فقط — عمل الحلقات الخلفية والتنبيهات المجمعة يُعرض منفصلاً).
+"""
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+import statistics
+from collections import Counter, defaultdict
+
+from config import Config
+
+BENCH_DB = "TelegramBot_bench"
+ADMIN_ID = Config.ADMIN_ID
+LIST_OWNER = 7_000_000          # مالك قنوات اللستة (مفعّل) لمسار listah_stats
+FIRST_USER = 8_000_000          # كل تكرار يستخدم مستخدماً جديداً
+
+def _parse_args(argv=None):
+    p = argparse.ArgumentParser(prog="python -m bench", description="offline benchmark of the hot bot flows")
+    p.add_argument("--mongo", default="mongomock", help="'mongomock' (in-memory) or a mongod URL")
+    p.add_argument("--latency", type=float, default=0.05, help="fake Bot API latency per call (s)")
+    p.add_argument("--iterations", type=int, default=50)
+    p.add_argument("--channels", type=int, default=40, help="funding channels to seed (force_sub + points pool)")
+    p.add_argument("--list-channels", type=int, default=20, help="ad-list channels to seed")
+    p.add_argument("--no-governor", action="store_true", help="skip GovernorRateLimiter (raw handler cost)")
+    p.add_argument("--json", help="write results to this file")
+    p.add_argument("--compare", help="baseline JSON from a previous --json run")
+    return p.parse_args(argv)
+
+# ---------------- القاعدة ----------------
+def _use_mongomock():
+    try:
+        from bench.fake_api import use_mongomock
+        use_mongomock()
+    except ImportError:
+        sys.exit("mongomock is not installed: pip install mongomock, or pass --mongo mongodb://localhost:27017")
+
+def _connect(mongo):
+    Config.MONGO_DB_NAME = BENCH_DB
+    Config.METRICS_PORT = 0  # لا خادم /metrics أثناء القياس
+    if mongo == "mongomock":
+        _use_mongomock()
+        Config.MONGO_URL = "mongodb://localhost"
+    else:
+        Config.MONGO_URL = mongo
+    import db as dbmod
+    if dbmod.db.db is None:
+        sys.exit(f"cannot connect to {Config.MONGO_URL}")
+    dbmod.db.client.drop_database(BENCH_DB)
+    dbmod.db.ensure_indexes()
+    return dbmod.db
+
+class DbCounter:
+    """عدّ استدعاءات القاعدة عبر DatabaseManager.run (كل استدعاء = رحلة واحدة على الأقل) لكل مسار"""
+
+    def __init__(self, manager):
+        self.calls = Counter()
+        original = manager.run
+
+        async def _counted(fn, *args, **kwargs):
+            from ratelimit import current_lane
+            self.calls[current_lane()] += 1
+            return await original(fn, *args, **kwargs)
+        manager.run = _counted
+
+def _seed(db, channels, list_channels):
+    now = time.time()
+    import datetime
+    utc = datetime.datetime.utcnow()
+    chans = []
+    for i in range(channels):
+        chans.append({
+            "channel_id": -1001000000000 - i, "username": f"@bench_ch{i}", "title": f"Bench channel {i}",
+            "owner_id": 5_000_000 + i, "active": True, "force_sub": True, "in_points_pool": i % 2 == 0,
+            "pool_added_at": utc, "created_at": utc, "member_count": 100 + i, "achieved_members": 0,
+        })
+    db.db.channels.insert_many(chans)
+    owners = [{"user_id": 5_000_000 + i, "points": 10_000, "force_sub_done": True} for i in range(channels)]
+    owners.append({"user_id": LIST_OWNER, "points": 0, "force_sub_done": True})
+    owners.append({"user_id": ADMIN_ID, "points": 0, "force_sub_done": True})
+    db.db.users.insert_many(owners)
+    db.db.list_channels.insert_many([{
+        "channel_id": -1002000000000 - i, "username": f"@bench_list{i}", "title": f"List {i}",
+        "owner_id": LIST_OWNER if i < 5 else 5_000_000 + i, "list_active": False,
+        "member_count": 500 + i, "yield_score": i, "total_clicks": i * 3,
+    } for i in range(list_channels)])
+    db.db.ads_history.insert_many([{
+        "from_channel": -1002000000000 - (i % max(1, list_channels)), "to_channel": -1002000000000 - ((i + 1) % max(1, list_channels)),
+        "msg_id": i, "status": "ignored" if i % 3 == 0 else "posted", "timestamp": utc,
+    } for i in range(list_channels * 10)])
+    logging.getLogger("bench").info(f"seeded in {time.time() - now:.2f}s")
+
+# ---------------- التحديثات ----------------
+class Updates:
+    def __init__(self):
+        self._next = 0
+
+    def _id(self):
+        self._next += 1
+        return self._next
+
+    @staticmethod
+    def _user(uid):
+        return {"id": uid, "is_bot": False, "first_name": f"u{uid}", "username": f"u{uid}"}
+
+    def text(self, uid, text):
+        n = self._id()
+        msg = {"message_id": n, "date": int(time.time()), "chat": {"id": uid, "type": "private"}, "from": self._user(uid), "text": text}
+        if text.startswith("/"):
+            msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"update_id": n, "message": msg}
+
+    def callback(self, uid, data):
+        n = self._id()
+        from bench.fake_api import BOT_USER
+        message = {"message_id": n, "date": int(time.time()), "chat": {"id": uid, "type": "private"}, "from": BOT_USER, "text": "..."}
+        return {"update_id": n, "callback_query": {"id": str(n), "from": self._user(uid), "chat_instance": "bench", "data": data, "message": message}}
+
+# ---------------- التشغيل ----------------
+def _percentile(sorted_values, q):
+    if len(sorted_values) == 1:
+        return sorted_values[0]
+    return statistics.quantiles(sorted_values, n=100, method="inclusive")[q - 1]
+
+def summarize(samples):
+    """samples: flow -> [(ms, db, api)]"""
+    out = {}
+    for flow, rows in samples.items():
+        lat = sorted(r[0] for r in rows)
+        out[flow] = {
+            "n": len(rows),
+            "p50_ms": round(_percentile(lat, 50), 2),
+            "p95_ms": round(_percentile(lat, 95), 2),
+            "p99_ms": round(_percentile(lat, 99), 2),
+            "db_per_update": round(sum(r[1] for r in rows) / len(rows), 2),
+            "api_per_update": round(sum(r[2] for r in rows) / len(rows), 2),
+        }
+    return out
+
+def print_report(results, background, baseline=None):
+    cols = ("p50_ms", "p95_ms", "p99_ms", "db_per_update", "api_per_update")
+    print(f"\n{'flow':<22}{'n':>5}" + "".join(f"{c:>16}" for c in cols))
+    for flow, row in results.items():
+        line = f"{flow:<22}{row['n']:>5}"
+        for c in cols:
+            cell = f"{row[c]:g}"
+            base = (baseline or {}).get("flows", {}).get(flow, {}).get(c)
+            if base:
+                cell += f" ({(row[c] - base) / base * 100:+.0f}%)"
+            line += f"{cell:>16}"
+        print(line)
+    print(f"\nbackground (ads engine, cleaner, monitor, notifications): db={background['db']} api={background['api']}")
+
+async def run(args):
+    db = _connect(args.mongo)
+    _seed(db, args.channels, args.list_channels)
+    db_counter = DbCounter(db)
+
+    from telegram import Update
+    from telegram.ext import Application
+    from bench.fake_api import FakeRequest, FakeWorld
+    from ratelimit import GovernorRateLimiter, INTERACTIVE, BULK
+    import main
+
+    world = FakeWorld()
+    request = FakeRequest(world, latency=args.latency)
+    builder = Application.builder().application_class(main.BotApplication).token("123456:BENCH").request(request).get_updates_request(FakeRequest(world, 0)).updater(None)
+    if not args.no_governor:
+        builder = builder.rate_limiter(GovernorRateLimiter())
+    app = builder.build()
+    await main.prepare_application(app)
+    await app.initialize()
+    await app.start()
+
+    updates = Updates()
+    samples = defaultdict(list)
+
+    async def measure(flow, data):
+        update = Update.de_json(data, app.bot)
+        db0, api0 = db_counter.calls[INTERACTIVE], request.count(INTERACTIVE)
+        t0 = time.perf_counter()
+        await app.process_update(update)
+        ms = (time.perf_counter() - t0) * 1000
+        samples[flow].append((ms, db_counter.calls[INTERACTIVE] - db0, request.count(INTERACTIVE) - api0))
+
+    for i in range(args.iterations):
+        uid = FIRST_USER + i
+        await measure("start", updates.text(uid, "/start"))
+        await measure("fund_points_sub", updates.callback(uid, "fund_points_sub"))
+        world.join_all(uid)
+        await measure("verify_callback", updates.callback(uid, "sub_verify"))
+        await measure("fund_points_check", updates.callback(uid, "fund_points_check"))
+        await measure("listah_stats", updates.text(LIST_OWNER, "📢إحصائيات الإعلان"))
+        await measure("admin_stats", updates.callback(ADMIN_ID, "adm_stats"))
+
+    results = summarize(samples)
+    background = {"db": db_counter.calls[BULK], "api": request.count(BULK)}
+    endpoints = Counter()
+    for (lane, endpoint), n in request.calls.items():
+        if lane == INTERACTIVE:
+            endpoints[endpoint] += n
+
+    await app.stop()
+    await app.shutdown()
+    for task in asyncio.all_tasks() - {asyncio.current_task()}:
+        task.cancel()
+    return {
+        "config": {"mongo": "mongomock" if args.mongo == "mongomock" else "mongod", "latency": args.latency,
+                   "iterations": args.iterations, "channels": args.channels, "governor": not args.no_governor},
+        "flows": results,
+        "background": background,
+        "api_endpoints": dict(endpoints.most_common()),
+    }
+
+def main(argv=None):
+    args = _parse_args(argv)
+    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s", level=logging.WARNING)
+    report = asyncio.run(run(args))
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(report["flows"], report["background"], baseline)
+    print("api calls by endpoint (handlers):", ", ".join(f"{k}={v}" for k, v in report["api_endpoints"].items()))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+import json
+import time
+import asyncio
+from collections import Counter
+from telegram.request import BaseRequest
+from ratelimit import current_lane
+
+# Bot API وهمي داخل العملية: يُمرَّر إلى ApplicationBuilder.request() فيمر كل استدعاء عبر telegram.Bot الحقيقي
+# (التحويل، المنظم GovernorRateLimiter، de_json) ثم يُجاب هنا بعد تأخير latency بدل الشبكة.
+BOT_USER = {"id": 999000, "is_bot": True, "first_name": "Bench", "username": "bench_bot",
+            "can_join_groups": True, "can_read_all_group_messages": False, "supports_inline_queries": False}
+
+_ADMIN_RIGHTS = {
+    "can_be_edited": False, "is_anonymous": False, "can_manage_chat": True, "can_delete_messages": True,
+    "can_manage_video_chats": True, "can_restrict_members": True, "can_promote_members": False,
+    "can_change_info": True, "can_invite_users": True, "can_post_stories": True, "can_edit_stories": True,
+    "can_delete_stories": True, "can_post_messages": True, "can_edit_messages": True, "can_pin_messages": True,
+}
+
+def use_mongomock():
+    """استبدال MongoClient بـ mongomock قبل استيراد db (للقياس والاختبارات فقط)؛ ImportError إن لم يكن مثبتاً"""
+    import inspect
+    import pymongo
+    import mongomock
+    import mongomock.collection as mc
+    # pymongo الحديث يمرر وسائط (sort, hint...) لا تعرفها bulk builders في mongomock
+    for name in ("add_replace", "add_update", "add_delete"):
+        original = getattr(mc.BulkOperationBuilder, name)
+        if getattr(original, "_compat", False):
+            continue
+        allowed = set(inspect.signature(original).parameters)
+
+        def _compat(self, *args, _original=original, _allowed=allowed, **kwargs):
+            return _original(self, *args, **{k: v for k, v in kwargs.items() if k in _allowed})
+        _compat._compat = True
+        setattr(mc.BulkOperationBuilder, name, _compat)
+    pymongo.MongoClient = mongomock.MongoClient
+
+class FakeWorld:
+    """حالة العالم الوهمي: أين البوت مشرف، ومن عضو في أي قناة"""
+
+    def __init__(self):
+        self.bot_admin_everywhere = True
+        self.members = {}  # user_id -> set(chat_id) أو None (عضو في كل شيء)
+
+    def join_all(self, user_id):
+        self.members[user_id] = None
+
+    def is_member(self, user_id, chat_id):
+        chats = self.members.get(user_id, set())
+        return chats is None or chat_id in chats
+
+class FakeRequest(BaseRequest):
+    """
+    BaseRequest بزمن استجابة ثابت لكل استدعاء وعدادات لكل endpoint ولكل مسار (تفاعلي/خلفي).
+    """
+
+    def __init__(self, world=None, latency=0.05):
+        self.world = world or FakeWorld()
+        self.latency = latency
+        self.calls = Counter()       # (lane, endpoint) -> عدد
+        self._message_id = 0
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def count(self, lane=None):
+        return sum(n for (ln, _), n in self.calls.items() if lane is None or ln == lane)
+
+    def _message(self, params):
+        self._message_id += 1
+        chat_id = params.get("chat_id", 0)
+        return {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id if isinstance(chat_id, int) else -1, "type": "private" if isinstance(chat_id, int) and chat_id > 0 else "channel"},
+            "from": BOT_USER,
+            "text": params.get("text") or params.get("caption") or "",
+        }
+
+    def _result(self, endpoint, params):
+        if endpoint == "getMe":
+            return BOT_USER
+        if endpoint in ("sendMessage", "sendPhoto", "editMessageText", "editMessageCaption", "copyMessage", "forwardMessage"):
+            return self._message(params)
+        if endpoint == "getChat":
+            chat_id = params.get("chat_id")
+            return {"id": chat_id if isinstance(chat_id, int) else -1009990000000, "type": "channel",
+                    "title": f"Bench {chat_id}", "username": str(chat_id).lstrip("@"), "accent_color_id": 0, "max_reaction_count": 0}
+        if endpoint == "getChatMember":
+            chat_id, user_id = params.get("chat_id"), params.get("user_id")
+            if user_id == BOT_USER["id"]:
+                if self.world.bot_admin_everywhere:
+                    return {"status": "administrator", "user": BOT_USER, **_ADMIN_RIGHTS}
+                return {"status": "left", "user": BOT_USER}
+            user = {"id": user_id, "is_bot": False, "first_name": f"u{user_id}"}
+            return {"status": "member" if self.world.is_member(user_id, chat_id) else "left", "user": user}
+        return True
+
+    async def do_request(self, url, method, request_data=None, read_timeout=BaseRequest.DEFAULT_NONE,
+                         write_timeout=BaseRequest.DEFAULT_NONE, connect_timeout=BaseRequest.DEFAULT_NONE,
+                         pool_timeout=BaseRequest.DEFAULT_NONE):
+        endpoint = url.rsplit("/", 1)[-1]
+        # المسار يُقرأ من سياق المستدعي (use_lane في الحلقات الخلفية) لفصل عمل المعالج عن الخلفية
+        self.calls[(current_lane(), endpoint)] += 1
+        params = request_data.parameters if request_data else {}
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return 200, json.dumps({"ok": True, "result": self._result(endpoint, params)}).encode()
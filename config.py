@@ -7,3 +7,11 @@ class Config:
     
     REQUIRED_GROUP = "@NN26S" 
     BOT_USERNAME = "XO_ar_bot"
+
+    # طريقة استقبال التحديثات: "polling" أو "webhook"
+    UPDATE_MODE = "polling"
+    WEBHOOK_URL = ""      # العنوان العام (https) الذي يصل إلى WEBHOOK_PORT
+    WEBHOOK_SECRET = ""   # يُرسل في ترويسة X-Telegram-Bot-Api-Secret-Token (فارغ = سر عشوائي يُولد عند كل تشغيل)
+
+    # عدد عمليات المعالجة (أكثر من 1 = مشرف يوزع التحديثات حسب user_id، والحلقات الخلفية بعقد في MongoDB)
+    WORKERS = 1
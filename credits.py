@@ -0,0 +1,71 @@
+import logging
+import datetime
+from typing import Dict, Iterable, List
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from db import db
+
+logger = logging.getLogger(__name__)
+
+# محرك احتساب الاشتراكات: كل (مستخدم، قناة) يُحتسب مرة واحدة فقط.
+# الفهرس الفريد (user_id, channel_id) على subscription_credits يجعل الإدراج "إن لم يوجد" كتابة واحدة،
+# والضغطات المتكررة على "تحقق" لا تضيف نقاطاً ولا عدادات ولا تنبيهات.
+CREDITS_COLLECTION = "subscription_credits"
+DUPLICATE_KEY = 11000
+
+def _doc(user_id, channel_id, owner_id, source, now):
+    return {"user_id": user_id, "channel_id": channel_id, "owner_id": owner_id, "source": source, "at": now}
+
+async def record_credit(user_id, channel_id, owner_id=None, source="force_sub") -> bool:
+    """True إذا كان هذا أول احتساب لهذا الاشتراك"""
+    try:
+        await db.adb[CREDITS_COLLECTION].insert_one(_doc(user_id, channel_id, owner_id, source, datetime.datetime.utcnow()))
+        return True
+    except DuplicateKeyError:
+        return False
+
+async def record_credits(user_id, owners: Dict[int, int], source="points_pool") -> List[int]:
+    """احتساب عدة قنوات {channel_id: owner_id} بكتابة واحدة؛ يعيد القنوات المحتسبة لأول مرة فقط"""
+    if not owners:
+        return []
+    now = datetime.datetime.utcnow()
+    channel_ids = list(owners)
+    docs = [_doc(user_id, ch_id, owners[ch_id], source, now) for ch_id in channel_ids]
+    try:
+        await db.adb[CREDITS_COLLECTION].insert_many(docs, ordered=False)
+        return channel_ids
+    except BulkWriteError as e:
+        errors = e.details.get("writeErrors", [])
+        if any(err.get("code") != DUPLICATE_KEY for err in errors):
+            raise
+        duplicated = {err["index"] for err in errors}
+        return [ch_id for i, ch_id in enumerate(channel_ids) if i not in duplicated]
+
+# ---------------- الاستعلامات (لإحصائيات المالكين بدل العدادات) ----------------
+async def has_credit(user_id, channel_id) -> bool:
+    return await db.adb[CREDITS_COLLECTION].count_documents({"user_id": user_id, "channel_id": channel_id}, limit=1) > 0
+
+async def credited_channels(user_id, channel_ids: Iterable[int]) -> set:
+    """القنوات التي احتُسبت لهذا المستخدم من بين channel_ids (استعلام واحد)"""
+    ids = list(channel_ids)
+    if not ids:
+        return set()
+    docs = await db.adb[CREDITS_COLLECTION].find({"user_id": user_id, "channel_id": {"$in": ids}}, {"channel_id": 1}).to_list()
+    return {d["channel_id"] for d in docs}
+
+async def count_for_channel(channel_id) -> int:
+    return await db.adb[CREDITS_COLLECTION].count_documents({"channel_id": channel_id})
+
+async def counts_for_channels(channel_ids: Iterable[int]) -> Dict[int, int]:
+    ids = list(channel_ids)
+    if not ids:
+        return {}
+    rows = await db.adb[CREDITS_COLLECTION].aggregate([
+        {"$match": {"channel_id": {"$in": ids}}},
+        {"$group": {"_id": "$channel_id", "count": {"$sum": 1}}},
+    ]).to_list()
+    counts = {ch_id: 0 for ch_id in ids}
+    counts.update({r["_id"]: r["count"] for r in rows})
+    return counts
+
+async def count_for_owner(owner_id) -> int:
+    return await db.adb[CREDITS_COLLECTION].count_documents({"owner_id": owner_id})
@@ -1,9 +1,17 @@
+import sys
+import json
+import queue
 import logging
 import certifi
 import asyncio
 import datetime
-from pymongo import MongoClient
+import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from pymongo import MongoClient, IndexModel, ASCENDING, DESCENDING, ReturnDocument, monitoring
+from pymongo.errors import OperationFailure, DuplicateKeyError, CollectionInvalid
 from config import Config
+from metrics import MongoCommandMetrics
 import dns.resolver
 
 logger = logging.getLogger(__name__)
@@ -15,31 +23,499 @@ try:
 except Exception as e:
     logger.warning(f"⚠️ DNS Setup: {e}")
 
+# عدد خيوط المنفذ الذي تُنفذ فيه استدعاءات pymongo بعيداً عن حلقة الأحداث
+DB_EXECUTOR_WORKERS = getattr(Config, "DB_EXECUTOR_WORKERS", 16)
+CURSOR_BATCH_SIZE = 200
+DB_NAME = getattr(Config, "MONGO_DB_NAME", "TelegramBot")
+
+# إنشاء الفهارس عند الإقلاع وتقرير الاستعلامات التي ما زالت تمسح المجموعة كاملة
+ENSURE_INDEXES = getattr(Config, "ENSURE_INDEXES", True)
+INDEX_SCAN_REPORT = getattr(Config, "INDEX_SCAN_REPORT", True)
+
+# سجل الاستعلامات البطيئة: كل أمر أبطأ من SLOW_QUERY_MS يُسجل (مع مصدره وشكل فلتره وخطة explain مرة لكل شكل)
+# في مجموعة محدودة الحجم slow_queries وفي السجل. 0 = معطل
+SLOW_QUERY_MS = getattr(Config, "SLOW_QUERY_MS", 100)
+SLOW_QUERY_COLLECTION = "slow_queries"
+SLOW_QUERY_CAP_MB = getattr(Config, "SLOW_QUERY_CAP_MB", 16)
+SLOW_QUERY_BACKLOG = 1000
+
+# وثيقة الإحصائيات المجمعة: مسارات الكتابة تحدثها بـ $inc، والمطابقة الدورية (reconcile_stats) تعيد حسابها بدقة.
+# شاشات الإحصائيات تقرأ وثيقة واحدة بدل count_documents/$group على المجموعات كاملة.
+STATS_COLLECTION = "stats_snapshot"
+STATS_ID = "global"
+STATS_FIELDS = ("users", "channels", "channels_active", "channels_members", "list_channels", "list_active", "list_members", "ads_posted")
+# الحقول اللازمة من وثيقة القناة لحساب فرق الإحصائيات (projection لـ find_one_and_update/delete)
+STATS_PROJECTION = {"_id": 0, "active": 1, "list_active": 1, "member_count": 1}
+# collection -> (حقل العدد، حقل المفعّلة، حقل مجموع الأعضاء، علم التفعيل في الوثيقة)
+_STATS_SHAPES = {
+    "channels": ("channels", "channels_active", "channels_members", "active"),
+    "list_channels": ("list_channels", "list_active", "list_members", "list_active"),
+}
+
+def _stats_weight(collection, doc):
+    if not doc:
+        return {}
+    count, active, members, flag = _STATS_SHAPES[collection]
+    try:
+        member_count = int(doc.get("member_count") or 0)
+    except (TypeError, ValueError):
+        member_count = 0
+    return {count: 1, active: 1 if doc.get(flag) else 0, members: member_count}
+
+def stats_deltas(collection, before, after):
+    """فرق مساهمة وثيقة في الإحصائيات: before=None إدراج، after=None حذف"""
+    old, new = _stats_weight(collection, before), _stats_weight(collection, after)
+    return {k: new.get(k, 0) - old.get(k, 0) for k in set(old) | set(new)}
+
+# --- [ الفهارس المعلنة لكل مجموعة ] ---
+INDEXES = {
+    "users": [
+        IndexModel([("user_id", ASCENDING)], name="user_id_unique", unique=True),
+        IndexModel([("referrals_count", DESCENDING)], name="referrals_count"),
+    ],
+    "channels": [
+        IndexModel([("channel_id", ASCENDING)], name="channel_id_unique", unique=True),
+        IndexModel([("active", ASCENDING), ("force_sub", ASCENDING)], name="active_force_sub"),
+        IndexModel([("in_points_pool", ASCENDING), ("active", ASCENDING), ("pool_added_at", DESCENDING)], name="points_pool"),
+        IndexModel([("owner_id", ASCENDING), ("created_at", DESCENDING)], name="owner_created"),
+    ],
+    "list_channels": [
+        IndexModel([("channel_id", ASCENDING)], name="channel_id_unique", unique=True),
+        IndexModel([("owner_id", ASCENDING)], name="owner_id"),
+        IndexModel([("list_active", ASCENDING)], name="list_active"),
+    ],
+    "ads_history": [
+        IndexModel([("to_channel", ASCENDING), ("timestamp", DESCENDING)], name="to_channel_timestamp"),
+        IndexModel([("from_channel", ASCENDING), ("status", ASCENDING)], name="from_channel_status"),
+        IndexModel([("timestamp", DESCENDING)], name="timestamp"),
+    ],
+    "ads_schedule": [
+        # جدول المطابقة يُحذف تلقائياً بعد أسبوع (يكفي لتجنب تكرار الأزواج)
+        IndexModel([("scheduled_at", DESCENDING)], name="scheduled_at_ttl", expireAfterSeconds=7 * 86400),
+    ],
+    "subscription_credits": [
+        # اشتراك واحد لكل (مستخدم، قناة) — أساس الاحتساب غير المكرر في credits.py
+        IndexModel([("user_id", ASCENDING), ("channel_id", ASCENDING)], name="user_channel_unique", unique=True),
+        IndexModel([("channel_id", ASCENDING)], name="channel_id"),
+        IndexModel([("owner_id", ASCENDING)], name="owner_id"),
+    ],
+    "points_ledger": [
+        IndexModel([("user_id", ASCENDING), ("at", DESCENDING)], name="user_at"),
+    ],
+    # حالات المستخدمين المحفوظة (persistence.MongoPersistence) — التحميل عند الإقلاع للحديثة فقط
+    "state_user_data": [
+        IndexModel([("updated_at", DESCENDING)], name="updated_at"),
+    ],
+    "state_chat_data": [
+        IndexModel([("updated_at", DESCENDING)], name="updated_at"),
+    ],
+    "state_conversations": [
+        IndexModel([("name", ASCENDING)], name="name"),
+    ],
+}
+
+# أشكال الاستعلامات الساخنة في الموديولات: (المجموعة، الفلتر، الترتيب، مصدر الاستعلام)
+HOT_QUERIES = [
+    ("users", {"user_id": 0}, None, "checker.check_subscription / stats.show_main"),
+    ("users", {"username": ""}, None, "admin.process_admin_text"),
+    ("users", {"referrals_count": {"$gt": 0}}, [("referrals_count", -1)], "leaderboard.refresh"),
+    ("channels", {"channel_id": 0}, None, "funding.manage_funding / checker.verify_callback"),
+    ("channels", {"username": ""}, None, "checker.verify_callback"),
+    ("channels", {"force_sub": True, "active": True}, None, "checker.get_force_channels_from_db"),
+    ("channels", {"active": True}, [("created_at", -1)], "checker/funding.get_active_funding_channels"),
+    ("channels", {"owner_id": 0}, [("created_at", -1)], "funding.get_user_channels"),
+    ("channels", {"in_points_pool": True, "active": True}, [("pool_added_at", -1)], "funding.get_pool_channels"),
+    ("list_channels", {"channel_id": 0}, None, "listah_manage.manage_actions"),
+    ("list_channels", {"owner_id": 0}, None, "listah_manage.show_main / listah_stats.show_main"),
+    ("list_channels", {"list_active": True}, None, "ads_engine.run_ads_engine"),
+    ("ads_history", {"to_channel": 0}, [("timestamp", -1)], "ads_cleaner.run_ads_cleaner / ads_engine.rotate_ad"),
+    ("ads_history", {"timestamp": {"$gte": 0}}, None, "ads_cleaner.clean_pass"),
+    ("ads_history", {"from_channel": 0, "status": "ignored"}, None, "listah_stats.show_main"),
+    ("subscription_credits", {"owner_id": 0}, None, "stats.build_report (credits.count_for_owner)"),
+]
+
+def _plan_has_collscan(plan) -> bool:
+    """البحث في شجرة خطة التنفيذ (winningPlan) عن مرحلة COLLSCAN"""
+    if isinstance(plan, dict):
+        if plan.get("stage") == "COLLSCAN":
+            return True
+        return any(_plan_has_collscan(v) for v in plan.values())
+    if isinstance(plan, list):
+        return any(_plan_has_collscan(v) for v in plan)
+    return False
+
+# --- [ سجل الاستعلامات البطيئة ] ---
+def query_shape(value):
+    """الفلتر بعد استبدال القيم بأنواعها: {"user_id": 5} -> {"user_id": "int"}"""
+    if isinstance(value, dict):
+        return {k: query_shape(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [query_shape(value[0])] if value else []
+    if value is None:
+        return None
+    return type(value).__name__
+
+def _pipeline_shape(pipeline):
+    match = next((stage["$match"] for stage in pipeline if "$match" in stage), None)
+    return {"stages": [next(iter(stage), None) for stage in pipeline], "match": query_shape(match)}
+
+# الأوامر التي يمكن تشغيل explain عليها -> شكل الاستعلام في كل منها
+_EXPLAINABLE = {
+    "find": lambda c: query_shape(c.get("filter")),
+    "count": lambda c: query_shape(c.get("query")),
+    "distinct": lambda c: query_shape(c.get("query")),
+    "findAndModify": lambda c: query_shape(c.get("query")),
+    "update": lambda c: query_shape((c.get("updates") or [{}])[0].get("q")),
+    "delete": lambda c: query_shape((c.get("deletes") or [{}])[0].get("q")),
+    "aggregate": lambda c: _pipeline_shape(c.get("pipeline", [])),
+}
+_COMMAND_META = ("lsid", "txnNumber", "$clusterTime", "$db", "$readPreference", "readConcern", "writeConcern", "cursor")
+
+def _caller():
+    """أول إطار خارج db.py (الموديول والدالة التي أطلقت الاستعلام)"""
+    frame = sys._getframe(2)
+    while frame is not None and frame.f_code.co_filename == __file__:
+        frame = frame.f_back
+    if frame is None:
+        return None
+    return f"{frame.f_globals.get('__name__')}:{frame.f_code.co_name}"
+
+def _plan_stages(plan, out=None):
+    out = [] if out is None else out
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            out.append(plan["stage"])
+        for v in plan.values():
+            _plan_stages(v, out)
+    elif isinstance(plan, list):
+        for v in plan:
+            _plan_stages(v, out)
+    return out
+
+def _find_key(doc, key):
+    if isinstance(doc, dict):
+        if key in doc:
+            return doc[key]
+        for v in doc.values():
+            found = _find_key(v, key)
+            if found is not None:
+                return found
+    elif isinstance(doc, list):
+        for v in doc:
+            found = _find_key(v, key)
+            if found is not None:
+                return found
+    return None
+
+class SlowQueryLog(monitoring.CommandListener):
+    """
+    مستمع أوامر pymongo: يقيس كل أمر ويضع البطيء منها في طابور يعالجه خيط خلفي واحد
+    (explain مرة لكل (أمر، مجموعة، شكل) ثم إدراج في slow_queries) حتى لا يتأخر الأمر الأصلي.
+    مصدر الاستعلام يُمرَّر من DatabaseManager.run عبر tagged() لأن الأمر ينفذ في خيط المنفذ.
+    """
+
+    def __init__(self, manager, threshold_ms=SLOW_QUERY_MS):
+        self.manager = manager
+        self.threshold_ms = threshold_ms
+        self._local = threading.local()
+        self._inflight = {}     # (connection, request_id) -> (command, origin)
+        self._explained = {}    # (command, collection, shape) -> ملخص explain
+        self._queue = queue.Queue(maxsize=SLOW_QUERY_BACKLOG)
+        self._worker = None
+        self.logged = 0
+        self.dropped = 0
+
+    def tagged(self, origin, fn, *args, **kwargs):
+        self._local.origin = origin
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            self._local.origin = None
+
+    # ---------------- أحداث pymongo ----------------
+    def started(self, event):
+        if getattr(self._local, "internal", False) or event.command_name not in _EXPLAINABLE:
+            return
+        self._inflight[(event.connection_id, event.request_id)] = (event.command, getattr(self._local, "origin", None))
+
+    def succeeded(self, event):
+        self._finish(event)
+
+    def failed(self, event):
+        self._finish(event)
+
+    def _finish(self, event):
+        started = self._inflight.pop((event.connection_id, event.request_id), None)
+        if started is None or event.duration_micros < self.threshold_ms * 1000:
+            return
+        command, origin = started
+        try:
+            self._queue.put_nowait((event.command_name, command, origin, event.duration_micros / 1000, event.database_name))
+        except queue.Full:
+            self.dropped += 1
+            return
+        if self._worker is None or not self._worker.is_alive():
+            self._worker = threading.Thread(target=self._drain, name="slow-queries", daemon=True)
+            self._worker.start()
+
+    # ---------------- الخيط الخلفي ----------------
+    def _drain(self):
+        self._local.internal = True  # أوامر explain/insert هنا لا تُقاس
+        while True:
+            name, command, origin, ms, database = self._queue.get()
+            try:
+                self._record(name, command, origin, ms, database)
+            except Exception as e:
+                logger.debug(f"slow query record failed: {e}")
+
+    def _explain(self, name, command, database):
+        cmd = {k: v for k, v in command.items() if k not in _COMMAND_META}
+        if name == "aggregate":
+            cmd["cursor"] = {}
+        result = self.manager.client[database].command({"explain": cmd, "verbosity": "executionStats"})
+        stats = _find_key(result, "executionStats") or {}
+        stages = _plan_stages(_find_key(result, "winningPlan") or {})
+        return {
+            "docs_examined": stats.get("totalDocsExamined"),
+            "keys_examined": stats.get("totalKeysExamined"),
+            "n_returned": stats.get("nReturned"),
+            "plan": stages,
+            "collscan": "COLLSCAN" in stages,
+        }
+
+    def _record(self, name, command, origin, ms, database):
+        collection = command.get(name) if isinstance(command.get(name), str) else ""
+        shape = json.dumps(_EXPLAINABLE[name](command), ensure_ascii=False, sort_keys=True, default=str)
+        key = (name, collection, shape)
+        summary = self._explained.get(key)
+        first = summary is None
+        if first:
+            try:
+                summary = self._explain(name, command, database)
+            except Exception as e:
+                summary = {"explain_error": str(e)[:200]}
+            if len(self._explained) > 5000:
+                self._explained.clear()
+            self._explained[key] = summary
+        doc = {
+            "at": datetime.datetime.utcnow(), "ms": round(ms, 2), "command": name, "collection": collection,
+            "origin": origin, "shape": shape, "first_seen": first, **summary,
+        }
+        self.logged += 1
+        level = logging.WARNING if first else logging.DEBUG
+        logger.log(level, f"🐢 slow {name} {collection} {ms:.0f}ms from {origin} shape={shape} "
+                          f"examined={summary.get('docs_examined')} returned={summary.get('n_returned')} plan={summary.get('plan')}")
+        self.manager.client[database][SLOW_QUERY_COLLECTION].insert_one(doc)
+
+# الدوال التي تُغلف كـ coroutines في AsyncCollection
+ASYNC_COLLECTION_METHODS = (
+    "find_one", "find_one_and_update", "find_one_and_delete", "find_one_and_replace",
+    "insert_one", "insert_many", "update_one", "update_many", "replace_one",
+    "delete_one", "delete_many", "bulk_write", "count_documents",
+    "estimated_document_count", "distinct", "create_index", "create_indexes",
+    "index_information",
+)
+
+# --- [ الواجهة غير المتزامنة (على نمط Motor) ] ---
+class AsyncCursor:
+    """مؤشر غير متزامن: يسجل sort/limit/skip ثم ينفذ الاستعلام داخل منفذ الخيوط"""
+
+    def __init__(self, manager, factory):
+        self._manager = manager
+        self._factory = factory
+        self._chain = []
+
+    def sort(self, *args, **kwargs):
+        self._chain.append(("sort", args, kwargs))
+        return self
+
+    def limit(self, *args, **kwargs):
+        self._chain.append(("limit", args, kwargs))
+        return self
+
+    def skip(self, *args, **kwargs):
+        self._chain.append(("skip", args, kwargs))
+        return self
+
+    def _build(self):
+        cursor = self._factory()
+        for name, args, kwargs in self._chain:
+            cursor = getattr(cursor, name)(*args, **kwargs)
+        return cursor
+
+    async def to_list(self, length=None):
+        """جلب النتائج كقائمة (length=None يعني كل النتائج)"""
+        def _fetch():
+            cursor = self._build()
+            try:
+                if length is None:
+                    return list(cursor)
+                return [doc for _, doc in zip(range(length), cursor)]
+            finally:
+                cursor.close()
+        return await self._manager.run(_fetch)
+
+    async def __aiter__(self):
+        # جلب على دفعات حتى لا تُحمّل المجموعات الكبيرة في الذاكرة دفعة واحدة
+        cursor = await self._manager.run(self._build)
+        try:
+            while True:
+                batch = await self._manager.run(lambda: [doc for _, doc in zip(range(CURSOR_BATCH_SIZE), cursor)])
+                if not batch:
+                    break
+                for doc in batch:
+                    yield doc
+        finally:
+            await self._manager.run(cursor.close)
+
+
+class AsyncCollection:
+    """غلاف غير متزامن لمجموعة pymongo بنفس أسماء الدوال"""
+
+    def __init__(self, manager, collection):
+        self._manager = manager
+        self.delegate = collection
+        self.name = collection.name
+
+    def find(self, *args, **kwargs):
+        return AsyncCursor(self._manager, lambda: self.delegate.find(*args, **kwargs))
+
+    def aggregate(self, pipeline, **kwargs):
+        return AsyncCursor(self._manager, lambda: self.delegate.aggregate(pipeline, **kwargs))
+
+    def __getattr__(self, name):
+        if name not in ASYNC_COLLECTION_METHODS:
+            raise AttributeError(f"AsyncCollection has no method '{name}'")
+        method = getattr(self.delegate, name)
+
+        async def _call(*args, **kwargs):
+            return await self._manager.run(method, *args, **kwargs)
+        _call.__name__ = name
+        return _call
+
+
+class AsyncDatabase:
+    """db.adb.<collection> -> AsyncCollection"""
+
+    def __init__(self, manager, database):
+        self._manager = manager
+        self.delegate = database
+        self._collections = {}
+
+    def __getitem__(self, name):
+        coll = self._collections.get(name)
+        if coll is None:
+            coll = self._collections[name] = AsyncCollection(self._manager, self.delegate[name])
+        return coll
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+    async def command(self, *args, **kwargs):
+        return await self._manager.run(self.delegate.command, *args, **kwargs)
+
+
 class DatabaseManager:
     def __init__(self):
         self.uri = Config.MONGO_URL 
         self.client = None
         self.db = None
+        self.adb = None
+        self._executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="mongo")
+        self.slow_log = SlowQueryLog(self) if SLOW_QUERY_MS else None
         self._connect()
 
+    async def run(self, fn, *args, **kwargs):
+        """تنفيذ استدعاء pymongo متزامن في منفذ الخيوط دون إيقاف حلقة الأحداث"""
+        loop = asyncio.get_running_loop()
+        if self.slow_log is not None:
+            # مصدر الاستعلام يُلتقط هنا (في خيط الحلقة) ويُمرر إلى مستمع الأوامر في خيط المنفذ
+            return await loop.run_in_executor(self._executor, functools.partial(self.slow_log.tagged, _caller(), fn, *args, **kwargs))
+        return await loop.run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+
     def _connect(self):
         try:
+            # شهادات certifi لاتصالات TLS فقط (Atlas)؛ mongod محلي بدون TLS يتصل مباشرة
+            uri = self.uri.lower()
+            tls = {"tlsCAFile": certifi.where()} if uri.startswith("mongodb+srv://") or "tls=true" in uri or "ssl=true" in uri else {}
             self.client = MongoClient(
                 self.uri, 
-                tlsCAFile=certifi.where(),
-                serverSelectionTimeoutMS=30000
+                serverSelectionTimeoutMS=30000,
+                # مقاييس كل أمر لـ /metrics + سجل الاستعلامات البطيئة
+                event_listeners=[MongoCommandMetrics()] + ([self.slow_log] if self.slow_log else []),
+                **tls
             )
             self.client.admin.command('ping')
-            self.db = self.client['TelegramBot']
+            self.db = self.client[DB_NAME]
+            self.adb = AsyncDatabase(self, self.db)
             logger.info("✅ متصل بـ MongoDB Atlas - نظام شامل!")
         except Exception as e:
             logger.error(f"❌ فشل اتصال القاعدة: {e}")
 
+    def provision(self):
+        """
+        تهيئة القاعدة مرة واحدة عند الإقلاع (من main() أو مشرف العمليات، وليس عند استيراد db):
+        الفهارس الناقصة، تقرير الاستعلامات التي تمسح المجموعة كاملة، ومجموعة الاستعلامات البطيئة.
+        """
+        if self.db is None:
+            return
+        if ENSURE_INDEXES:
+            self.ensure_indexes()
+        if INDEX_SCAN_REPORT:
+            self.report_collection_scans()
+        if self.slow_log is not None:
+            self.ensure_slow_query_log()
+
+    # --- [ إدارة الفهارس ] ---
+    def ensure_indexes(self):
+        """إنشاء الفهارس الناقصة (عملية idempotent: الفهرس الموجود بنفس المواصفات لا يتغير)"""
+        for coll_name, models in INDEXES.items():
+            coll = self.db[coll_name]
+            try:
+                coll.create_indexes(models)
+                continue
+            except OperationFailure as e:
+                logger.warning(f"⚠️ فشل إنشاء فهارس {coll_name} دفعة واحدة: {e}")
+            # إعادة المحاولة فهرساً فهرساً حتى لا يمنع فهرس واحد (مثلاً unique مع قيم مكررة) البقية
+            for model in models:
+                try:
+                    coll.create_indexes([model])
+                except OperationFailure as e:
+                    logger.error(f"❌ الفهرس {coll_name}.{model.document['name']} لم يُنشأ: {e}")
+
+    def ensure_slow_query_log(self):
+        """مجموعة محدودة الحجم (capped): أقدم السجلات تُستبدل تلقائياً"""
+        try:
+            self.db.create_collection(SLOW_QUERY_COLLECTION, capped=True, size=SLOW_QUERY_CAP_MB * 1024 * 1024)
+        except CollectionInvalid:
+            pass  # موجودة
+        except Exception as e:
+            logger.warning(f"⚠️ slow_queries collection not created: {e}")
+
+    def report_collection_scans(self):
+        """تشغيل explain على الاستعلامات الساخنة وتسجيل ما يزال منها يمسح المجموعة كاملة"""
+        scans = []
+        for coll_name, flt, sort, origin in HOT_QUERIES:
+            try:
+                cursor = self.db[coll_name].find(flt)
+                if sort:
+                    cursor = cursor.sort(sort)
+                plan = cursor.explain().get("queryPlanner", {}).get("winningPlan", {})
+            except Exception as e:
+                logger.debug(f"explain {coll_name} {flt}: {e}")
+                continue
+            if _plan_has_collscan(plan):
+                scans.append((coll_name, flt, origin))
+                logger.warning(f"🐢 COLLSCAN: {coll_name}.find({flt}) — {origin}")
+        return scans
+
     # --- [ نظام المستخدمين والإحالات ] ---
-    def add_user(self, user_id, name, username):
+    async def add_user(self, user_id, name, username):
         """إضافة مستخدم مع تهيئة كاملة لحقول الإحالة والتمويل"""
-        if self.db is not None:
-            self.db.users.update_one(
+        if self.adb is not None:
+            res = await self.adb.users.update_one(
                 {"user_id": user_id},
                 {
                     "$set": {"first_name": name, "username": username},
@@ -52,12 +528,14 @@ class DatabaseManager:
                 },
                 upsert=True
             )
+            if res.upserted_id is not None:
+                await self.bump_stats(users=1)
 
     # --- [ نظام اللستة والتبادل المستقل ] ---
-    def update_list_channel(self, channel_id, owner_id, title, username, member_count):
+    async def update_list_channel(self, channel_id, owner_id, title, username, member_count):
         """إضافة أو تحديث قناة في نظام اللستة المستقل"""
-        if self.db is not None:
-            self.db.list_channels.update_one(
+        if self.adb is not None:
+            before = await self.adb.list_channels.find_one_and_update(
                 {"channel_id": channel_id},
                 {
                     "$set": {
@@ -76,13 +554,15 @@ class DatabaseManager:
                         "last_post_time": 0        # توقيت آخر نشر (كل 3 ساعات)
                     }
                 },
+                projection=STATS_PROJECTION,
                 upsert=True
             )
+            await self.track_stats("list_channels", before, {**(before or {}), "member_count": member_count})
 
     # --- [ محرك السجلات والإحصائيات ] ---
-    def log_ad_event(self, from_ch_id, to_ch_id, message_id):
+    async def log_ad_event(self, from_ch_id, to_ch_id, message_id):
         """تسجيل عملية نشر إعلان بكل تفاصيلها"""
-        if self.db is not None:
+        if self.adb is not None:
             log_data = {
                 "from_channel": from_ch_id,     # القناة صاحبة الإعلان
                 "to_channel": to_ch_id,         # القناة التي نُشر فيها الإعلان
@@ -91,36 +571,132 @@ class DatabaseManager:
                 "date_str": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
             }
             # إضافة السجل
-            self.db.ads_history.insert_one(log_data)
-            
+            await self.adb.ads_history.insert_one(log_data)
+            await self.bump_stats(ads_posted=1)
+
             # تحديث عداد "العطاء" للقناة التي نُشر فيها الإعلان (التي استقبلت)
-            self.db.list_channels.update_one(
+            await self.adb.list_channels.update_one(
                 {"channel_id": to_ch_id},
                 {"$inc": {"yield_score": 1}}
             )
 
-    def get_channel_history(self, channel_id, limit=10):
+    async def get_channel_history(self, channel_id, limit=10):
         """جلب تقرير أين نُشر إعلاني؟"""
-        if self.db is not None:
-            return list(self.db.ads_history.find({"from_channel": channel_id}).sort("timestamp", -1).limit(limit))
+        if self.adb is not None:
+            return await self.adb.ads_history.find({"from_channel": channel_id}).sort("timestamp", -1).limit(limit).to_list()
         return []
 
-    def get_global_stats(self):
-        """إحصائيات عامة للبوت ككل"""
-        if self.db is not None:
-            stats = {
-                "users_count": self.db.users.count_documents({}),
-                "channels_count": self.db.list_channels.count_documents({}),
-                "total_ads_posted": self.db.ads_history.count_documents({}),
-                "active_exchanges": self.db.list_channels.count_documents({"list_active": True})
+    async def get_global_stats(self):
+        """إحصائيات عامة للبوت ككل (من وثيقة stats_snapshot)"""
+        if self.adb is not None:
+            snap = await self.get_stats_snapshot()
+            return {
+                "users_count": snap["users"],
+                "channels_count": snap["list_channels"],
+                "total_ads_posted": snap["ads_posted"],
+                "active_exchanges": snap["list_active"]
             }
-            return stats
         return {}
 
+    # --- [ وثيقة الإحصائيات المجمعة (stats_snapshot) ] ---
+    async def bump_stats(self, **deltas):
+        """$inc على وثيقة الإحصائيات؛ أفضل جهد — أي انحراف تصححه المطابقة الدورية"""
+        deltas = {k: v for k, v in deltas.items() if v}
+        if self.adb is None or not deltas:
+            return
+        try:
+            await self.adb[STATS_COLLECTION].update_one({"_id": STATS_ID}, {"$inc": deltas}, upsert=True)
+        except Exception as e:
+            logger.warning(f"stats bump {deltas} failed: {e}")
+
+    async def track_stats(self, collection, before, after):
+        """تحديث الإحصائيات بفرق وثيقة قناة (channels/list_channels) قبل الكتابة وبعدها"""
+        await self.bump_stats(**stats_deltas(collection, before, after))
+
+    async def get_stats_snapshot(self):
+        """قراءة وثيقة واحدة؛ تُبنى بمطابقة كاملة إذا لم تُطابق من قبل"""
+        doc = await self.adb[STATS_COLLECTION].find_one({"_id": STATS_ID})
+        if not doc or "reconciled_at" not in doc:
+            # وثيقة أنشأها $inc قبل أول مطابقة لا تحمل إلا الفروق
+            return await self.reconcile_stats()
+        return {**{f: 0 for f in STATS_FIELDS}, **doc}
+
+    async def _sum_field(self, coll_name, field):
+        rows = await self.adb[coll_name].aggregate([{"$group": {"_id": None, "total": {"$sum": f"${field}"}}}]).to_list()
+        return rows[0]["total"] if rows else 0
+
+    async def reconcile_stats(self):
+        """
+        إعادة حساب الإحصائيات بدقة من المجموعات وكتابتها فوق الوثيقة.
+        الكتابات المتزامنة مع المطابقة قد تُحسب مرتين أو لا تُحسب؛ المطابقة التالية تصححها.
+        """
+        coll = self.adb
+        values = await asyncio.gather(
+            coll.users.count_documents({}),
+            coll.channels.count_documents({}),
+            coll.channels.count_documents({"active": True}),
+            self._sum_field("channels", "member_count"),
+            coll.list_channels.count_documents({}),
+            coll.list_channels.count_documents({"list_active": True}),
+            self._sum_field("list_channels", "member_count"),
+            coll.ads_history.count_documents({}),
+        )
+        exact = dict(zip(STATS_FIELDS, values))
+        now = datetime.datetime.utcnow()
+        before = await coll[STATS_COLLECTION].find_one_and_update(
+            {"_id": STATS_ID}, {"$set": {**exact, "reconciled_at": now}}, upsert=True
+        )
+        if before and "reconciled_at" in before:
+            drift = {f: before.get(f, 0) - exact[f] for f in STATS_FIELDS if before.get(f, 0) != exact[f]}
+            if drift:
+                logger.info(f"📊 stats_snapshot drift corrected: {drift}")
+        return {"_id": STATS_ID, **exact, "reconciled_at": now}
+
+    # --- [ عقود القيادة (Leases) بين النسخ ] ---
+    async def acquire_lease(self, name, owner, ttl):
+        """
+        أخذ العقد name أو تجديده لمدة ttl ثانية.
+        يعيد رمز السياج (fencing token) — عدد يزيد مع كل انتقال للملكية — أو None إذا كان العقد لغيرنا.
+        """
+        if self.adb is None:
+            return None
+        now = datetime.datetime.utcnow()
+        expires_at = now + datetime.timedelta(seconds=ttl)
+        # 1. تجديد عقد نملكه ولم ينتهِ (نفس الرمز)
+        doc = await self.adb.leases.find_one_and_update(
+            {"_id": name, "owner": owner, "expires_at": {"$gt": now}},
+            {"$set": {"expires_at": expires_at, "renewed_at": now}},
+            return_document=ReturnDocument.AFTER
+        )
+        if doc:
+            return doc["token"]
+        # 2. الاستيلاء على عقد منتهٍ أو غير موجود (رمز جديد)
+        try:
+            doc = await self.adb.leases.find_one_and_update(
+                {"_id": name, "$or": [{"expires_at": {"$lte": now}}, {"expires_at": {"$exists": False}}]},
+                {"$set": {"owner": owner, "expires_at": expires_at, "renewed_at": now, "acquired_at": now}, "$inc": {"token": 1}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            return None  # عقد ساري لمالك آخر
+        return doc["token"] if doc and doc.get("owner") == owner else None
+
+    async def release_lease(self, name, owner):
+        """التخلي عن العقد فوراً (ليأخذه الاحتياطي دون انتظار انتهائه)"""
+        if self.adb is not None:
+            await self.adb.leases.update_one({"_id": name, "owner": owner}, {"$set": {"expires_at": datetime.datetime.utcnow()}})
+
+    async def lease_token_is_current(self, name, token):
+        """التحقق من أن رمز السياج ما زال الأحدث (لم يستولِ أحد على العقد بعدنا)"""
+        if self.adb is None:
+            return False
+        return await self.adb.leases.count_documents({"_id": name, "token": token}, limit=1) > 0
+
     # --- [ نظام التمويل (القديم لضمان التوافق) ] ---
-    def update_funding_channel(self, channel_id, owner_id, username, title, member_count):
-        if self.db is not None:
-            self.db.channels.update_one(
+    async def update_funding_channel(self, channel_id, owner_id, username, title, member_count):
+        if self.adb is not None:
+            before = await self.adb.channels.find_one_and_update(
                 {"channel_id": channel_id},
                 {
                     "$set": {
@@ -130,8 +706,10 @@ class DatabaseManager:
                         "member_count": member_count
                     }
                 },
+                projection=STATS_PROJECTION,
                 upsert=True
             )
+            await self.track_stats("channels", before, {**(before or {}), "member_count": member_count})
 
 # تصدير الكائن للاستخدام المباشر
 db = DatabaseManager()
@@ -0,0 +1,70 @@
+import time
+import bisect
+import asyncio
+import logging
+from config import Config
+from db import db
+from metrics import loop_cycle
+from ratelimit import use_lane, BULK
+
+logger = logging.getLogger(__name__)
+
+# لوحة المتصدرين بالإحالات: نسخة مرتبة في الذاكرة تُحدَّث كل LEADERBOARD_REFRESH ثانية (في كل عملية)،
+# فالترتيب بحث ثنائي O(log n) بلا أي رحلة إلى القاعدة، والمتصدرون والنسبة المئوية من نفس النسخة.
+LEADERBOARD_REFRESH = getattr(Config, "LEADERBOARD_REFRESH", 300)
+LEADERBOARD_TOP = getattr(Config, "LEADERBOARD_TOP", 10)
+
+class Leaderboard:
+    """counts: referrals_count (>0) مرتبة تصاعدياً؛ أصحاب الصفر لا يُحمَّلون (يكفي عددهم من stats_snapshot)"""
+
+    def __init__(self, top_size=LEADERBOARD_TOP):
+        self.top_size = top_size
+        self._counts = []
+        self._top = []
+        self._total_users = 0
+        self.refreshed_at = None
+        self._lock = asyncio.Lock()
+
+    async def refresh(self):
+        async with self._lock:
+            started = time.monotonic()
+            docs = await db.adb.users.find(
+                {"referrals_count": {"$gt": 0}},
+                {"_id": 0, "user_id": 1, "referrals_count": 1, "first_name": 1, "username": 1},
+            ).sort("referrals_count", -1).to_list()
+            total_users = (await db.get_stats_snapshot())["users"]
+            # التبديل دفعة واحدة: القراء يرون النسخة القديمة أو الجديدة كاملة
+            self._counts = [d["referrals_count"] for d in reversed(docs)]
+            self._top = docs[:self.top_size]
+            self._total_users = max(total_users, len(docs))
+            self.refreshed_at = time.time()
+            logger.debug(f"leaderboard refreshed: {len(docs)} referrers in {time.monotonic() - started:.2f}s")
+
+    async def ensure_loaded(self):
+        if self.refreshed_at is None:
+            await self.refresh()
+
+    def rank(self, referrals_count) -> int:
+        """1 + عدد من لديهم إحالات أكثر (نفس معنى count_documents({"$gt": ...}) + 1)"""
+        return len(self._counts) - bisect.bisect_right(self._counts, referrals_count) + 1
+
+    def top_percent(self, referrals_count) -> float:
+        """أنت ضمن أفضل X% من المستخدمين"""
+        total = max(self._total_users, 1)
+        return min(100.0, self.rank(referrals_count) / total * 100)
+
+    def top(self, n=None):
+        return self._top[:n or self.top_size]
+
+    async def run(self):
+        use_lane(BULK)
+        while True:
+            try:
+                with loop_cycle("leaderboard"):
+                    await self.refresh()
+            except Exception as e:
+                logger.error(f"Leaderboard refresh error: {e}")
+            await asyncio.sleep(LEADERBOARD_REFRESH)
+
+# نسخة مشتركة على مستوى العملية
+leaderboard = Leaderboard()
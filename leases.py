@@ -0,0 +1,93 @@
+import os
+import time
+import socket
+import asyncio
+import logging
+from config import Config
+from db import db
+
+logger = logging.getLogger(__name__)
+
+# قيادة الحلقات الخلفية بين النسخ/العمليات: كل حلقة (محرك الإعلانات، المنظف، مراقب التمويل) تأخذ عقدها
+# من MongoDB (db.acquire_lease) قبل كل دورة، والنسخ الاحتياطية تبقى خاملة حتى ينتهي عقد القائد.
+LEASE_TTL = getattr(Config, "LEASE_TTL", 15)      # ثوانٍ قبل أن يستولي الاحتياطي على عقد قائد ميت
+LEASE_RETRY = getattr(Config, "LEASE_RETRY", 3)   # ثوانٍ بين محاولات الاحتياطي
+OWNER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+class LeaderLease:
+    """
+    عقد قيادة باسم name مع نبض (heartbeat) يجدده كل ttl/3 ما دمنا نملكه.
+    token هو رمز السياج الحالي؛ held() تحقق محلي رخيص قبل أي أثر جانبي (نشر، حذف، تنبيه).
+    """
+
+    def __init__(self, name, ttl=LEASE_TTL, retry=LEASE_RETRY, owner=OWNER_ID):
+        self.name = name
+        self.ttl = ttl
+        self.retry = retry
+        self.owner = owner
+        self.token = None
+        self._valid_until = 0.0
+        self._heartbeat = None
+
+    def held(self) -> bool:
+        # هامش أمان: نعتبر العقد منتهياً قبل انتهائه في القاعدة بثلث المدة
+        return self.token is not None and time.monotonic() < self._valid_until
+
+    async def acquire(self):
+        """محاولة واحدة لأخذ/تجديد العقد؛ يعيد رمز السياج أو None"""
+        started = time.monotonic()
+        try:
+            token = await db.acquire_lease(self.name, self.owner, self.ttl)
+        except Exception as e:
+            logger.error(f"lease {self.name} acquire failed: {e}")
+            return self.token if self.held() else None
+        if token is None:
+            if self.token is not None:
+                logger.warning(f"lease {self.name} lost by {self.owner}")
+            self.token = None
+            return None
+        if token != self.token:
+            logger.info(f"lease {self.name} acquired by {self.owner} (token {token})")
+        self.token = token
+        self._valid_until = started + self.ttl * 2 / 3
+        if self._heartbeat is None or self._heartbeat.done():
+            self._heartbeat = asyncio.create_task(self._beat())
+        return token
+
+    async def wait(self):
+        """الانتظار (كاحتياطي خامل) حتى نصبح القائد؛ يعيد رمز السياج"""
+        while True:
+            token = await self.acquire()
+            if token is not None:
+                return token
+            await asyncio.sleep(self.retry)
+
+    async def _beat(self):
+        while self.token is not None:
+            await asyncio.sleep(self.ttl / 3)
+            if self.token is None:
+                break
+            await self.acquire()
+
+    async def release(self):
+        if self._heartbeat and not self._heartbeat.done():
+            self._heartbeat.cancel()
+        if self.token is not None:
+            self.token = None
+            try:
+                await db.release_lease(self.name, self.owner)
+            except Exception:
+                pass
+
+    async def still_current(self) -> bool:
+        """تحقق من القاعدة نفسها (وليس محلياً) أن رمزنا ما زال الأحدث — قبل العمليات غير القابلة للتكرار"""
+        return self.held() and await db.lease_token_is_current(self.name, self.token)
+
+def fenced(query, token):
+    """
+    فلتر كتابة مسيَّجة: يطابق الوثيقة فقط إذا لم يكتب عليها قائد أحدث (fence أكبر من رمزنا).
+    الكتابة تضبط {"fence": token}، فقائد متوقف مؤقتاً ثم استُبدل تُرفض كتاباته في القاعدة نفسها (matched_count=0).
+    """
+    if token is None:
+        return query
+    return {**query, "fence": {"$not": {"$gt": token}}}
@@ -2,10 +2,12 @@ import os
 import importlib
 import logging
 import asyncio
+from types import MappingProxyType
 from telegram import Update, ReplyKeyboardMarkup, KeyboardButton
 from telegram.ext import Application, CommandHandler, ContextTypes, MessageHandler, filters
 from config import Config
 from db import db
+import router
 
 # إعداد السجلات
 logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
@@ -13,37 +15,61 @@ logger = logging.getLogger(__name__)
 
 # --- [ بناء القائمة الأساسية ] ---
 
-async def get_main_reply_keyboard(user_id):
-    """توليد أزرار أساسية ديناميكية من الموديولات المحقونة"""
-    buttons = []
-    
-    # جلب الأزرار من الموديولات المسجلة في Config
-    for mod_path, button_text in Config.DYNAMIC_BUTTONS.items():
-        buttons.append(KeyboardButton(button_text))
-    
-    # إضافة زر الإدارة للمشرف فقط
-    if user_id == Config.ADMIN_ID:
-        buttons.append(KeyboardButton("🛠️ لوحة الإدارة"))
-        
+ADMIN_BUTTON = "🛠️ لوحة الإدارة"
+
+# تُبنى مرة واحدة في load_modules: لوحة أزرار جاهزة وجدول توجيه (نص الزر -> show_main) لكل دور
+_KEYBOARDS = {}
+_ROUTES = {"user": MappingProxyType({}), "admin": MappingProxyType({})}
+# دوال الموديولات المستخدمة في كل رسالة (تُربط بعد التحميل بدل الاستيراد داخل المعالج)
+_check_subscription = None
+_process_referral = None
+
+def _role(user_id):
+    return "admin" if user_id == Config.ADMIN_ID else "user"
+
+def _build_keyboard(button_texts):
     # توزيع الأزرار (2 في كل صف)
+    buttons = [KeyboardButton(t) for t in button_texts]
     keyboard = [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
-    
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True, input_field_placeholder="اختر من القائمة أدناه...")
 
+def build_menus(routes, admin_handler=None):
+    """بناء لوحات الأزرار وجداول التوجيه الثابتة لكل دور من أزرار الموديولات المحقونة"""
+    global _ROUTES
+    user_routes = dict(routes)
+    admin_routes = dict(routes)
+    if admin_handler is not None:
+        # زر الإدارة للمشرف فقط
+        admin_routes[ADMIN_BUTTON] = admin_handler
+    _ROUTES = {"user": MappingProxyType(user_routes), "admin": MappingProxyType(admin_routes)}
+    _KEYBOARDS["user"] = _build_keyboard(Config.DYNAMIC_BUTTONS.values())
+    _KEYBOARDS["admin"] = _build_keyboard(list(Config.DYNAMIC_BUTTONS.values()) + [ADMIN_BUTTON])
+
+async def get_main_reply_keyboard(user_id):
+    """القائمة الأساسية الجاهزة حسب دور المستخدم"""
+    role = _role(user_id)
+    if role not in _KEYBOARDS:
+        build_menus({})
+    return _KEYBOARDS[role]
+
 # --- [ محرك الحقن التلقائي ] ---
 
 async def load_modules(application):
     """تحميل الموديولات وربط الأزرار والـ Handlers تلقائياً"""
+    global _check_subscription, _process_referral
     modules_dir = os.path.join(os.path.dirname(__file__), "modules")
     if not os.path.exists(modules_dir):
         os.makedirs(modules_dir)
         return
 
+    routes = {}
+    loaded = {}
     for filename in os.listdir(modules_dir):
         if filename.endswith(".py") and filename != "__init__.py":
             module_name = f"modules.{filename[:-3]}"
             try:
                 module = importlib.import_module(module_name)
+                loaded[module_name] = module
                 
                 # تنفيذ دالة setup لربط أي معالجات إضافية
                 if hasattr(module, "setup"):
@@ -52,10 +78,21 @@ async def load_modules(application):
                 # تسجيل الزر الرئيسي للموديول
                 if hasattr(module, "MAIN_BUTTON"):
                     Config.DYNAMIC_BUTTONS[module_name] = module.MAIN_BUTTON
+                    if hasattr(module, "show_main"):
+                        routes[module.MAIN_BUTTON] = module.show_main
                     logger.info(f"✅ تم حقن موديول: {filename}")
             except Exception as e:
                 logger.error(f"⚠️ خطأ أثناء تحميل الموديول {filename}: {e}")
 
+    checker = loaded.get("modules.checker")
+    referral = loaded.get("modules.referral")
+    admin = loaded.get("modules.admin")
+    _check_subscription = getattr(checker, "check_subscription", None)
+    _process_referral = getattr(referral, "process_referral", None)
+    if checker is None:
+        logger.warning("Checker module not found, skipping sub check.")
+    build_menus(routes, getattr(admin, "show_main", None))
+
 # --- [ المعالجات الرئيسية ] ---
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -68,19 +105,15 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         referrer_id = int(context.args[0])
     
     # استدعاء موديول الإحالات لمعالجة النقاط والتنبيهات
-    try:
-        from modules.referral import process_referral
-        await process_referral(user, referrer_id, context)
-    except Exception as e:
-        logger.error(f"Error in referral processing: {e}")
+    if _process_referral is not None:
+        try:
+            await _process_referral(user, referrer_id, context)
+        except Exception as e:
+            logger.error(f"Error in referral processing: {e}")
 
     # 2. التحقق من الاشتراك الإجباري قبل الدخول
-    try:
-        from modules.checker import check_subscription
-        if not await check_subscription(update, context):
-            return # توقف إذا لم يشترك
-    except ImportError:
-        logger.warning("Checker module not found, skipping sub check.")
+    if _check_subscription is not None and not await _check_subscription(update, context):
+        return # توقف إذا لم يشترك
 
     # 3. عرض القائمة الرئيسية
     reply_markup = await get_main_reply_keyboard(user.id)
@@ -90,44 +123,119 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     await update.message.reply_text(welcome_text, reply_markup=reply_markup, parse_mode="Markdown")
 
+async def check_subscription_safe(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    if _check_subscription is None:
+        return True
+    try:
+        return await _check_subscription(update, context)
+    except Exception as e:
+        logger.error(f"Error in subscription check: {e}")
+        return True
+
 async def handle_text_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """التحقق من ضغط الأزرار الأساسية أو إرسال روابط القنوات"""
+    """الموجه الوحيد للرسائل: زر من القائمة، أو حالة انتظار المستخدم (رابط، نص إعلان، إدخال المشرف...)"""
     text = update.message.text
     user_id = update.effective_user.id
 
-    # أولاً: التحقق من الاشتراك الإجباري في كل ضغطة زر (لضمان بقائه في القنوات)
-    try:
-        from modules.checker import check_subscription
-        if not await check_subscription(update, context):
+    # أولاً: الموديول المطابق لنص الزر (بحث واحد في جدول التوجيه، وزر الإدارة موجود في جدول المشرف فقط)
+    handler = _ROUTES[_role(user_id)].get(text) if text else None
+    if handler is not None:
+        # ضغط زر من القائمة يلغي أي انتظار سابق
+        router.clear_state(context)
+        # التحقق من الاشتراك الإجباري في كل ضغطة زر (لضمان بقائه في القنوات)
+        if not await check_subscription_safe(update, context):
             return
-    except: pass
-
-    # ثانياً: البحث عن الموديول المطابق لنص الزر
-    for mod_path, button_text in Config.DYNAMIC_BUTTONS.items():
-        if text == button_text:
-            module = importlib.import_module(mod_path)
-            if hasattr(module, "show_main"):
-                return await module.show_main(update, context)
+        return await handler(update, context)
 
-    # ثالثاً: إذا أرسل المستخدم رابط قناة (لموديول التمويل)
-    if text.startswith("https://t.me/"):
-        try:
-            from modules.funding import handle_new_channel
-            return await handle_new_channel(update, context)
-        except: pass
+    # ثانياً: معالج واحد حسب ما ينتظره البوت من المستخدم
+    if await router.dispatch(update, context):
+        return
 
-    # رابعاً: لوحة الإدارة
-    if text == "🛠️ لوحة الإدارة" and user_id == Config.ADMIN_ID:
-        try:
-            from modules.admin import admin_panel
-            return await admin_panel(update, context)
-        except: pass
+    # ثالثاً: نص حر بلا حالة — تذكير بالاشتراك الإجباري إن لزم
+    if text:
+        await check_subscription_safe(update, context)
 
 # --- [ تشغيل البوت ] ---
 
+class BotApplication(Application):
+    """Application تبدأ الحلقات الخلفية للموديولات بعد start() (حين يتابعها PTB) وتوقفها قبل stop()"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.background = {}        # الاسم -> دالة تُنشئ الـ coroutine (تُسجل في setup الموديولات)
+        self.background_tasks = {}  # الاسم -> المهمة الجارية (مراجع محفوظة)
+
+    def add_background(self, name, factory):
+        """تسجيل حلقة خلفية؛ تبدأ مع start() أو فوراً إن كان التطبيق يعمل"""
+        self.background[name] = factory
+        if self.running:
+            self._start_background(name)
+
+    def _start_background(self, name):
+        task = self.background_tasks.get(name)
+        if task is None or task.done():
+            # create_task أثناء التشغيل: الاستثناءات تمر عبر معالجات أخطاء PTB
+            self.background_tasks[name] = self.create_task(self.background[name](), name=name)
+
+    async def start(self):
+        await super().start()
+        for name in self.background:
+            self._start_background(name)
+
+    async def stop(self):
+        # الحلقات لا تنتهي وحدها، و stop() ينتظر كل مهام create_task -> إلغاؤها أولاً
+        tasks = list(self.background_tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.background_tasks.clear()
+        await super().stop()
+
+async def _post_stop(application):
+    # إرسال ملخصات التنبيهات المنتظرة قبل إغلاق البوت
+    from notify import notifier
+    await notifier.flush()
+
+def build_application(updater=True, request=None):
+    """إنشاء التطبيق؛ updater=False للعمليات التي تستقبل التحديثات من المشرف (shard)، request = BaseRequest بديل (الاختبارات)"""
+    # حالات المستخدمين (user_data) محفوظة في MongoDB بكتابة مؤجلة مجمعة
+    from persistence import MongoPersistence
+    from ratelimit import GovernorRateLimiter
+    # كل استدعاءات application.bot تمر عبر المنظم: دلو عام بمسارين (تفاعلي/خلفي) + دلو لكل محادثة + RetryAfter
+    builder = (Application.builder().application_class(BotApplication).token(Config.BOT_TOKEN)
+               .persistence(MongoPersistence())
+               .rate_limiter(GovernorRateLimiter())
+               .post_stop(_post_stop))
+    if not updater:
+        builder = builder.updater(None)
+    if request is not None:
+        builder = builder.request(request)
+    return builder.build()
+
+async def prepare_application(application, worker=None):
+    """تحميل الموديولات ثم إضافة المعالجات الرئيسية؛ worker = رقم العملية العاملة في وضع shard"""
+    await load_modules(application)
+    application.add_handler(CommandHandler("start", start))
+    # معالج رسائل واحد لكل النصوص والصور (التوجيه في router)
+    application.add_handler(MessageHandler((filters.TEXT | filters.PHOTO) & ~filters.COMMAND, handle_text_messages))
+    # قياس زمن كل معالج + خادم /metrics المحلي (منفذ مستقل لكل عملية عاملة)
+    import metrics
+    metrics.instrument_handlers(application)
+    if metrics.METRICS_PORT:
+        await metrics.start_server(metrics.METRICS_PORT + (worker + 1 if worker is not None else 0))
+
 def main():
+    # الفهارس وتقرير المسح مرة واحدة هنا (العمليات العاملة في وضع التقسيم لا تكررها)
+    db.provision()
+
+    # وضع تعدد العمليات: مشرف يوزع التحديثات على WORKERS عملية حسب user_id
+    workers = getattr(Config, "WORKERS", 1)
+    if workers > 1:
+        from shard import run_supervisor
+        return run_supervisor(workers)
+
     # إنشاء التطبيق
-    application = Application.builder().token(Config.BOT_TOKEN).build()
+    application = build_application()
 
     # تحميل الموديولات قبل البدء
     try:
@@ -136,14 +244,15 @@ def main():
         loop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
         
-    loop.run_until_complete(load_modules(application))
-
-    # إضافة المعالجات
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_messages))
+    loop.run_until_complete(prepare_application(application))
 
     print("🚀 البوت يعمل الآن بنظام الأزرار الأساسية والتمويل الذكي...")
-    application.run_polling(drop_pending_updates=True)
+    if getattr(Config, "UPDATE_MODE", "polling") == "webhook":
+        # وضع الـ Webhook: لا تضيع التحديثات أثناء إعادة التشغيل ويمكن معالجتها بالتوازي
+        from webhook import run_webhook
+        loop.run_until_complete(run_webhook(application, Config.WEBHOOK_URL))
+    else:
+        application.run_polling(drop_pending_updates=True)
 
 if __name__ == "__main__":
     main()
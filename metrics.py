@@ -0,0 +1,243 @@
+import re
+import time
+import bisect
+import asyncio
+import logging
+import functools
+import threading
+from contextlib import contextmanager
+from pymongo import monitoring
+from telegram.ext import ApplicationHandlerStop
+from config import Config
+from cache import CACHES
+
+logger = logging.getLogger(__name__)
+
+# مقاييس التشغيل بصيغة Prometheus النصية على خادم HTTP محلي (GET /metrics):
+# زمن كل معالج، أوامر MongoDB (command monitoring)، استدعاءات Bot API، ومدة دورات الحلقات الخلفية.
+METRICS_HOST = getattr(Config, "METRICS_HOST", "127.0.0.1")
+METRICS_PORT = getattr(Config, "METRICS_PORT", 9108)  # 0 = معطل؛ العمليات العاملة (shard) تستخدم المنفذ + رقمها + 1
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+LOOP_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600)
+
+REGISTRY = []
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _fmt_labels(names, values, extra=None) -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labels)
+        self._lock = threading.Lock()  # مستمعو pymongo يعملون في خيوط المنفذ
+        REGISTRY.append(self)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, help_text, labels=()):
+        super().__init__(name, help_text, labels)
+        self._values = {}
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+    def render(self):
+        lines = self.header()
+        with self._lock:
+            items = list(self._values.items())
+        lines += [f"{self.name}{_fmt_labels(self.labelnames, k)} {v}" for k, v in items]
+        return lines
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+        self._series = {}  # labels -> [counts لكل حد, sum, count]
+
+    def observe(self, value, *labels):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * len(self.buckets), 0.0, 0]
+            idx = bisect.bisect_left(self.buckets, value)
+            if idx < len(self.buckets):
+                series[0][idx] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def render(self):
+        lines = self.header()
+        with self._lock:
+            items = [(k, list(s[0]), s[1], s[2]) for k, s in self._series.items()]
+        for labels, counts, total, count in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                le = _fmt_labels(self.labelnames, labels, 'le="%s"' % bound)
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            le = _fmt_labels(self.labelnames, labels, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{le} {count}")
+            lines.append(f"{self.name}_sum{_fmt_labels(self.labelnames, labels)} {total}")
+            lines.append(f"{self.name}_count{_fmt_labels(self.labelnames, labels)} {count}")
+        return lines
+
+class CacheStats(_Metric):
+    """عدادات الكاشات المسجلة في cache.CACHES (تُقرأ عند الطلب)"""
+    kind = "gauge"
+
+    def render(self):
+        lines = self.header()
+        for name, cache in list(CACHES.items()):
+            st = cache.stats()
+            for field in ("size", "hits", "misses"):
+                lines.append(f'{self.name}{{cache="{_escape(name)}",field="{field}"}} {st[field]}')
+        return lines
+
+# ---------------- المقاييس ----------------
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "Handler latency by module and pattern.", ("module", "handler"))
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Handler exceptions by module and pattern.", ("module", "handler"))
+MONGO_SECONDS = Histogram("bot_mongo_command_seconds", "MongoDB command duration.", ("command", "collection"))
+MONGO_FAILURES = Counter("bot_mongo_command_failures_total", "Failed MongoDB commands.", ("command", "collection"))
+TG_CALLS = Counter("bot_telegram_calls_total", "Bot API calls by method and lane.", ("method", "lane"))
+TG_SECONDS = Histogram("bot_telegram_call_seconds", "Bot API call duration (including rate-limit waits).", ("method",))
+TG_ERRORS = Counter("bot_telegram_errors_total", "Bot API errors by method and error type.", ("method", "error"))
+TG_RETRY_AFTER = Counter("bot_telegram_retry_after_total", "RetryAfter (flood-wait) responses by method.", ("method",))
+LOOP_SECONDS = Histogram("bot_loop_cycle_seconds", "Background loop cycle duration.", ("loop",), buckets=LOOP_BUCKETS)
+CACHE_STATS = CacheStats("bot_cache", "TTL cache size/hits/misses.")
+
+def render() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+def loop_cycle(name):
+    """with metrics.loop_cycle("ads_engine"): ... — مدة دورة واحدة من حلقة خلفية"""
+    return LOOP_SECONDS.time(name)
+
+# ---------------- MongoDB (command monitoring) ----------------
+class MongoCommandMetrics(monitoring.CommandListener):
+    """يُمرَّر إلى MongoClient(event_listeners=[...]) في DatabaseManager"""
+
+    def __init__(self):
+        self._inflight = {}  # (connection, request_id) -> (command, collection)
+
+    def started(self, event):
+        name = event.command_name
+        target = event.command.get(name)
+        collection = target if isinstance(target, str) else event.command.get("collection", "")
+        self._inflight[(event.connection_id, event.request_id)] = (name, collection if isinstance(collection, str) else "")
+
+    def succeeded(self, event):
+        labels = self._inflight.pop((event.connection_id, event.request_id), (event.command_name, ""))
+        MONGO_SECONDS.observe(event.duration_micros / 1e6, *labels)
+
+    def failed(self, event):
+        labels = self._inflight.pop((event.connection_id, event.request_id), (event.command_name, ""))
+        MONGO_SECONDS.observe(event.duration_micros / 1e6, *labels)
+        MONGO_FAILURES.inc(*labels)
+
+# ---------------- المعالجات ----------------
+def handler_labels(handler):
+    """(الموديول، النمط) مثل ("funding", "^fund_") أو ("main", "/start")"""
+    callback = getattr(handler.callback, "__wrapped__", handler.callback)
+    module = (getattr(callback, "__module__", "") or "").rsplit(".", 1)[-1]
+    if module == "__main__":
+        module = "main"
+    pattern = getattr(handler, "pattern", None)
+    if isinstance(pattern, re.Pattern):
+        return module, pattern.pattern
+    if isinstance(pattern, str):
+        return module, pattern
+    commands = getattr(handler, "commands", None)
+    if commands:
+        return module, "/" + ",".join(sorted(commands))
+    return module, getattr(callback, "__name__", type(handler).__name__)
+
+def _timed(callback, module, name):
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        start = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except ApplicationHandlerStop:
+            raise
+        except Exception:
+            HANDLER_ERRORS.inc(module, name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - start, module, name)
+    wrapper._timed = True
+    return wrapper
+
+def instrument_handlers(application):
+    """تغليف callback كل معالج مسجل بمؤقت (يُستدعى بعد تسجيل كل المعالجات)"""
+    count = 0
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            if getattr(handler.callback, "_timed", False):
+                continue
+            handler.callback = _timed(handler.callback, *handler_labels(handler))
+            count += 1
+    return count
+
+# ---------------- خادم HTTP ----------------
+async def _serve(reader, writer):
+    from webhook import _read_request
+    try:
+        request = await _read_request(reader)
+        if request is None:
+            return
+        method, path, _, _ = request
+        if method == "GET" and path == "/metrics":
+            status, body, ctype = "200 OK", render().encode(), "text/plain; version=0.0.4; charset=utf-8"
+        else:
+            status, body, ctype = "404 Not Found", b"", "text/plain"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: {ctype}\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body
+        )
+        await writer.drain()
+    except Exception as e:
+        logger.debug(f"metrics request failed: {e}")
+    finally:
+        writer.close()
+
+async def start_server(port=METRICS_PORT, host=METRICS_HOST):
+    """تشغيل خادم /metrics؛ يعيد الخادم أو None إذا كان معطلاً أو المنفذ مشغولاً"""
+    if not port:
+        return None
+    try:
+        server = await asyncio.start_server(_serve, host, port)
+    except OSError as e:
+        logger.warning(f"metrics endpoint not started on {host}:{port}: {e}")
+        return None
+    logger.info(f"📈 metrics on http://{host}:{port}/metrics")
+    return server
@@ -1,7 +1,7 @@
 # modules/admin.py
 # لوحة إدارة متكاملة — محدثة لضمان استجابة الزر (Reply Keyboard) وInline buttons.
 # MAIN_BUTTON يضمن ظهور زر في القائمة الرئيسية (main) باسم "زر لوحة المشرف".
-# متوافق مع python-telegram-bot v20+ و MongoDB (db.db)
+# متوافق مع python-telegram-bot v20+ و MongoDB (db.adb)
 
 import os
 import sys
@@ -11,12 +11,16 @@ from typing import List, Dict, Any, Optional
 
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update, KeyboardButton, ReplyKeyboardMarkup
 from telegram.constants import ParseMode
-from telegram.ext import ContextTypes, CallbackQueryHandler, MessageHandler, CommandHandler, filters
+from telegram.ext import ContextTypes, CallbackQueryHandler, CommandHandler
 
 # تمكين استيراد الوحدات العليا (main, db, config)
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from db import db
+from db import db, STATS_PROJECTION
 from config import Config
+from cache import CACHES
+from router import register_state, set_state, get_state, clear_state
+import points as ledger
+from modules.broadcast import start_job as start_broadcast_job, cancel_job as cancel_broadcast_job, list_jobs as list_broadcast_jobs, progress_text as broadcast_progress_text, progress_markup as broadcast_progress_markup
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
@@ -75,7 +79,8 @@ async def show_admin_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
          InlineKeyboardButton("📂 عرض قنوات/مجموعات", callback_data="adm_list_channels")],
         [InlineKeyboardButton("📣 نشر في كل القنوات", callback_data="adm_broadcast_channels"),
          InlineKeyboardButton("📣 نشر في قناة/مجموعة", callback_data="adm_broadcast_single")],
-        [InlineKeyboardButton("👥 عرض المستخدمين", callback_data="adm_list_users")]
+        [InlineKeyboardButton("👥 عرض المستخدمين", callback_data="adm_list_users"),
+         InlineKeyboardButton("📡 عمليات البث", callback_data="adm_bc_jobs")]
     ]
 
     # إن جاء الطلب عن طريق زر قائمة Reply Keyboard (نص) فإن update.message موجود
@@ -102,16 +107,19 @@ async def show_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await show_admin_main(update, context)
 
 # ---------------- معالجات الإدخال النصي (حالات المشرف) ----------------
+# حالات الانتظار الإدارية — كلها تُوجَّه إلى process_admin_text
+ADMIN_STATES = ("grant_user_wait", "grant_all_wait", "msg_user_wait", "broadcast_wait", "broadcast_channels_wait", "broadcast_single_wait")
+
 async def process_admin_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """معالجة نصية لجميع الحالات الإدارية التي تنتظر إدخال نص من المشرف"""
     user = update.effective_user
     if not user or not is_admin(user.id):
         return
 
-    action = context.user_data.get("admin_action")
+    action = get_state(context)
     text = (update.message.text or "").strip()
 
-    # منح نقاط لمستخدم (context.user_data['admin_action']=='grant_user_wait')
+    # منح نقاط لمستخدم (حالة grant_user_wait)
     if action == "grant_user_wait":
         # دعم: reply with number OR "id points" OR "@username points"
         target_id = None
@@ -132,7 +140,7 @@ async def process_admin_text(update: Update, context: ContextTypes.DEFAULT_TYPE)
                     points = None
                 if who.startswith("@"):
                     uname = who.lstrip("@")
-                    udoc = db.db.users.find_one({"username": uname})
+                    udoc = await db.adb.users.find_one({"username": uname})
                     if udoc:
                         target_id = udoc.get("user_id")
                 else:
@@ -142,15 +150,15 @@ async def process_admin_text(update: Update, context: ContextTypes.DEFAULT_TYPE)
                         target_id = None
         if not target_id or points is None:
             await update.message.reply_text("❌ المدخل غير صالح. ارسل: `@username 50` أو `12345 50` أو قم بالرد على رسالة المستخدم و اكتب `50`.", parse_mode=ParseMode.HTML)
-            context.user_data.pop("admin_action", None)
+            clear_state(context)
             return
-        db.db.users.update_one({"user_id": target_id}, {"$inc": {"points": points}}, upsert=True)
+        await ledger.credit(target_id, points, "admin_grant", ref=user.id)
         await update.message.reply_text(f"✅ تم منح {points} نقطة للمستخدم <code>{target_id}</code>.", parse_mode=ParseMode.HTML)
         try:
             await context.bot.send_message(target_id, f"🎁 تم إضافة {points} نقطة لحسابك بواسطة المشرف.")
         except Exception:
             pass
-        context.user_data.pop("admin_action", None)
+        clear_state(context)
         return
 
     # منح نقاط للجميع
@@ -159,12 +167,12 @@ async def process_admin_text(update: Update, context: ContextTypes.DEFAULT_TYPE)
             pts = int(text)
         except:
             await update.message.reply_text("❌ ارسل عدد صحيح من النقاط (مثال: 20).")
-            context.user_data.pop("admin_action", None)
+            clear_state(context)
             return
-        res = db.db.users.update_many({}, {"$inc": {"points": pts}})
-        count = res.matched_count if res else 0
+        # عبر دفتر النقاط (حركة لكل مستخدم) حتى يبقى points_ledger مطابقاً لـ users.points
+        count = await ledger.credit_all(pts, "admin_grant_all", ref=user.id)
         await update.message.reply_text(f"✅ تم منح {pts} نقطة إلى {count} مستخدمًا.")
-        context.user_data.pop("admin_action", None)
+        clear_state(context)
         return
 
     # مراسلة مستخدم واحد
@@ -179,12 +187,12 @@ async def process_admin_text(update: Update, context: ContextTypes.DEFAULT_TYPE)
             parts = text.split(maxsplit=1)
             if len(parts) < 2:
                 await update.message.reply_text("❌ ارسل: `@username نص الرسالة` أو قم بالرد على رسالة المستخدم مع نص الرسالة.")
-                context.user_data.pop("admin_action", None)
+                clear_state(context)
                 return
             who, msg_text = parts[0], parts[1]
             if who.startswith("@"):
                 uname = who.lstrip("@")
-                udoc = db.db.users.find_one({"username": uname})
+                udoc = await db.adb.users.find_one({"username": uname})
                 if udoc:
                     target = udoc.get("user_id")
             else:
@@ -194,56 +202,26 @@ async def process_admin_text(update: Update, context: ContextTypes.DEFAULT_TYPE)
                     target = None
         if not target:
             await update.message.reply_text("❌ لم أجد المستخدم المستهدف. تأكد من @username أو استخدم الرد على رسالة المستخدم.")
-            context.user_data.pop("admin_action", None)
+            clear_state(context)
             return
         try:
             await context.bot.send_message(target, msg_text, parse_mode=ParseMode.HTML)
             await update.message.reply_text("✅ تم إرسال الرسالة.")
         except Exception as e:
             await update.message.reply_text(f"❌ فشل إرسال الرسالة: {e}")
-        context.user_data.pop("admin_action", None)
+        clear_state(context)
         return
 
-    # مراسلة الجميع
-    if action == "broadcast_wait":
+    # مراسلة الجميع / نشر في كل القنوات — مهمة بث خلفية محدودة المعدل وقابلة للاستئناف
+    if action in ("broadcast_wait", "broadcast_channels_wait"):
         body = text
+        target = "users" if action == "broadcast_wait" else "channels"
         if not body:
-            await update.message.reply_text("❌ اكتب نص الرسالة لإرسالها لجميع المستخدمين.")
-            context.user_data.pop("admin_action", None)
+            await update.message.reply_text("❌ اكتب نص الرسالة لإرسالها لجميع المستخدمين." if target == "users" else "❌ اكتب نص الرسالة للنشر في القنوات.")
+            clear_state(context)
             return
-        sent = 0
-        failed = 0
-        cursor = db.db.users.find({})
-        for u in cursor:
-            uid = u.get("user_id")
-            try:
-                await context.bot.send_message(uid, body, parse_mode=ParseMode.HTML)
-                sent += 1
-            except Exception:
-                failed += 1
-        await update.message.reply_text(f"✅ الإرسال اكتمل. نجح: {sent} — فشل: {failed}")
-        context.user_data.pop("admin_action", None)
-        return
-
-    # نشر في كل القنوات
-    if action == "broadcast_channels_wait":
-        body = text
-        if not body:
-            await update.message.reply_text("❌ اكتب نص الرسالة للنشر في القنوات.")
-            context.user_data.pop("admin_action", None)
-            return
-        channels = list(db.db.channels.find({"active": True}))
-        sent = 0
-        failed = 0
-        for ch in channels:
-            ch_id = ch.get("channel_id")
-            try:
-                await context.bot.send_message(ch_id, body, parse_mode=ParseMode.HTML)
-                sent += 1
-            except Exception:
-                failed += 1
-        await update.message.reply_text(f"✅ النشر اكتمل. نجح: {sent} — فشل: {failed}")
-        context.user_data.pop("admin_action", None)
+        await start_broadcast_job(context.application, target, body, update.effective_chat.id)
+        clear_state(context)
         return
 
     # نشر في قناة مفردة (context.user_data['admin_target_channel'])
@@ -252,19 +230,39 @@ async def process_admin_text(update: Update, context: ContextTypes.DEFAULT_TYPE)
         body = text
         if not ch_id or not body:
             await update.message.reply_text("❌ خطأ: لم يتم تحديد القناة أو نص الرسالة.")
-            context.user_data.pop("admin_action", None)
+            clear_state(context)
             return
         try:
             await context.bot.send_message(ch_id, body, parse_mode=ParseMode.HTML)
             await update.message.reply_text("✅ تم النشر في القناة المحددة.")
         except Exception as e:
             await update.message.reply_text(f"❌ فشل النشر: {e}")
-        context.user_data.pop("admin_action", None)
+        clear_state(context)
         return
 
     # لا حالة إدارية حالية -> تجاهل
     return
 
+async def show_broadcast_jobs(query, notice=None):
+    """تعديل الرسالة إلى آخر عمليات البث (زر إلغاء للجارية فقط)؛ notice سطر نتيجة في الأعلى"""
+    jobs = await list_broadcast_jobs()
+    kb = []
+    lines = ["<b>📡 آخر عمليات البث</b>\n"]
+    if notice:
+        lines.insert(0, notice)
+    for job in jobs:
+        lines.append(broadcast_progress_text(job))
+        markup = broadcast_progress_markup(job)
+        if markup:
+            kb.extend(markup.inline_keyboard)
+    if not jobs:
+        lines.append("لا توجد عمليات بث بعد.")
+    kb.append([InlineKeyboardButton("🔄 تحديث", callback_data="adm_bc_jobs"), InlineKeyboardButton("🏠 رجوع", callback_data="adm_home")])
+    try:
+        await query.edit_message_text("\n\n".join(lines), parse_mode=ParseMode.HTML, reply_markup=InlineKeyboardMarkup(kb))
+    except Exception:
+        pass
+
 # ---------------- Callback handler لإدارة النقرات ----------------
 async def manage_admin_callbacks(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -287,49 +285,49 @@ async def manage_admin_callbacks(update: Update, context: ContextTypes.DEFAULT_T
 
     # منح نقاط لمستخدم
     if data == "adm_grant_user":
-        context.user_data['admin_action'] = 'grant_user_wait'
+        set_state(context, 'grant_user_wait')
         await query.edit_message_text("📌 أرسل الآن: `@username 50` أو `12345 50` أو قم بالرد على رسالة المستخدم واكتب `50`.")
         return
 
     # منح نقاط للجميع
     if data == "adm_grant_all":
-        context.user_data['admin_action'] = 'grant_all_wait'
+        set_state(context, 'grant_all_wait')
         await query.edit_message_text("📌 أرسل الآن عدد النقاط لمنحها لكل المستخدمين (مثال: `20`).")
         return
 
     # مراسلة مستخدم
     if data == "adm_msg_user":
-        context.user_data['admin_action'] = 'msg_user_wait'
+        set_state(context, 'msg_user_wait')
         await query.edit_message_text("📌 أرسل الآن: `@username رسالة` أو قم بالرد على رسالة المستخدم واكتب نص الرسالة.")
         return
 
     # مراسلة الجميع
     if data == "adm_broadcast":
-        context.user_data['admin_action'] = 'broadcast_wait'
+        set_state(context, 'broadcast_wait')
         await query.edit_message_text("📣 أرسل الآن نص الرسالة التي تريد إرسالها إلى كل المستخدمين.")
         return
 
     # إحصائيات
     if data == "adm_stats":
-        users_count = db.db.users.count_documents({})
-        channels_count = db.db.channels.count_documents({})
-        active_channels = db.db.channels.count_documents({"active": True})
-        total_members = 0
-        for ch in db.db.channels.find({}):
-            total_members += int(ch.get("member_count", 0))
+        # وثيقة stats_snapshot المجمعة بدل العد والجمع على المجموعات كاملة
+        snap = await db.get_stats_snapshot()
         text = (
             "<b>📊 إحصائيات البوت</b>\n\n"
-            f"👥 عدد مستخدمي البوت: <b>{users_count}</b>\n"
-            f"📂 عدد القنوات/المجموعات المسجلة: <b>{channels_count}</b>\n"
-            f"✅ عدد القنوات/المجموعات الفعّالة: <b>{active_channels}</b>\n"
-            f"👥 إجمالي أعضاء القنوات (مجموع): <b>{total_members}</b>\n"
+            f"👥 عدد مستخدمي البوت: <b>{snap['users']}</b>\n"
+            f"📂 عدد القنوات/المجموعات المسجلة: <b>{snap['channels']}</b>\n"
+            f"✅ عدد القنوات/المجموعات الفعّالة: <b>{snap['channels_active']}</b>\n"
+            f"👥 إجمالي أعضاء القنوات (مجموع): <b>{snap['channels_members']}</b>\n"
+            f"🕒 آخر مطابقة دقيقة: <code>{snap['reconciled_at']:%Y-%m-%d %H:%M}</code> UTC\n"
         )
+        for name, cache in CACHES.items():
+            st = cache.stats()
+            text += f"🗃️ كاش {name}: <code>{st['hits']}</code> إصابة / <code>{st['misses']}</code> إخفاق — الحجم <code>{st['size']}</code>\n"
         await query.edit_message_text(text, parse_mode=ParseMode.HTML, reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🏠 رجوع", callback_data="adm_home")]]))
         return
 
     # عرض القنوات/المجموعات
     if data == "adm_list_channels":
-        channels = list(db.db.channels.find({}).limit(MAX_LIST_DISPLAY))
+        channels = await db.adb.channels.find({}).limit(MAX_LIST_DISPLAY).to_list()
         if not channels:
             await query.edit_message_text("⚠️ لا توجد قنوات مسجلة.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🏠 رجوع", callback_data="adm_home")]]))
             return
@@ -354,7 +352,7 @@ async def manage_admin_callbacks(update: Update, context: ContextTypes.DEFAULT_T
             ch_id = int(ch_raw)
         except:
             ch_id = ch_raw
-        ch = db.db.channels.find_one({"channel_id": ch_id}) or db.db.channels.find_one({"username": ch_raw})
+        ch = await db.adb.channels.find_one({"channel_id": ch_id}) or await db.adb.channels.find_one({"username": ch_raw})
         if not ch:
             await query.edit_message_text("⚠️ القناة غير موجودة.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🏠 رجوع", callback_data="adm_home")]]))
             return
@@ -387,7 +385,9 @@ async def manage_admin_callbacks(update: Update, context: ContextTypes.DEFAULT_T
             ch_id = int(ch_raw)
         except:
             ch_id = ch_raw
-        db.db.channels.update_one({"channel_id": ch_id}, {"$set": {"active": False, "deactivated_reason": "admin_disabled", "deactivated_at": datetime.utcnow()}})
+        before = await db.adb.channels.find_one_and_update({"channel_id": ch_id}, {"$set": {"active": False, "deactivated_reason": "admin_disabled", "deactivated_at": datetime.utcnow()}}, projection=STATS_PROJECTION)
+        if before:
+            await db.track_stats("channels", before, {**before, "active": False})
         await query.edit_message_text("✅ تم تعطيل/حذف القناة من النظام.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🏠 رجوع", callback_data="adm_home")]]))
         return
 
@@ -398,20 +398,20 @@ async def manage_admin_callbacks(update: Update, context: ContextTypes.DEFAULT_T
             ch_id = int(ch_raw)
         except:
             ch_id = ch_raw
-        context.user_data['admin_action'] = 'broadcast_single_wait'
+        set_state(context, 'broadcast_single_wait')
         context.user_data['admin_target_channel'] = ch_id
         await query.edit_message_text("📣 الآن أرسل نص الرسالة التي تريد نشرها في هذه القناة/المجموعة:")
         return
 
     # نشر في كل القنوات
     if data == "adm_broadcast_channels":
-        context.user_data['admin_action'] = 'broadcast_channels_wait'
+        set_state(context, 'broadcast_channels_wait')
         await query.edit_message_text("📣 أرسل الآن نص الرسالة للنشر في كل القنوات/المجموعات المسجلة:")
         return
 
     # نشر في قناة/مجموعة واحدة (اختيار)
     if data == "adm_broadcast_single":
-        channels = list(db.db.channels.find({"active": True}).limit(MAX_LIST_DISPLAY))
+        channels = await db.adb.channels.find({"active": True}).limit(MAX_LIST_DISPLAY).to_list()
         if not channels:
             await query.edit_message_text("⚠️ لا توجد قنوات/مجموعات فعّالة.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🏠 رجوع", callback_data="adm_home")]]))
             return
@@ -429,14 +429,23 @@ async def manage_admin_callbacks(update: Update, context: ContextTypes.DEFAULT_T
             ch_id = int(ch_raw)
         except:
             ch_id = ch_raw
-        context.user_data['admin_action'] = 'broadcast_single_wait'
+        set_state(context, 'broadcast_single_wait')
         context.user_data['admin_target_channel'] = ch_id
         await query.edit_message_text("📣 الآن أرسل نص الرسالة التي تريد نشرها في القناة/المجموعة المحددة:")
         return
 
+    # عمليات البث (التقدم + الإلغاء)
+    if data == "adm_bc_jobs":
+        return await show_broadcast_jobs(query)
+
+    if data.startswith("adm_bc_cancel_"):
+        # الضغطة أُجيبت أعلاه (answer لا يُستدعى مرتين)؛ النتيجة تظهر في الرسالة نفسها مع القائمة المحدثة بلا زر إلغاء
+        ok = await cancel_broadcast_job(data.replace("adm_bc_cancel_", ""))
+        return await show_broadcast_jobs(query, "⛔ تم إلغاء البث." if ok else "ℹ️ العملية منتهية بالفعل.")
+
     # عرض المستخدمين
     if data == "adm_list_users":
-        users = list(db.db.users.find({}).limit(MAX_LIST_DISPLAY))
+        users = await db.adb.users.find({}).limit(MAX_LIST_DISPLAY).to_list()
         if not users:
             await query.edit_message_text("⚠️ لا يوجد مستخدمين مسجلين.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🏠 رجوع", callback_data="adm_home")]]))
             return
@@ -456,8 +465,9 @@ async def setup(application):
     # Handlers للضغطات ضمن لوحة الإدارة
     application.add_handler(CallbackQueryHandler(manage_admin_callbacks, pattern="^adm_"))
 
-    # معالج للمدخلات النصية المتعلقة بالمشرف (يعمل بمجموعة عالية لالتقاطها قبل معالجات أخرى)
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, process_admin_text), group=3)
+    # المدخلات النصية للمشرف تصل عبر الموجه فقط عندما تكون إحدى الحالات الإدارية فعالة
+    for state in ADMIN_STATES:
+        register_state(state, process_admin_text)
 
     # أمر احتياطي لفتح لوحة الإدارة
     application.add_handler(CommandHandler("admin", show_admin_main))
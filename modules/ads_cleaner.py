@@ -2,6 +2,7 @@ import sys
 import os
 import asyncio
 import logging
+import datetime
 
 # --- [ حل مشكلة المسارات لضمان التعرف على db ] ---
 current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -10,13 +11,20 @@ if parent_dir not in sys.path:
     sys.path.append(parent_dir)
 
 from db import db
+from config import Config
+from ratelimit import use_lane, BULK
+from metrics import loop_cycle
+from leases import LeaderLease
 from telegram.error import BadRequest, Forbidden
 
 logger = logging.getLogger("AdsCleaner")
 
+CLEANER_CONCURRENCY = getattr(Config, "ADS_CLEANER_CONCURRENCY", 10)
+leader = LeaderLease("ads_cleaner")  # نسخة واحدة فقط تنظف
+
 async def setup(application):
-    """تشغيل المنظف كخدمة خلفية مستقلة"""
-    asyncio.create_task(run_ads_cleaner(application.bot))
+    """تشغيل المنظف كخدمة خلفية مستقلة (تبدأ مع application.start)"""
+    application.add_background("ads_cleaner", lambda: run_ads_cleaner(application.bot))
 
 async def delete_message_safe(bot, chat_id, message_id):
     """محاولة حذف الرسالة وتجاهل الأخطاء إذا كانت محذوفة بالفعل"""
@@ -29,35 +37,59 @@ async def delete_message_safe(bot, chat_id, message_id):
         logger.error(f"Error deleting msg {message_id} in {chat_id}: {e}")
         return False
 
+# نافذة التجميعة: القنوات التي نُشر فيها إعلان خلال آخر ADS_CLEANER_WINDOW ثانية (تغطي عدة دورات،
+# فما فشل حذفه يُعاد في الدورات التالية)؛ 0 = فحص كل السجل
+CLEANER_WINDOW = getattr(Config, "ADS_CLEANER_WINDOW", 3600)
+
+def stale_ads_pipeline(since=None):
+    """
+    تجميعة واحدة: القنوات التي وصلها إعلان منذ since (فهرس timestamp) مع كل إعلاناتها (فهرس to_channel_timestamp)،
+    وفقط التي فيها أكثر من إعلان مسجل
+    """
+    pipeline = [{"$match": {"timestamp": {"$gte": since}}}] if since is not None else []
+    return pipeline + [
+        {"$group": {"_id": "$to_channel"}},
+        {"$lookup": {"from": "ads_history", "localField": "_id", "foreignField": "to_channel", "as": "ads"}},
+        {"$match": {"ads.1": {"$exists": True}}},
+        {"$project": {"ads._id": 1, "ads.msg_id": 1, "ads.timestamp": 1}},
+    ]
+
+async def _drop_stale_ad(bot, sem, chat_id, record, lease=None):
+    """حذف إعلان قديم من القناة — تُعيد True إذا نجح الحذف (عندها فقط يُحذف سجله من القاعدة)"""
+    async with sem:
+        if lease is not None and not lease.held():
+            return False  # لم نعد القائد
+        return await delete_message_safe(bot, chat_id, record.get('msg_id'))
+
+async def clean_pass(bot, lease=None, window=CLEANER_WINDOW):
+    """دورة تنظيف واحدة: استعلام تجميعي واحد + حذف متوازٍ محدود المعدل + delete_many واحدة"""
+    since = datetime.datetime.utcnow() - datetime.timedelta(seconds=window) if window else None
+    groups = await db.adb.ads_history.aggregate(stale_ads_pipeline(since), allowDiskUse=True).to_list()
+    if not groups:
+        return 0
+    sem = asyncio.Semaphore(CLEANER_CONCURRENCY)
+    jobs = []
+    for g in groups:
+        ads = sorted(g['ads'], key=lambda a: a.get('timestamp') or datetime.datetime.min, reverse=True)
+        jobs.extend((g['_id'], record) for record in ads[1:])  # الإبقاء على الأحدث
+    results = await asyncio.gather(*[_drop_stale_ad(bot, sem, chat_id, record, lease) for chat_id, record in jobs])
+    ids = [record['_id'] for (_, record), ok in zip(jobs, results) if ok]
+    if ids:
+        res = await db.adb.ads_history.delete_many({"_id": {"$in": ids}})
+        await db.bump_stats(ads_posted=-res.deleted_count)
+        logger.info(f"🗑️ تم حذف {len(ids)} إعلان قديم مكرر من {len(groups)} قناة")
+    return len(ids)
+
 async def run_ads_cleaner(bot):
-    print("🧹 منظف الإعلانات الذكي بدأ العمل لتصفية القنوات...")
+    logger.info("🧹 منظف الإعلانات الذكي بدأ العمل لتصفية القنوات...")
+    use_lane(BULK)
     
     while True:
+        # أخذ/تجديد عقد القيادة قبل كل دورة (الاحتياطي ينتظر هنا)
+        await leader.wait()
         try:
-            # 1. جلب كافة القنوات المسجلة
-            all_channels = list(db.db.list_channels.find({}))
-            
-            for channel in all_channels:
-                chat_id = channel['channel_id']
-                
-                # جلب سجل الإعلانات المرتبطة بهذه القناة (التي استقبلتها)
-                # نريد الإبقاء على أحدث رسالة فقط وحذف الباقي
-                ads_in_channel = list(db.db.ads_history.find({"to_channel": chat_id}).sort("timestamp", -1))
-                
-                if len(ads_in_channel) > 1:
-                    # الإبقاء على الأول (الأحدث) وحذف الباقي
-                    to_delete = ads_in_channel[1:] 
-                    
-                    for record in to_delete:
-                        success = await delete_message_safe(bot, chat_id, record['msg_id'])
-                        if success:
-                            # إزالة السجل من قاعدة البيانات بعد الحذف من تلجرام
-                            db.db.ads_history.delete_one({"_id": record["_id"]})
-                            print(f"🗑️ تم حذف إعلان قديم مكرر في قناة: {channel.get('title')}")
-                
-                # فحص إضافي: هل البوت لا يزال مشرفاً؟ (لتجنب تعليق الحلقة)
-                await asyncio.sleep(1) 
-
+            with loop_cycle("ads_cleaner"):
+                await clean_pass(bot, leader)
         except Exception as e:
             logger.error(f"Cleaner Loop Error: {e}")
             
@@ -66,7 +98,9 @@ async def run_ads_cleaner(bot):
 
 async def force_clean_channel(bot, chat_id):
     """دالة يمكن استدعاؤها عند نشر إعلان جديد لضمان حذف ما قبله فوراً"""
-    old_ads = list(db.db.ads_history.find({"to_channel": chat_id}))
+    old_ads = await db.adb.ads_history.find({"to_channel": chat_id}).to_list()
     for ad in old_ads:
         await delete_message_safe(bot, chat_id, ad['msg_id'])
-        db.db.ads_history.delete_one({"_id": ad["_id"]})
+    if old_ads:
+        res = await db.adb.ads_history.delete_many({"_id": {"$in": [ad["_id"] for ad in old_ads]}})
+        await db.bump_stats(ads_posted=-res.deleted_count)
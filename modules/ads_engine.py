@@ -1,21 +1,39 @@
 import asyncio
 import logging
 import datetime
-import random
+import heapq
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.error import BadRequest, Forbidden, RetryAfter
+from telegram.error import BadRequest, Forbidden
 from db import db
+from config import Config
+from permissions import bot_is_admin_in
+from ratelimit import use_lane, BULK
+import notify
+from leases import LeaderLease, fenced
+from metrics import loop_cycle
 
 logger = logging.getLogger("AdsEngine")
 
+ROTATION_INTERVAL = getattr(Config, "ADS_ROTATION_INTERVAL", 21600)      # 6 ساعات بين تبديلين في نفس القناة
+ROTATION_CONCURRENCY = getattr(Config, "ADS_ROTATION_CONCURRENCY", 5)     # تبديلات متزامنة كحد أقصى
+ROTATION_RETRY = getattr(Config, "ADS_ROTATION_RETRY", 600)              # تأجيل القناة بعد تبديل فاشل
+SCHEDULER_REFRESH = 60                                                   # إعادة قراءة القنوات المفعلة
+RECENT_PAIR_WINDOW = getattr(Config, "ADS_RECENT_PAIR_WINDOW", 86400)   # تجنب تكرار نفس الزوج (مصدر، هدف) خلال يوم
+PAIR_LOOKAHEAD = 8                                                       # أقصى مصادر تُتخطى بحثاً عن زوج غير مكرر
+
+_in_flight = set()   # قنوات يجري تبديل إعلانها الآن
+_rotations = set()   # مهام التبديل الجارية (مراجع حتى تنتهي)
+_retry_at = {}       # channel_id -> موعد إعادة المحاولة بعد فشل
+leader = LeaderLease("ads_engine")  # نسخة واحدة فقط تنشر؛ البقية احتياطية خاملة
+
 async def setup(application):
     """تشغيل المحرك كخدمة خلفية"""
     # تسجيل معالج زر التجاهل ليعمل في كل مكان
     from telegram.ext import CallbackQueryHandler
     application.add_handler(CallbackQueryHandler(handle_ignore_button, pattern="^ignore_ad$"))
     
-    # بدء الدورة اللانهائية
-    asyncio.create_task(run_ads_engine(application))
+    # الدورة اللانهائية تبدأ مع application.start (مرجعها في application.background_tasks)
+    application.add_background("ads_engine", lambda: run_ads_engine(application))
 
 async def handle_ignore_button(update, context):
     """حل مشكلة زر التجاهل - يختفي الإعلان فوراً"""
@@ -26,58 +44,194 @@ async def handle_ignore_button(update, context):
     except:
         await query.answer("لا يمكن حذف الإعلان، ربما انتهت صلاحيته.")
 
+def _due_at(channel):
+    """موعد التبديل التالي للقناة = آخر تبديل + 6 ساعات (أو أي تأجيل بعد فشل)"""
+    last = channel.get('last_ad_update')
+    due = last + datetime.timedelta(seconds=ROTATION_INTERVAL) if last else datetime.datetime.min
+    retry = _retry_at.get(channel['channel_id'])
+    return max(due, retry) if retry else due
+
+# --- [ محرك المطابقة العادل ] ---
+def _source_priority(channel, exposures):
+    """
+    أولوية المصدر (الأصغر أولاً في heapq):
+    1) القنوات التي لم تبلغ هدفها (custom_target - achieved_members > 0) قبل غيرها
+    2) ثم الأكبر عجزاً: ما قدمته للشبكة (yield_score) ناقص ما عُرض لها (exposure_count + عروض هذه الدورة)
+    3) ثم الأبعد عن هدفها
+    """
+    remaining = max(0, int(channel.get('custom_target', 0) or 0) - int(channel.get('achieved_members', 0) or 0))
+    deficit = int(channel.get('yield_score', 0) or 0) - int(channel.get('exposure_count', 0) or 0) - exposures
+    return (0 if remaining > 0 else 1, -deficit, -remaining)
+
+def build_assignment(targets, sources, recent_pairs=frozenset(), lookahead=PAIR_LOOKAHEAD):
+    """
+    مطابقة كل قناة مستحقة (target) بمصدر واحد في O(N log N):
+    heap على أولوية المصادر، نسحب الأعلى الصالح (ليس الهدف نفسه ولا زوجاً تكرر مؤخراً)
+    ثم نعيده للـ heap بأولوية محدثة حتى لا يحتكر مصدر واحد الدورة.
+    """
+    exposures = {}
+    heap = [(_source_priority(c, 0), i, c) for i, c in enumerate(sources)]
+    heapq.heapify(heap)
+    pairs = []
+    for target in targets:
+        t_id = target['channel_id']
+        skipped = []
+        chosen = None
+        fallback = None
+        while heap and len(skipped) <= lookahead:
+            entry = heapq.heappop(heap)
+            s_id = entry[2]['channel_id']
+            if s_id != t_id and (s_id, t_id) not in recent_pairs:
+                chosen = entry
+                break
+            if s_id != t_id and fallback is None:
+                fallback = entry  # زوج مكرر مقبول فقط إن لم يوجد غيره
+            skipped.append(entry)
+        if chosen is None and fallback is not None:
+            skipped.remove(fallback)
+            chosen = fallback
+        for entry in skipped:
+            heapq.heappush(heap, entry)
+        if chosen is None:
+            continue
+        source = chosen[2]
+        s_id = source['channel_id']
+        exposures[s_id] = exposures.get(s_id, 0) + 1
+        heapq.heappush(heap, (_source_priority(source, exposures[s_id]), chosen[1], source))
+        pairs.append((source, target))
+    return pairs
+
+async def _recent_pairs(now):
+    """أزواج (مصدر، هدف) المجدولة خلال آخر RECENT_PAIR_WINDOW ثانية — استعلام واحد لكل دورة"""
+    since = now - datetime.timedelta(seconds=RECENT_PAIR_WINDOW)
+    docs = await db.adb.ads_schedule.find({"scheduled_at": {"$gte": since}}, {"source": 1, "target": 1}).to_list()
+    return {(d['source'], d['target']) for d in docs}
+
+async def _save_schedule(pairs, now, fence=None):
+    if not pairs:
+        return []
+    res = await db.adb.ads_schedule.insert_many([
+        {"source": s['channel_id'], "target": t['channel_id'], "scheduled_at": now, "status": "planned", "fence": fence}
+        for s, t in pairs
+    ])
+    return res.inserted_ids
+
+async def _claim_target(target_ch, token):
+    """حجز القناة الهدف برمز السياج قبل النشر؛ False = قائد أحدث تولاها"""
+    res = await db.adb.list_channels.update_one(fenced({"channel_id": target_ch['channel_id']}, token), {"$set": {"fence": token}})
+    return res.matched_count > 0
+
+async def _rotate_guarded(bot, sem, source_ch, target_ch, schedule_id=None, token=None):
+    status = "skipped"
+    try:
+        async with sem:
+            # فحص الصلاحيات قبل كل شيء
+            if not await check_permissions_silent(bot, target_ch):
+                return
+            # فقدنا القيادة أثناء الانتظار -> لا ننشر (القائد الجديد سيتولى القناة)
+            if not leader.held():
+                return
+            if token is not None and not await _claim_target(target_ch, token):
+                status = "fenced"
+                return
+            if await rotate_ad(bot, source_ch, target_ch, fence=token):
+                status = "posted"
+                _retry_at.pop(target_ch['channel_id'], None)
+            else:
+                status = "failed"
+                _retry_at[target_ch['channel_id']] = datetime.datetime.utcnow() + datetime.timedelta(seconds=ROTATION_RETRY)
+    finally:
+        _in_flight.discard(target_ch['channel_id'])
+        if schedule_id is not None:
+            try:
+                await db.adb.ads_schedule.update_one(fenced({"_id": schedule_id}, token), {"$set": {"status": status}})
+            except Exception:
+                pass
+
+def _spawn_rotation(coro):
+    """مهمة تبديل مع مرجع محفوظ حتى تنتهي؛ استثناؤها يُسجل بدل أن يضيع"""
+    task = asyncio.create_task(coro)
+    _rotations.add(task)
+    task.add_done_callback(_rotation_done)
+    return task
+
+def _rotation_done(task):
+    _rotations.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("rotation task failed", exc_info=task.exception())
+
+async def _cycle(bot, sem, token):
+    """دورة جدولة واحدة؛ تعيد مدة النوم حتى الدورة التالية"""
+    # 1. جلب القنوات المفعلة
+    active_channels = await db.adb.list_channels.find({"list_active": True}).to_list()
+
+    if len(active_channels) < 2:
+        # إذا كانت قناة واحدة فقط، لا ننشر لتجنب التكرار داخل نفس القناة
+        return SCHEDULER_REFRESH
+
+    # 2. طابور أولويات مرتب حسب موعد التبديل التالي لكل قناة
+    by_id = {c['channel_id']: c for c in active_channels}
+    heap = [(_due_at(c), c['channel_id']) for c in active_channels if c['channel_id'] not in _in_flight]
+    heapq.heapify(heap)
+
+    # 3. جمع القنوات المستحقة ثم مطابقتها مع المصادر دفعة واحدة (عدالة حسب العجز)
+    now = datetime.datetime.utcnow()
+    due_targets = []
+    while heap and heap[0][0] <= now:
+        _, ch_id = heapq.heappop(heap)
+        due_targets.append(by_id[ch_id])
+
+    # التحقق من رمز السياج في القاعدة قبل أي نشر (قائد متوقف مؤقتاً لا ينشر بعد أن يُستبدل)
+    if due_targets and await leader.still_current():
+        recent_pairs = await _recent_pairs(now)
+        pairs = build_assignment(due_targets, active_channels, recent_pairs)
+        schedule_ids = await _save_schedule(pairs, now, fence=token)
+
+        # 4. إطلاق التبديلات بالتوازي (المعدل يضبطه GovernorRateLimiter وليس sleep ثابت)
+        for (source_ch, target_ch), schedule_id in zip(pairs, schedule_ids):
+            _in_flight.add(target_ch['channel_id'])
+            _spawn_rotation(_rotate_guarded(bot, sem, source_ch, target_ch, schedule_id, token))
+
+    # 5. النوم حتى أقرب موعد (أو حتى إعادة قراءة القنوات لالتقاط الجديدة منها)
+    wait = SCHEDULER_REFRESH
+    if heap:
+        wait = min(wait, max(1.0, (heap[0][0] - now).total_seconds()))
+    return wait
+
 async def run_ads_engine(application):
     print("🚀 محرك التبادل الذكي قيد التشغيل (نظام الـ 6 ساعات)...")
+    bot = application.bot
+    use_lane(BULK)  # لا يزاحم ردود المستخدمين
+    sem = asyncio.Semaphore(ROTATION_CONCURRENCY)
     while True:
+        # 0. أخذ/تجديد عقد القيادة قبل كل دورة (الاحتياطي ينتظر هنا حتى يموت القائد)
+        token = await leader.wait()
         try:
-            # 1. جلب القنوات المفعلة
-            active_channels = list(db.db.list_channels.find({"list_active": True}))
-            
-            if len(active_channels) < 2:
-                # إذا كانت قناة واحدة فقط، لا ننشر لتجنب التكرار داخل نفس القناة
-                await asyncio.sleep(60)
-                continue
-
-            for target_ch in active_channels:
-                # فحص الصلاحيات قبل كل شيء
-                if not await check_permissions_silent(application.bot, target_ch):
-                    continue
-
-                # البحث عن إعلان مناسب للنشر في هذه القناة (ليس إعلانها نفسه)
-                # ويجب أن يكون مر 6 ساعات على آخر تبديل في هذه القناة
-                last_update = target_ch.get('last_ad_update')
-                if last_update:
-                    time_passed = datetime.datetime.utcnow() - last_update
-                    if time_passed.total_seconds() < 21600: # 6 ساعات
-                        continue
-
-                # اختيار قناة "مصدر" عشوائية ليست هي "الهدف"
-                source_candidates = [c for c in active_channels if c['channel_id'] != target_ch['channel_id']]
-                if not source_candidates: continue
-                source_ch = random.choice(source_candidates)
-
-                # تنفيذ عملية التبديل (حذف القديم ونشر الجديد)
-                await rotate_ad(application.bot, source_ch, target_ch)
-                
-                # انتظار قصير بين كل قناة وأخرى (10 دقائق تدريجياً) لتجنب حظر تلجرام
-                await asyncio.sleep(600) 
-
+            with loop_cycle("ads_engine"):
+                wait = await _cycle(bot, sem, token)
         except Exception as e:
             logger.error(f"Main Loop Error: {e}")
-            await asyncio.sleep(30)
+            wait = 30
+        await asyncio.sleep(wait)
 
-async def rotate_ad(bot, source, target):
-    """حذف الإعلان القديم ونشر الجديد مع تنبيهات"""
+async def rotate_ad(bot, source, target, fence=None):
+    """
+    حذف الإعلان القديم ونشر الجديد مع تنبيهات — تُعيد True عند النجاح.
+    fence: رمز سياج القائد؛ كل كتابة على ads_history/list_channels مشروطة به ويُتخلى عن النتيجة إن لم تطابق شيئاً.
+    """
+    stamp = {"fence": fence} if fence is not None else {}
     try:
         # 1. حذف أي إعلان سابق مسجل في هذه القناة (Target)
-        old_ad = db.db.ads_history.find_one({"to_channel": target['channel_id']})
+        old_ad = await db.adb.ads_history.find_one({"to_channel": target['channel_id']})
         if old_ad:
             try: await bot.delete_message(target['channel_id'], old_ad['msg_id'])
             except: pass
-            db.db.ads_history.delete_one({"_id": old_ad["_id"]})
+            res = await db.adb.ads_history.delete_one(fenced({"_id": old_ad["_id"]}, fence))
+            await db.bump_stats(ads_posted=-res.deleted_count)
 
         # 2. بناء الإعلان الجديد بالرابط المخفي
-        bot_user = (await bot.get_me()).username
+        try: bot_user = bot.username
+        except Exception: bot_user = (await bot.get_me()).username
         ad_text = (
             f"{source.get('ad_text', 'تابعوا هذه القناة المتميزة!')}\n\n"
             f"━━━━━━━━━━━━━━━\n"
@@ -86,41 +240,63 @@ async def rotate_ad(bot, source, target):
         kb = [[InlineKeyboardButton("✅ انضمام للقناة", url=f"https://t.me/{source['username'].replace('@','')}")],
               [InlineKeyboardButton("❌ تجاهل الإعلان", callback_data="ignore_ad")]]
 
-        # 3. النشر
+        # 3. النشر (المعدل العام ومعدل القناة و RetryAfter يتولاها GovernorRateLimiter)
         if source.get('ad_photo'):
             msg = await bot.send_photo(target['channel_id'], photo=source['ad_photo'], caption=ad_text, reply_markup=InlineKeyboardMarkup(kb), parse_mode="Markdown")
         else:
             msg = await bot.send_message(target['channel_id'], text=ad_text, reply_markup=InlineKeyboardMarkup(kb), parse_mode="Markdown")
 
-        # 4. تحديث الداتا
-        db.db.ads_history.insert_one({
+        # 4. تحديث الداتا (الهدف أولاً: إن سبقنا قائد أحدث نسحب الإعلان ولا نسجل شيئاً)
+        res = await db.adb.list_channels.update_one(
+            fenced({"channel_id": target['channel_id']}, fence),
+            {"$set": {"last_ad_update": datetime.datetime.utcnow(), **stamp}, "$inc": {"yield_score": 1}}
+        )
+        if not res.matched_count:
+            logger.warning(f"rotation into {target['channel_id']} fenced out (token {fence})")
+            try: await bot.delete_message(target['channel_id'], msg.message_id)
+            except: pass
+            return False
+        await db.adb.ads_history.insert_one({
             "msg_id": msg.message_id,
             "from_channel": source['channel_id'],
             "to_channel": target['channel_id'],
-            "timestamp": datetime.datetime.utcnow()
+            "timestamp": datetime.datetime.utcnow(),
+            **stamp
         })
-        db.db.list_channels.update_one({"channel_id": target['channel_id']}, {"$set": {"last_ad_update": datetime.datetime.utcnow()}})
+        await db.bump_stats(ads_posted=1)
+        await db.adb.list_channels.update_one(fenced({"channel_id": source['channel_id']}, fence), {"$inc": {"exposure_count": 1}})
         
-        # 5. إرسال تنبيهات للملاك
-        try:
-            await bot.send_message(source['owner_id'], f"✨ **بشارة!** تم نشر إعلان قناتك الآن في قناة: `{target['title']}`\nسيستمر العرض لمدة 6 ساعات ثم ينتقل لقناة أخرى.")
-            await bot.send_message(target['owner_id'], f"🔄 **تبادل:** تم تحديث الإعلان في قناتك `{target['title']}` بنجاح.")
-        except: pass
+        # 5. تنبيهات الملاك عبر الطابور المجمع (لا تؤخر دورة التبديل)
+        notify.push(bot, source.get('owner_id'), "ad_posted", source.get('title') or "", target.get('title'))
+        notify.push(bot, target.get('owner_id'), "ad_rotated", target.get('title') or "")
+        return True
 
     except Exception as e:
         logger.error(f"Rotation Error: {e}")
+        return False
+
+async def deactivate_list_channel(bot, channel_id, reason="bot_lost_admin"):
+    """إيقاف النشر للقناة وتنبيه المالك مرة واحدة فقط (الشرط list_active=True يمنع التكرار)"""
+    channel = await db.adb.list_channels.find_one_and_update(
+        {"channel_id": channel_id, "list_active": True},
+        {"$set": {"list_active": False, "deactivated_reason": reason, "deactivated_at": datetime.datetime.utcnow()}},
+        projection={"owner_id": 1, "title": 1}
+    )
+    if not channel:
+        return False
+    await db.bump_stats(list_active=-1)
+    try:
+        await bot.send_message(channel['owner_id'], f"🛑 **تنبيه:** توقف النشر لقناتك ({channel.get('title')}) لأنك قمت بإلغاء صلاحيات البوت أو طرده!")
+    except: pass
+    return True
 
 async def check_permissions_silent(bot, channel):
-    """فحص الصلاحيات بدون إزعاج متكرر"""
+    """فحص الصلاحيات بدون إزعاج متكرر (من الكاش المشترك الذي تحدّثه أحداث my_chat_member)"""
     try:
-        member = await bot.get_chat_member(channel['channel_id'], bot.id)
-        if member.status not in ['administrator', 'creator'] or not member.can_post_messages:
+        if not await bot_is_admin_in(bot, channel['channel_id'], need_post=True):
             raise Exception("No Perms")
         return True
     except:
         # إذا فشل، نعطل القناة وننبه مرة واحدة فقط
-        db.db.list_channels.update_one({"channel_id": channel['channel_id']}, {"$set": {"list_active": False}})
-        try:
-            await bot.send_message(channel['owner_id'], f"🛑 **تنبيه:** توقف النشر لقناتك ({channel['title']}) لأنك قمت بإلغاء صلاحيات البوت أو طرده!")
-        except: pass
+        await deactivate_list_channel(bot, channel['channel_id'])
         return False
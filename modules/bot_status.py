@@ -0,0 +1,43 @@
+# modules/bot_status.py
+# متابعة وضع البوت في القنوات/المجموعات عبر تحديثات my_chat_member
+# لا يحتوي على MAIN_BUTTON
+
+import os
+import sys
+import logging
+
+from telegram import Update
+from telegram.ext import ContextTypes, ChatMemberHandler
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from permissions import remember_bot_member, is_admin_member
+from modules.funding import deactivate_funding_channel
+from modules.ads_engine import deactivate_list_channel
+
+logger = logging.getLogger(__name__)
+
+async def on_my_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    تحديث كاش صلاحيات البوت فور رفعه/تنزيله/طرده من قناة،
+    وتعطيل التمويل (channels.active) والنشر (list_channels.list_active) مباشرة عند فقدان الصلاحيات.
+    """
+    change = update.my_chat_member
+    if not change:
+        return
+    chat_id = change.chat.id
+    member = change.new_chat_member
+    remember_bot_member(chat_id, member)
+    logger.info(f"bot status in {chat_id}: {change.old_chat_member.status} -> {member.status}")
+
+    # التمويل يحتاج صلاحية دعوة المستخدمين، ونظام اللستة يحتاج صلاحية النشر
+    try:
+        if not is_admin_member(member, need_invite=True):
+            await deactivate_funding_channel(context.bot, chat_id, "bot_lost_admin")
+        if not is_admin_member(member, need_post=True):
+            await deactivate_list_channel(context.bot, chat_id, "bot_lost_admin")
+    except Exception:
+        logger.exception("on_my_chat_member deactivate")
+
+async def setup(application):
+    application.add_handler(ChatMemberHandler(on_my_chat_member, ChatMemberHandler.MY_CHAT_MEMBER))
+    logger.info("bot_status module loaded (no MAIN_BUTTON)")
@@ -0,0 +1,239 @@
+# modules/broadcast.py
+# محرك البث الجماعي للمشرف: مهام خلفية محفوظة في MongoDB (broadcast_jobs) قابلة للاستئناف بعد إعادة التشغيل
+# لا يحتوي على MAIN_BUTTON — تُستدعى start_job / cancel_job من admin
+
+import os
+import sys
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Any, Optional
+
+from bson import ObjectId
+from pymongo import ReturnDocument
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.constants import ParseMode
+from telegram.error import RetryAfter, Forbidden, BadRequest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from db import db
+from config import Config
+from ratelimit import use_lane, BULK
+from leases import OWNER_ID
+
+logger = logging.getLogger(__name__)
+
+# ---------------- إعدادات ----------------
+BROADCAST_CONCURRENCY = getattr(Config, "BROADCAST_CONCURRENCY", 20)  # أقصى إرسالات متزامنة
+BROADCAST_BATCH = getattr(Config, "BROADCAST_BATCH", 100)              # حجم الدفعة بين كل حفظ للتقدم
+BROADCAST_MAX_RETRIES = 3
+PROGRESS_EVERY = 5  # ثوانٍ بين تحديثات رسالة التقدم
+# كل مهمة تملكها عملية واحدة (owner)؛ المهمة التي لم تتقدم منذ BROADCAST_STALE_AFTER تُعتبر يتيمة وتستأنفها أي عملية
+BROADCAST_STALE_AFTER = getattr(Config, "BROADCAST_STALE_AFTER", 120)
+BROADCAST_RESUME_EVERY = 60
+# نبض المالك: تجديد updated_at أثناء التنفيذ حتى لا تبدو الدفعة البطيئة (انتظار RetryAfter) يتيمة
+BROADCAST_HEARTBEAT = max(1, BROADCAST_STALE_AFTER // 4)
+
+# مصدر المستلمين لكل نوع مهمة: (المجموعة، الفلتر، حقل المعرف)
+TARGETS = {
+    "users": ("users", {}, "user_id"),
+    "channels": ("channels", {"active": True}, "channel_id"),
+}
+
+_running: Dict[str, asyncio.Task] = {}
+
+# ---------------- الإرسال ----------------
+async def _send_one(bot, chat_id, text) -> bool:
+    """إرسال رسالة واحدة؛ الحدود وانتظار RetryAfter يتولاها GovernorRateLimiter، وهنا إعادة إضافية للبث فقط"""
+    for _ in range(BROADCAST_MAX_RETRIES):
+        try:
+            await bot.send_message(chat_id, text, parse_mode=ParseMode.HTML)
+            return True
+        except RetryAfter:
+            continue  # المنظم أوقف الدلو العام بالفعل؛ المحاولة التالية تنتظر انتهاء الإيقاف
+        except (Forbidden, BadRequest):
+            return False  # المستخدم حظر البوت / المحادثة غير موجودة
+        except Exception as e:
+            logger.debug(f"broadcast send to {chat_id} failed: {e}")
+            return False
+    return False
+
+def progress_text(job: Dict[str, Any]) -> str:
+    status_names = {"running": "⏳ جارٍ", "done": "✅ اكتمل", "cancelled": "⛔ أُلغي"}
+    target = "المستخدمين" if job.get("target") == "users" else "القنوات"
+    return (
+        f"<b>📡 بث إلى {target}</b> — {status_names.get(job.get('status'), job.get('status'))}\n\n"
+        f"نجح: <b>{job.get('sent', 0)}</b> — فشل: <b>{job.get('failed', 0)}</b> — من أصل: <b>{job.get('total', 0)}</b>"
+    )
+
+def progress_markup(job: Dict[str, Any]) -> Optional[InlineKeyboardMarkup]:
+    if job.get("status") != "running":
+        return None
+    return InlineKeyboardMarkup([[InlineKeyboardButton("⛔ إلغاء البث", callback_data=f"adm_bc_cancel_{job['_id']}")]])
+
+async def _update_progress_message(bot, job: Dict[str, Any]):
+    if not job.get("status_chat_id") or not job.get("status_message_id"):
+        return
+    try:
+        await bot.edit_message_text(progress_text(job), chat_id=job["status_chat_id"], message_id=job["status_message_id"], parse_mode=ParseMode.HTML, reply_markup=progress_markup(job))
+    except BadRequest:
+        pass  # الرسالة لم تتغير
+    except Exception as e:
+        logger.debug(f"broadcast progress edit failed: {e}")
+
+# ---------------- تنفيذ المهمة ----------------
+async def _heartbeat(job_id: ObjectId, lost: asyncio.Event):
+    """تجديد updated_at ما دامت المهمة لنا؛ فقدان الملكية (أو الإلغاء) يضبط lost فتتوقف الإرسالات"""
+    while not lost.is_set():
+        await asyncio.sleep(BROADCAST_HEARTBEAT)
+        try:
+            res = await db.adb.broadcast_jobs.update_one(
+                {"_id": job_id, "status": "running", "owner": OWNER_ID},
+                {"$set": {"updated_at": datetime.utcnow()}}
+            )
+        except Exception as e:
+            logger.debug(f"broadcast heartbeat failed: {e}")
+            continue
+        if not res.matched_count:
+            lost.set()
+
+async def _claim_job(job_id: ObjectId):
+    """حجز المهمة لهذه العملية (إن كانت لنا أو يتيمة) — يمنع تنفيذها مرتين مع تعدد العمليات"""
+    now = datetime.utcnow()
+    return await db.adb.broadcast_jobs.find_one_and_update(
+        {"_id": job_id, "status": "running", "$or": [
+            {"owner": OWNER_ID},
+            {"updated_at": {"$lt": now - timedelta(seconds=BROADCAST_STALE_AFTER)}},
+        ]},
+        {"$set": {"owner": OWNER_ID, "updated_at": now}},
+        return_document=ReturnDocument.AFTER
+    )
+
+async def _run_job(bot, job_id: ObjectId):
+    use_lane(BULK)
+    job = await _claim_job(job_id)
+    if not job:
+        return  # منتهية أو تنفذها عملية أخرى
+    coll_name, flt, id_field = TARGETS[job["target"]]
+    coll = db.adb[coll_name]
+    sem = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    lost = asyncio.Event()
+    heartbeat = asyncio.create_task(_heartbeat(job_id, lost))
+
+    async def _guarded(chat_id):
+        async with sem:
+            if lost.is_set():
+                return None  # لم تعد المهمة لنا: لا نرسل (المالك الجديد يستأنف من last_id)
+            return await _send_one(bot, chat_id, job["text"])
+
+    try:
+        await _send_batches(bot, job_id, job, coll, flt, id_field, _guarded)
+    finally:
+        lost.set()
+        heartbeat.cancel()
+
+async def _send_batches(bot, job_id, job, coll, flt, id_field, _guarded):
+    """الدفعات بالترتيب؛ حفظ التقدم مشروط بـ owner (عملية استولت على المهمة لا تُكتب فوقها)"""
+    last_progress = 0.0
+    while True:
+        # الاستئناف من آخر _id محفوظ — الدفعة غير المحفوظة فقط قد تتكرر بعد انقطاع
+        query = dict(flt)
+        if job.get("last_id") is not None:
+            query["_id"] = {"$gt": job["last_id"]}
+        batch = await coll.find(query, {id_field: 1}).sort("_id", 1).limit(BROADCAST_BATCH).to_list()
+        if not batch:
+            break
+        results = await asyncio.gather(*[_guarded(doc.get(id_field)) for doc in batch if doc.get(id_field)])
+        sent = sum(1 for r in results if r is True)
+        failed = sum(1 for r in results if r is False)
+        job = await db.adb.broadcast_jobs.find_one_and_update(
+            {"_id": job_id, "owner": OWNER_ID},
+            {"$set": {"last_id": batch[-1]["_id"], "updated_at": datetime.utcnow()}, "$inc": {"sent": sent, "failed": failed}},
+            return_document=ReturnDocument.AFTER
+        )
+        if not job or job.get("status") != "running":
+            break  # أُلغيت المهمة أو انتقلت ملكيتها لعملية أخرى
+        if time.monotonic() - last_progress >= PROGRESS_EVERY:
+            last_progress = time.monotonic()
+            await _update_progress_message(bot, job)
+
+    if job and job.get("status") == "running":
+        job = await db.adb.broadcast_jobs.find_one_and_update(
+            {"_id": job_id, "status": "running", "owner": OWNER_ID},
+            {"$set": {"status": "done", "finished_at": datetime.utcnow()}},
+            return_document=ReturnDocument.AFTER
+        ) or job
+    if job:
+        await _update_progress_message(bot, job)
+    logger.info(f"broadcast job {job_id} finished")
+
+def _spawn(application, job_id: ObjectId):
+    key = str(job_id)
+    if key in _running and not _running[key].done():
+        return
+    task = application.create_task(_run_job(application.bot, job_id))
+    _running[key] = task
+    task.add_done_callback(lambda _t: _running.pop(key, None))
+
+# ---------------- الواجهة العامة ----------------
+async def start_job(application, target: str, text: str, admin_chat_id: int) -> ObjectId:
+    """إنشاء مهمة بث جديدة وإرسال رسالة تقدم حية للمشرف"""
+    coll_name, flt, _ = TARGETS[target]
+    total = await db.adb[coll_name].count_documents(flt)
+    job = {
+        "target": target,
+        "text": text,
+        "status": "running",
+        "total": total,
+        "sent": 0,
+        "failed": 0,
+        "last_id": None,
+        "owner": OWNER_ID,
+        "created_by": admin_chat_id,
+        "created_at": datetime.utcnow(),
+        "updated_at": datetime.utcnow(),
+    }
+    res = await db.adb.broadcast_jobs.insert_one(job)
+    job["_id"] = res.inserted_id
+    try:
+        msg = await application.bot.send_message(admin_chat_id, progress_text(job), parse_mode=ParseMode.HTML, reply_markup=progress_markup(job))
+        await db.adb.broadcast_jobs.update_one({"_id": job["_id"]}, {"$set": {"status_chat_id": msg.chat_id, "status_message_id": msg.message_id}})
+    except Exception:
+        logger.debug("broadcast progress message failed")
+    _spawn(application, job["_id"])
+    return job["_id"]
+
+async def cancel_job(job_id: str) -> bool:
+    try:
+        oid = ObjectId(job_id)
+    except Exception:
+        return False
+    res = await db.adb.broadcast_jobs.update_one({"_id": oid, "status": "running"}, {"$set": {"status": "cancelled", "finished_at": datetime.utcnow()}})
+    return bool(res.modified_count)
+
+async def list_jobs(limit: int = 5):
+    return await db.adb.broadcast_jobs.find({}).sort("created_at", -1).limit(limit).to_list()
+
+async def resume_jobs(application):
+    """استئناف مهام البث الخاصة بهذه العملية أو اليتيمة (إعادة تشغيل / عملية متوقفة) بشكل دوري"""
+    use_lane(BULK)
+    await asyncio.sleep(5)
+    while True:
+        stale = datetime.utcnow() - timedelta(seconds=BROADCAST_STALE_AFTER)
+        try:
+            jobs = await db.adb.broadcast_jobs.find(
+                {"status": "running", "$or": [{"owner": OWNER_ID}, {"updated_at": {"$lt": stale}}]}, {"_id": 1}
+            ).to_list()
+        except Exception:
+            logger.exception("resume broadcast jobs")
+            jobs = []
+        for job in jobs:
+            if str(job["_id"]) not in _running:
+                logger.info(f"resuming broadcast job {job['_id']}")
+                _spawn(application, job["_id"])
+        await asyncio.sleep(BROADCAST_RESUME_EVERY)
+
+async def setup(application):
+    application.add_background("broadcast_resume", lambda: resume_jobs(application))
+    logger.info("broadcast module loaded (no MAIN_BUTTON)")
@@ -2,10 +2,11 @@
 # Checker (اشتراك إجباري محسن)
 # لا يحتوي على MAIN_BUTTON (لن يغرز زر في main تلقائياً)
 # استدعِ check_subscription(update, context) من main.start
-# متوافق مع python-telegram-bot v20+ و MongoDB (db.db)
+# متوافق مع python-telegram-bot v20+ و MongoDB (db.adb)
 
 import os
 import sys
+import asyncio
 import logging
 from datetime import datetime
 from typing import List, Dict, Optional, Any
@@ -16,8 +17,13 @@ from telegram.ext import ContextTypes, CallbackQueryHandler, CommandHandler
 
 # path fix: main, db, config موجودة بجانب modules/
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from db import db
+from db import db, STATS_PROJECTION
 from config import Config
+from cache import TTLCache
+from permissions import bot_is_admin_in
+import credits
+import points as ledger
+import notify
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
@@ -36,6 +42,8 @@ if OFFICIAL_CHANNEL_RAW:
 FORCE_LIMIT = getattr(Config, "FORCE_SUB_LIMIT", 10)   # نعرض حتى 10 قنوات في الاشتراك الإجباري
 REQUIRED_COUNT = getattr(Config, "REQUIRED_COUNT", FORCE_LIMIT) # مطلوب اشتراك (عادة 10)
 SUB_COST = getattr(Config, "SUB_COST", 15)            # يُخصم من صاحب القناة عند انضمام مستخدم
+FORCE_PROBE_CONCURRENCY = getattr(Config, "FORCE_PROBE_CONCURRENCY", 10)  # أقصى فحوصات Telegram متزامنة لكل مستخدم
+FORCE_PROBE_DEADLINE = getattr(Config, "FORCE_PROBE_DEADLINE", 6.0)       # مهلة بناء القائمة (ثوانٍ)
 
 # مكافآت الإحالة — عند إتمام إحالة كاملة
 REF_BONUS_MEMBERS = getattr(Config, "REF_BONUS_MEMBERS", 20)  # كم عضو يعادل كل إحالة
@@ -43,6 +51,11 @@ REF_BONUS_POINTS = getattr(Config, "REF_BONUS_POINTS", 300)   # نقاط تُع
 
 VALID_STATUSES = ("member", "administrator", "creator", "restricted")
 
+# كاش حالة التفعيل (force_sub_done) أمام بوابة الاشتراك التي تُستدعى مع كل ضغطة زر
+SUB_CACHE_SIZE = getattr(Config, "SUB_CACHE_SIZE", 10000)
+SUB_CACHE_TTL = getattr(Config, "SUB_CACHE_TTL", 600)
+activation_cache = TTLCache("force_sub", maxsize=SUB_CACHE_SIZE, ttl=SUB_CACHE_TTL)
+
 # ---------------- تلغرام آمن helpers ----------------
 async def _safe_get_chat(bot, identifier: Any):
     try:
@@ -64,21 +77,10 @@ async def _safe_get_chat_member(bot, chat_id: Any, user_id: int):
 async def bot_has_admin_permissions(bot, chat_identifier: Any) -> bool:
     """
     تحقق مرن لصلاحيات البوت في القناة/المجموعة (يقبل غياب بعض الأعلام).
+    النتيجة من الكاش المشترك في permissions لتجنب get_chat_member متكرر لكل مستخدم.
     """
     try:
-        me = await bot.get_me()
-        m = await _safe_get_chat_member(bot, chat_identifier, me.id)
-        if not m:
-            return False
-        status = getattr(m, "status", None)
-        if status not in ("administrator", "creator"):
-            return False
-        # تحقق فقط إذا كانت الخاصيات موجودة
-        if hasattr(m, "can_post_messages") and not getattr(m, "can_post_messages", True):
-            return False
-        if hasattr(m, "can_invite_users") and not getattr(m, "can_invite_users", True):
-            return False
-        return True
+        return await bot_is_admin_in(bot, chat_identifier, need_post=True, need_invite=True)
     except Exception as e:
         logger.debug(f"bot_has_admin_permissions error: {e}")
         return False
@@ -92,40 +94,78 @@ def normalize_username(raw: Optional[str]) -> Optional[str]:
     return s or None
 
 # ---------------- DB helpers ----------------
-def get_force_channels_from_db(limit: int = FORCE_LIMIT) -> List[Dict]:
+async def get_force_channels_from_db(limit: int = FORCE_LIMIT) -> List[Dict]:
     try:
-        return list(db.db.channels.find({"force_sub": True, "active": True}).limit(limit))
+        return await db.adb.channels.find({"force_sub": True, "active": True}).limit(limit).to_list()
     except Exception:
         logger.exception("get_force_channels_from_db")
         return []
 
-def mark_channel_deactivated(channel_id: Any, reason: str = "bot_lost_admin"):
+async def mark_channel_deactivated(channel_id: Any, reason: str = "bot_lost_admin"):
     try:
-        db.db.channels.update_one({"channel_id": channel_id}, {"$set": {"active": False, "deactivated_reason": reason, "deactivated_at": datetime.utcnow()}})
+        before = await db.adb.channels.find_one_and_update({"channel_id": channel_id}, {"$set": {"active": False, "deactivated_reason": reason, "deactivated_at": datetime.utcnow()}}, projection=STATS_PROJECTION)
+        if before:
+            await db.track_stats("channels", before, {**before, "active": False})
     except Exception:
         logger.exception("mark_channel_deactivated")
 
-def get_active_funding_channels(limit: int = 5) -> List[Dict]:
+async def get_active_funding_channels(limit: int = 5) -> List[Dict]:
     try:
-        return list(db.db.channels.find({"active": True}).sort("created_at", -1).limit(limit))
+        return await db.adb.channels.find({"active": True}).sort("created_at", -1).limit(limit).to_list()
     except Exception:
         return []
 
 # ---------------- بناء قائمة الاشتراك للمستخدم ----------------
+async def _probe_force_channel(bot, ch: Dict, user_id: int, sem: asyncio.Semaphore) -> Optional[Dict]:
+    """
+    فحص قناة واحدة: صلاحيات البوت وعضوية المستخدم بالتوازي.
+    تُعيد عنصر الطابور أو None إذا يجب استبعاد القناة.
+    """
+    ch_id = ch.get("channel_id")
+    async with sem:
+        # تحقق صلاحيات البوت إذا كان ID رقمي (مجموعات/قنوات خاصة)
+        admin_check = bot_has_admin_permissions(bot, ch_id) if isinstance(ch_id, int) else asyncio.sleep(0, result=True)
+        ok, member = await asyncio.gather(admin_check, _safe_get_chat_member(bot, ch_id, user_id), return_exceptions=True)
+    if ok is False:
+        await mark_channel_deactivated(ch_id, "bot_lost_admin")
+        return None
+    if isinstance(ok, BaseException):
+        logger.debug("bot admin check error; continuing")
+
+    # تحقق إن المستخدم مشترك حالياً => لا نعرض القناة
+    # إذا status == 'left' أو 'kicked' -> نعرض (المستخدم غادر مسبقاً)
+    # إذا member is None -> نعرض (يعني نحتاج فحص/قدّم طلب انضمام)
+    if member and not isinstance(member, BaseException):
+        if getattr(member, "status", None) in VALID_STATUSES:
+            return None
+
+    return {
+        "title": ch.get("title") or ch.get("username") or str(ch_id),
+        "username": ch.get("username"),
+        "channel_id": ch_id,
+        "owner_id": ch.get("owner_id")
+    }
+
 async def build_force_queue_for_user(bot, user_id: int) -> List[Dict]:
     """
     - تضم القناة الرسمية أولاً إن وُجدت.
-    - تجلب قنوات force_sub من DB وتستبعد:
+    - تجلب قنوات force_sub من DB وتفحصها بالتوازي (حتى FORCE_PROBE_CONCURRENCY معاً) وتستبعد:
         * القنوات التي فقد فيها البوت صلاحياته (وَتُعلّم inactive)
         * القنوات التي المستخدم مشترك فيها (status in VALID_STATUSES) -> لا نعرضها
-    - تُعيد حتى FORCE_LIMIT عناصر.
+    - تتوقف فور جمع FORCE_LIMIT قناة أو عند انتهاء FORCE_PROBE_DEADLINE ثانية.
+    - تُعيد حتى FORCE_LIMIT عناصر بنفس ترتيب DB.
     """
     queue: List[Dict] = []
 
-    # 1) official channel (نضيفها أولاً إن وُجدت)
-    if OFFICIAL_CHANNEL:
+    # 1) official channel (نطلبها بالتوازي مع قراءة DB ونضيفها أولاً إن وُجدت)
+    official_task = asyncio.ensure_future(_safe_get_chat(bot, f"@{OFFICIAL_CHANNEL}")) if OFFICIAL_CHANNEL else None
+
+    # 2) قنوات من DB
+    force_chs = await get_force_channels_from_db(limit=FORCE_LIMIT * 2)
+
+    if official_task:
         try:
-            chat = await _safe_get_chat(bot, f"@{OFFICIAL_CHANNEL}")
+            chat = await official_task
             if chat:
                 queue.append({
                     "title": getattr(chat, "title", "القناة الرسمية"),
@@ -136,39 +176,33 @@ async def build_force_queue_for_user(bot, user_id: int) -> List[Dict]:
         except Exception:
             logger.debug("official channel not reachable (skipped)")
 
-    # 2) قنوات من DB
-    force_chs = get_force_channels_from_db(limit=FORCE_LIMIT * 2)
-    for ch in force_chs:
-        ch_id = ch.get("channel_id")
-        # تحقق صلاحيات البوت إذا كان ID رقمي (مجموعات/قنوات خاصة)
-        try:
-            if isinstance(ch_id, int):
-                ok = await bot_has_admin_permissions(bot, ch_id)
-                if not ok:
-                    mark_channel_deactivated(ch_id, "bot_lost_admin")
+    wanted = FORCE_LIMIT - len(queue)
+    sem = asyncio.Semaphore(FORCE_PROBE_CONCURRENCY)
+    tasks = {asyncio.ensure_future(_probe_force_channel(bot, ch, user_id, sem)): idx for idx, ch in enumerate(force_chs)}
+    found: Dict[int, Dict] = {}
+    pending = set(tasks)
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + FORCE_PROBE_DEADLINE
+    try:
+        while pending and len(found) < wanted:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                logger.debug(f"force queue probe deadline reached ({len(pending)} channels skipped)")
+                break
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                try:
+                    item = task.result()
+                except Exception:
+                    logger.debug("force channel probe failed")
                     continue
-        except Exception:
-            logger.debug("bot admin check error; continuing")
-
-        # تحقق إن المستخدم مشترك حالياً => لا نعرض القناة
-        try:
-            member = await _safe_get_chat_member(bot, ch_id, user_id)
-            status = getattr(member, "status", None) if member else None
-            if status in VALID_STATUSES:
-                continue  # المستخدم مشترك حالياً -> لا نعرضها
-            # إذا status == 'left' أو 'kicked' -> نعرض (المستخدم غادر مسبقاً)
-            # إذا member is None -> نعرض (يعني نحتاج فحص/قدّم طلب انضمام)
-        except Exception:
-            pass
+                if item:
+                    found[tasks[task]] = item
+    finally:
+        for task in pending:
+            task.cancel()
 
-        queue.append({
-            "title": ch.get("title") or ch.get("username") or str(ch_id),
-            "username": ch.get("username"),
-            "channel_id": ch_id,
-            "owner_id": ch.get("owner_id")
-        })
-        if len(queue) >= FORCE_LIMIT:
-            break
+    queue.extend(found[idx] for idx in sorted(found))
 
     # dedupe & limit
     seen = set()
@@ -258,8 +292,12 @@ async def check_subscription(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if not user:
         return False
 
-    user_doc = db.db.users.find_one({"user_id": user.id}) or {}
-    if user_doc.get("force_sub_done"):
+    done = activation_cache.get(user.id)
+    if done is None:
+        user_doc = await db.adb.users.find_one({"user_id": user.id}, {"force_sub_done": 1}) or {}
+        done = bool(user_doc.get("force_sub_done"))
+        activation_cache.set(user.id, done)
+    if done:
         return True
 
     # لم يُفعّل بعد -> أعرض له واجهة الاشتراك
@@ -303,7 +341,7 @@ async def verify_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if isinstance(chat_id_real, int):
             ok = await bot_has_admin_permissions(bot, chat_id_real)
             if not ok:
-                mark_channel_deactivated(chat_id_real, "bot_lost_admin")
+                await mark_channel_deactivated(chat_id_real, "bot_lost_admin")
                 # اسحب هذه القناة من القائمة وتابع التالي
                 queue.pop(0)
                 context.user_data['force_queue'] = queue
@@ -340,22 +378,21 @@ async def verify_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         try:
             ch_doc = None
             if isinstance(chat_id_real, int):
-                ch_doc = db.db.channels.find_one({"channel_id": chat_id_real})
+                ch_doc = await db.adb.channels.find_one({"channel_id": chat_id_real})
             else:
                 uname = normalize_username(current.get("username") or chat_identifier)
                 if uname:
-                    ch_doc = db.db.channels.find_one({"username": "@" + uname}) or db.db.channels.find_one({"username": uname})
-            if ch_doc:
-                owner = ch_doc.get("owner_id")
+                    ch_doc = await db.adb.channels.find_one({"username": "@" + uname}) or await db.adb.channels.find_one({"username": uname})
+            owner = ch_doc.get("owner_id") if ch_doc else None
+            # احتساب غير مكرر: الضغطات المتكررة على "تحقق" لا تخصم ولا تزيد العدادات ولا تُبلغ مجدداً
+            if ch_doc and await credits.record_credit(user.id, ch_doc.get("channel_id"), owner, source="force_sub"):
                 if owner:
-                    db.db.users.update_one({"user_id": owner}, {"$inc": {"points": -SUB_COST}}, upsert=True)
-                db.db.channels.update_one({"channel_id": ch_doc.get("channel_id")}, {"$inc": {"achieved_members": 1, "member_count": 1}}, upsert=False)
-                # notify owner (one-line)
-                try:
-                    display = user.first_name or f"user:{user.id}"
-                    await bot.send_message(owner, f"🔔 انضم مستخدم جديد إلى قناتك: {display}")
-                except Exception:
-                    logger.debug("notify owner failed")
+                    await ledger.credit(owner, -SUB_COST, "force_sub_charge", ref=ch_doc.get("channel_id"))
+                res = await db.adb.channels.update_one({"channel_id": ch_doc.get("channel_id")}, {"$inc": {"achieved_members": 1, "member_count": 1}}, upsert=False)
+                if res.modified_count:
+                    await db.bump_stats(channels_members=1)
+                # notify owner (عبر طابور التنبيهات المجمعة — لا ننتظر الإرسال)
+                notify.push(bot, owner, "join", ch_doc.get("title") or ch_doc.get("username") or "", user.first_name or f"user:{user.id}")
                 # notify joining user
                 try:
                     await bot.send_message(user.id, f"✅ تم انضمامك إلى {ch_doc.get('title') or ch_doc.get('username')}")
@@ -388,23 +425,24 @@ async def verify_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         else:
             # اكتمال القائمة
             try:
-                db.db.users.update_one({"user_id": user.id}, {"$set": {"force_sub_done": True, "force_sub_at": datetime.utcnow()}}, upsert=True)
+                res = await db.adb.users.update_one({"user_id": user.id}, {"$set": {"force_sub_done": True, "force_sub_at": datetime.utcnow()}}, upsert=True)
+                if res.upserted_id is not None:
+                    await db.bump_stats(users=1)
+                activation_cache.invalidate(user.id)
             except Exception:
                 logger.exception("mark force_sub_done failed")
             # احساب الإحالة الآن
             ref = context.user_data.pop("referrer", None)
             if ref:
                 try:
-                    db.db.users.update_one({"user_id": ref}, {"$inc": {"referrals_count": 1, "points": REF_BONUS_POINTS, "total_received_members": REF_BONUS_MEMBERS}}, upsert=True)
-                    try:
-                        await bot.send_message(ref, f"🎉 تم احتساب إحالتك! لقد كُسبت {REF_BONUS_POINTS} نقطة و {REF_BONUS_MEMBERS} عضوًا افتراضيًا كمكافأة.")
-                    except Exception:
-                        pass
+                    await ledger.credit(ref, REF_BONUS_POINTS, "referral_bonus", ref=user.id,
+                                        inc={"referrals_count": 1, "total_received_members": REF_BONUS_MEMBERS})
+                    notify.push(bot, ref, "referral", detail=REF_BONUS_MEMBERS, value=REF_BONUS_POINTS)
                 except Exception:
                     logger.exception("process referral error")
 
             # رسالة النجاح النهائية مع عرض قنوات التمويل النشطة
-            active_channels = get_active_funding_channels(limit=5)
+            active_channels = await get_active_funding_channels(limit=5)
             kb = []
             if BOT_USERNAME:
                 kb.append([InlineKeyboardButton("/start", url=f"https://t.me/{BOT_USERNAME}?start={user.id}")])
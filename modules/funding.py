@@ -1,6 +1,6 @@
 # modules/funding.py
 # تم تحديث شامل — نظام تمويل متكامل، حيوي، ونقاط قابلة للصرف على الظهور في قوائم التجميع.
-# متوافق مع python-telegram-bot v20+ و MongoDB (db.db)
+# متوافق مع python-telegram-bot v20+ و MongoDB (db.adb)
 
 import os
 import sys
@@ -8,16 +8,25 @@ import logging
 import asyncio
 from datetime import datetime, timedelta
 from typing import List, Dict, Any, Optional, Tuple
+from pymongo import UpdateOne
 from urllib.parse import quote_plus
 
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.constants import ParseMode
-from telegram.ext import ContextTypes, CallbackQueryHandler, MessageHandler, filters
+from telegram.ext import ContextTypes, CallbackQueryHandler
 
 # ربط المسار لتمكين استيراد db و config
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from db import db
+from db import db, STATS_PROJECTION
 from config import Config
+from permissions import bot_is_admin_in, remember_bot_member, invalidate_bot_member
+from router import register_state, set_state, clear_state
+from leases import LeaderLease
+from ratelimit import use_lane, BULK
+from metrics import loop_cycle
+import points as ledger
+import credits
+import notify
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
@@ -34,7 +43,8 @@ REFERRAL_BONUS_PER = getattr(Config, "REFERRAL_BONUS_PER", 20)# معلومة ل
 
 MAX_POINTS_CHANNELS = getattr(Config, "MAX_POINTS_CHANNELS", 8)
 POOL_WAIT_MINUTES = getattr(Config, "POOL_WAIT_MINUTES", 15)  # إذا لا توجد قنوات: اطلب المحاولة بعد هذا الوقت
-MONITOR_INTERVAL = getattr(Config, "FUND_MONITOR_INTERVAL", 300)
+# فقدان الصلاحيات يُكتشف فوراً عبر my_chat_member (modules/bot_status) — هذا الفحص الدوري مجرد مطابقة احتياطية بطيئة
+MONITOR_INTERVAL = getattr(Config, "FUND_MONITOR_INTERVAL", 3600)
 
 VALID_MEMBER_STATUSES = ("member", "administrator", "creator", "restricted")
 
@@ -62,35 +72,30 @@ async def _safe_send(bot, chat_id, text, **kwargs):
 
 # ------------------ صلاحية البوت ------------------
 async def bot_is_admin(bot, chat_identifier) -> bool:
+    # من الكاش المشترك (permissions) — إن وُجدت خاصية can_invite_users نتحقق منها
     try:
-        me = await bot.get_me()
-        m = await _safe_get_chat_member(bot, chat_identifier, me.id)
-        if m and getattr(m, "status", None) in ("administrator", "creator"):
-            # إن وُجدت خاصية can_invite_users نتحقق منها
-            if hasattr(m, "can_invite_users"):
-                return bool(getattr(m, "can_invite_users", True))
-            return True
+        return await bot_is_admin_in(bot, chat_identifier, need_invite=True)
     except Exception as e:
         logger.debug(f"bot_is_admin error for {chat_identifier}: {e}")
     return False
 
 # ------------------ DB helpers ------------------
-def get_active_funding_channels(limit: int = 100) -> List[Dict[str, Any]]:
+async def get_active_funding_channels(limit: int = 100) -> List[Dict[str, Any]]:
     try:
-        return list(db.db.channels.find({"active": True}).sort("created_at", -1).limit(limit))
+        return await db.adb.channels.find({"active": True}).sort("created_at", -1).limit(limit).to_list()
     except Exception:
         return []
 
-def get_user_channels(user_id: int) -> List[Dict[str, Any]]:
+async def get_user_channels(user_id: int) -> List[Dict[str, Any]]:
     try:
-        return list(db.db.channels.find({"owner_id": user_id}).sort("created_at", -1))
+        return await db.adb.channels.find({"owner_id": user_id}).sort("created_at", -1).to_list()
     except Exception:
         return []
 
-def get_pool_channels(limit: int = MAX_POINTS_CHANNELS) -> List[Dict[str, Any]]:
+async def get_pool_channels(limit: int = MAX_POINTS_CHANNELS) -> List[Dict[str, Any]]:
     """قنوات تم تعيينها في قائمة التجميع (in_points_pool=True)"""
     try:
-        return list(db.db.channels.find({"in_points_pool": True, "active": True}).sort("pool_added_at", -1).limit(limit))
+        return await db.adb.channels.find({"in_points_pool": True, "active": True}).sort("pool_added_at", -1).limit(limit).to_list()
     except Exception:
         return []
 
@@ -123,49 +128,71 @@ async def add_funding_channel(application, channel_identifier, owner_id: int, ti
             "in_points_pool": False,
             "created_at": datetime.utcnow()
         }
-        db.db.channels.update_one({"channel_id": ch_id}, {"$set": doc}, upsert=True)
+        before = await db.adb.channels.find_one_and_update({"channel_id": ch_id}, {"$set": doc}, projection=STATS_PROJECTION, upsert=True)
+        await db.track_stats("channels", before, doc)
         return True, "تم حفظ القناة للتمويل (انتظر تفعيل المالك)."
     except Exception as e:
         logger.exception("add_funding_channel")
         return False, str(e)
 
-def remove_funding_channel(channel_identifier, owner_id: Optional[int]=None) -> Tuple[bool,str]:
+async def remove_funding_channel(channel_identifier, owner_id: Optional[int]=None) -> Tuple[bool,str]:
     try:
         if owner_id:
-            res = db.db.channels.delete_one({"channel_id": channel_identifier, "owner_id": owner_id})
-            if res.deleted_count:
+            removed = await db.adb.channels.find_one_and_delete({"channel_id": channel_identifier, "owner_id": owner_id}, projection=STATS_PROJECTION)
+            if removed:
+                await db.track_stats("channels", removed, None)
                 return True, "تم حذف القناة."
             return False, "لم يتم العثور على القناة أو ليست ملكك."
         else:
-            db.db.channels.update_one({"channel_id": channel_identifier}, {"$set": {"active": False, "deactivated_at": datetime.utcnow(), "deactivated_reason": "manual_removed"}})
+            before = await db.adb.channels.find_one_and_update({"channel_id": channel_identifier}, {"$set": {"active": False, "deactivated_at": datetime.utcnow(), "deactivated_reason": "manual_removed"}}, projection=STATS_PROJECTION)
+            if before:
+                await db.track_stats("channels", before, {**before, "active": False})
             return True, "تم تعطيل القناة."
     except Exception as e:
         logger.exception("remove_funding_channel")
         return False, str(e)
 
-# ------------------ مهمة الخلفية: تعطيل القنوات إذا سحب البوت صلاحياته ------------------
+# ------------------ تعطيل قناة فقد البوت صلاحياته فيها ------------------
+async def deactivate_funding_channel(bot, ch_id, reason: str = "bot_lost_admin") -> bool:
+    """تعطيل القناة وإبلاغ المالك مرة واحدة فقط (الشرط active=True يمنع تكرار الإشعار)"""
+    ch = await db.adb.channels.find_one_and_update(
+        {"channel_id": ch_id, "active": True},
+        {"$set": {"active": False, "deactivated_at": datetime.utcnow(), "deactivated_reason": reason}},
+        projection={"owner_id": 1, "title": 1}
+    )
+    if not ch:
+        return False
+    await db.bump_stats(channels_active=-1)
+    owner = ch.get("owner_id")
+    if owner:
+        await _safe_send(bot, owner, f"⚠️ تم إيقاف تمويل *{ch.get('title','قناتك')}* لأن البوت فقد صلاحيات المشرف. أعد رفع البوت مشرفًا لإعادة التفعيل.", parse_mode=ParseMode.MARKDOWN)
+    return True
+
+# ------------------ مهمة الخلفية: مطابقة دورية للقنوات التي فاتتها تحديثات my_chat_member ------------------
+monitor_leader = LeaderLease("funding_monitor")  # نسخة واحدة فقط تراقب وتُبلغ المالكين
+
 async def monitor_channels_admin(application):
     await asyncio.sleep(5)
+    use_lane(BULK)
     bot = application.bot
     while True:
+        # أخذ/تجديد عقد القيادة قبل كل دورة (الاحتياطي ينتظر هنا)
+        await monitor_leader.wait()
         try:
-            channels = get_active_funding_channels(limit=1000)
-            for ch in channels:
-                ch_id = ch.get("channel_id")
-                owner = ch.get("owner_id")
-                if not ch_id:
-                    continue
-                try:
-                    ok = await bot_is_admin(bot, ch_id)
-                    if not ok:
-                        db.db.channels.update_one({"channel_id": ch_id}, {"$set": {"active": False, "deactivated_at": datetime.utcnow(), "deactivated_reason": "bot_lost_admin"}})
-                        if owner:
-                            try:
-                                await _safe_send(bot, owner, f"⚠️ تم إيقاف تمويل *{ch.get('title','قناتك')}* لأن البوت فقد صلاحيات المشرف. أعد رفع البوت مشرفًا لإعادة التفعيل.", parse_mode=ParseMode.MARKDOWN)
-                            except Exception:
-                                pass
-                except Exception:
-                    logger.exception("monitor check_one error")
+            with loop_cycle("monitor_channels_admin"):
+                channels = await get_active_funding_channels(limit=1000)
+                for ch in channels:
+                    if not monitor_leader.held():
+                        break
+                    ch_id = ch.get("channel_id")
+                    if not ch_id:
+                        continue
+                    try:
+                        ok = await bot_is_admin(bot, ch_id)
+                        if not ok:
+                            await deactivate_funding_channel(bot, ch_id, "bot_lost_admin")
+                    except Exception:
+                        logger.exception("monitor check_one error")
         except Exception:
             logger.exception("monitor loop error")
         await asyncio.sleep(MONITOR_INTERVAL)
@@ -173,11 +200,8 @@ async def monitor_channels_admin(application):
 # ------------------ setup و show_main ------------------
 async def setup(application):
     application.add_handler(CallbackQueryHandler(manage_funding, pattern="^fund_"))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_channel_link), group=2)
-    try:
-        application.create_task(monitor_channels_admin(application))
-    except Exception:
-        logger.exception("failed to start monitor task")
+    register_state("funding_link", handle_channel_link)
+    application.add_background("funding_monitor", lambda: monitor_channels_admin(application))
 
 async def show_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -207,7 +231,7 @@ async def manage_funding(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # --- إضافة قناة: وضع انتظار رابط ---
     if data == "fund_add":
-        context.user_data['awaiting_funding_link'] = True
+        set_state(context, "funding_link")
         text = (
             "<b>📥 إضافة قناة/مجموعة للتمويل</b>\n\n"
             "أرسل رابط القناة الآن (مثال: <code>@MyChannel</code> أو <code>https://t.me/MyChannel</code>).\n"
@@ -220,13 +244,13 @@ async def manage_funding(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     if data == "fund_cancel_add":
-        context.user_data.pop('awaiting_funding_link', None)
+        clear_state(context, "funding_link")
         await query.answer("تم إلغاء إضافة القناة.", show_alert=False)
         return await show_main(update, context)
 
     # --- عرض قنواتي (مرقّمة وحيوية) ---
     if data == "fund_list":
-        channels = get_user_channels(user_id)
+        channels = await get_user_channels(user_id)
         if not channels:
             await query.answer("ليس لديك قنوات مضافة.", show_alert=True)
             return await show_main(update, context)
@@ -246,7 +270,7 @@ async def manage_funding(update: Update, context: ContextTypes.DEFAULT_TYPE):
             ch_id = int(ch_raw)
         except Exception:
             ch_id = ch_raw
-        ch = db.db.channels.find_one({"channel_id": ch_id})
+        ch = await db.adb.channels.find_one({"channel_id": ch_id})
         if not ch:
             await query.answer("القناة غير موجودة.", show_alert=True)
             return await show_main(update, context)
@@ -277,17 +301,19 @@ async def manage_funding(update: Update, context: ContextTypes.DEFAULT_TYPE):
             ch_id = int(ch_raw)
         except:
             ch_id = ch_raw
-        ch = db.db.channels.find_one({"channel_id": ch_id})
+        ch = await db.adb.channels.find_one({"channel_id": ch_id})
         if not ch:
             await query.answer("القناة غير موجودة.", show_alert=True)
             return await show_main(update, context)
         if ch.get("owner_id") != user_id and user_id != ADMIN_ID:
             await query.answer("ليس لديك إذن تفعيل هذه القناة.", show_alert=True)
             return
+        invalidate_bot_member(ch_id)  # المالك قد يكون أعاد رفع البوت للتو
         if not await bot_is_admin(context.bot, ch_id):
             await query.answer("❌ البوت ليس مشرفاً في هذه القناة. ارفعه ثم أعد المحاولة.", show_alert=True)
             return await show_main(update, context)
-        db.db.channels.update_one({"channel_id": ch_id}, {"$set": {"active": True, "activated_at": datetime.utcnow()}}, upsert=True)
+        before = await db.adb.channels.find_one_and_update({"channel_id": ch_id}, {"$set": {"active": True, "activated_at": datetime.utcnow()}}, projection=STATS_PROJECTION, upsert=True)
+        await db.track_stats("channels", before, {**(before or {}), "active": True})
         await query.answer("✅ تم تفعيل القناة للتمويل.", show_alert=True)
         return await show_main(update, context)
 
@@ -298,14 +324,16 @@ async def manage_funding(update: Update, context: ContextTypes.DEFAULT_TYPE):
             ch_id = int(ch_raw)
         except:
             ch_id = ch_raw
-        ch = db.db.channels.find_one({"channel_id": ch_id})
+        ch = await db.adb.channels.find_one({"channel_id": ch_id})
         if not ch:
             await query.answer("القناة غير موجودة.", show_alert=True)
             return await show_main(update, context)
         if ch.get("owner_id") != user_id and user_id != ADMIN_ID:
             await query.answer("ليس لديك إذن حذف هذه القناة.", show_alert=True)
             return
-        db.db.channels.delete_one({"channel_id": ch_id})
+        res = await db.adb.channels.delete_one({"channel_id": ch_id})
+        if res.deleted_count:
+            await db.track_stats("channels", ch, None)
         await query.answer("✅ تم حذف القناة.", show_alert=True)
         return await show_main(update, context)
 
@@ -316,21 +344,30 @@ async def manage_funding(update: Update, context: ContextTypes.DEFAULT_TYPE):
             ch_id = int(ch_raw)
         except:
             ch_id = ch_raw
-        ch = db.db.channels.find_one({"channel_id": ch_id})
+        ch = await db.adb.channels.find_one({"channel_id": ch_id})
         if not ch:
             await query.answer("القناة غير موجودة.", show_alert=True)
             return
         if ch.get("owner_id") != user_id:
             await query.answer("فقط مالك القناة يمكنه إدخالها في التجميع.", show_alert=True)
             return
-        user_doc = db.db.users.find_one({"user_id": user_id}) or {}
-        points = user_doc.get("points", 0)
-        if points < POOL_COST:
+        if ch.get("in_points_pool"):
+            await query.answer("القناة ضمن قائمة التجميع بالفعل.", show_alert=True)
+            return await show_main(update, context)
+        # خصم ذري مشروط بالرصيد (لا قراءة ثم كتابة)
+        if await ledger.debit(user_id, POOL_COST, "pool_purchase", ref=ch_id) is None:
+            points = await ledger.balance(user_id)
             await query.answer(f"رصيدك من النقاط غير كافٍ. تحتاج {POOL_COST} نقطة (لديك {points}).", show_alert=True)
             return await show_main(update, context)
-        # خصم النقاط وإضافة القناة لمجموعة التجميع
-        db.db.users.update_one({"user_id": user_id}, {"$inc": {"points": -POOL_COST}})
-        db.db.channels.update_one({"channel_id": ch_id}, {"$set": {"in_points_pool": True, "pool_added_at": datetime.utcnow()}})
+        res = await db.adb.channels.update_one(
+            {"channel_id": ch_id, "in_points_pool": {"$ne": True}},
+            {"$set": {"in_points_pool": True, "pool_added_at": datetime.utcnow()}}
+        )
+        if not res.modified_count:
+            # ضغطة مزدوجة: القناة أُضيفت من الطلب الآخر -> استرجاع النقاط
+            await ledger.credit(user_id, POOL_COST, "pool_refund", ref=ch_id)
+            await query.answer("القناة ضمن قائمة التجميع بالفعل.", show_alert=True)
+            return await show_main(update, context)
         await query.answer(f"✅ أُضيفت القناة لقائمة التجميع وتم خصم {POOL_COST} نقطة.", show_alert=True)
         return await show_main(update, context)
 
@@ -341,20 +378,20 @@ async def manage_funding(update: Update, context: ContextTypes.DEFAULT_TYPE):
             ch_id = int(ch_raw)
         except:
             ch_id = ch_raw
-        ch = db.db.channels.find_one({"channel_id": ch_id})
+        ch = await db.adb.channels.find_one({"channel_id": ch_id})
         if not ch:
             await query.answer("القناة غير موجودة.", show_alert=True)
             return
         if ch.get("owner_id") != user_id:
             await query.answer("فقط المالك يمكنه إلغاء التجميع.", show_alert=True)
             return
-        db.db.channels.update_one({"channel_id": ch_id}, {"$set": {"in_points_pool": False}, "$unset": {"pool_added_at": ""}})
+        await db.adb.channels.update_one({"channel_id": ch_id}, {"$set": {"in_points_pool": False}, "$unset": {"pool_added_at": ""}})
         await query.answer("✅ أُزيلت القناة من قائمة التجميع.", show_alert=True)
         return await show_main(update, context)
 
     # --- تمويلاتي (عرض سريع) ---
     if data == "fund_myfunds":
-        channels = get_user_channels(user_id)
+        channels = await get_user_channels(user_id)
         if not channels:
             await query.answer("لا توجد قنوات لديك.", show_alert=True)
             return await show_main(update, context)
@@ -375,7 +412,7 @@ async def manage_funding(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # --- تجميع نقاط: عرض الرصيد + اختيار قنوات من pool ---
     if data == "fund_points":
-        user_doc = db.db.users.find_one({"user_id": user_id}) or {}
+        user_doc = await db.adb.users.find_one({"user_id": user_id}) or {}
         points = user_doc.get("points", 0)
         text = (
             f"<b>🎯 تجميع النقاط — {BOT_NAME}</b>\n\n"
@@ -395,18 +432,24 @@ async def manage_funding(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # --- عرض قنوات التجميع للمستخدم للاشتراك (مع رفض عرض قنوات ليس لها owner.points>=POOL_COST أو إن المستخدم مشترك فعلاً) ---
     if data == "fund_points_sub":
         # اجلب قنوات في pool
-        pool = list(db.db.channels.find({"in_points_pool": True, "active": True}).limit(MAX_POINTS_CHANNELS))
+        pool = await db.adb.channels.find({"in_points_pool": True, "active": True}).limit(MAX_POINTS_CHANNELS).to_list()
+        # القنوات المحتسبة للمستخدم سابقاً لا تمنحه نقاطاً مجدداً
+        already = await credits.credited_channels(user_id, [ch.get("channel_id") for ch in pool])
+        pool = [ch for ch in pool if ch.get("channel_id") not in already]
+        # المالكون باستعلام $in واحد (كما في fund_points_check) والعضوية بالتوازي، بدل رحلتين لكل قناة
+        owner_ids = list({ch.get("owner_id") for ch in pool if ch.get("owner_id") is not None})
+        owners = {}
+        if owner_ids:
+            owner_docs = await db.adb.users.find({"user_id": {"$in": owner_ids}}, {"_id": 0, "user_id": 1, "points": 1}).to_list()
+            owners = {d["user_id"]: d for d in owner_docs}
+        members = await asyncio.gather(*[_safe_get_chat_member(context.bot, ch.get("channel_id"), user_id) for ch in pool], return_exceptions=True)
         filtered = []
-        for ch in pool:
-            owner = db.db.users.find_one({"user_id": ch.get("owner_id")}) or {}
+        for ch, m in zip(pool, members):
+            owner = owners.get(ch.get("owner_id")) or {}
             owner_points = owner.get("points", 0)
             # شرط: يجب أن يكون لدى المالك نقاط >=0? here as owner already paid when adding in pool
             # لا نعرض القناة لو كان المشاهد مشترك فعلياً فيها
-            try:
-                m = await _safe_get_chat_member(context.bot, ch.get("channel_id"), user_id)
-                status = getattr(m, "status", None) if m else None
-            except Exception:
-                status = None
+            status = getattr(m, "status", None) if m and not isinstance(m, Exception) else None
             if status in VALID_MEMBER_STATUSES:
                 continue
             # ensure owner originally had paid (we assume pool presence means paid). still double-check if needed
@@ -439,36 +482,40 @@ async def manage_funding(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not ch_list:
             await query.answer("لم تُعرض عليك أي قنوات.", show_alert=True)
             return await show_main(update, context)
-        awarded = 0
-        joined = 0
-        for ch_id in ch_list:
-            try:
-                m = await _safe_get_chat_member(context.bot, ch_id, user_id)
-                status = getattr(m, "status", None) if m else None
-                # قبول حالة pending (None أو status==restricted?) => نعتبرها مقبولة
-                if status in VALID_MEMBER_STATUSES or status is None:
-                    db.db.users.update_one({"user_id": user_id}, {"$inc": {"points": POINTS_PER_SUB}}, upsert=True)
-                    awarded += POINTS_PER_SUB
-                    joined += 1
-                    # تحديث achieved_members لإبلاغ المالك لاحقاً؛ لاحظ: هذا قد يزيد حتى لو pending — مقبول كما طلبت
-                    db.db.channels.update_one({"channel_id": ch_id}, {"$inc": {"achieved_members": 1}}, upsert=False)
-                    # إعلام المالك بسطر واحد بسيط
-                    # جلب اسم المشترك
-                    u = db.db.users.find_one({"user_id": user_id}) or {}
-                    display = u.get("first_name") or f"user:{user_id}"
-                    # إرسال إشعار بسيط
-                    try:
-                        # we don't await notify inside loop to avoid blocking; but do safe send
-                        owner_doc = db.db.channels.find_one({"channel_id": ch_id}) or {}
-                        owner = owner_doc.get("owner_id")
-                        if owner:
-                            await _safe_send(context.bot, owner, f"🔔 تم تمويل قناتك بعضو جديد — {display}. الإجمالي: {owner_doc.get('achieved_members',0)+1}")
-                    except Exception:
-                        pass
-            except Exception:
+        # 1. فحص العضوية في كل القنوات بالتوازي (Telegram فقط، بدون قاعدة البيانات)
+        members = await asyncio.gather(*[_safe_get_chat_member(context.bot, ch_id, user_id) for ch_id in ch_list], return_exceptions=True)
+        verified = []
+        for ch_id, m in zip(ch_list, members):
+            if isinstance(m, Exception):
                 continue
+            status = getattr(m, "status", None) if m else None
+            # قبول حالة pending (None أو status==restricted?) => نعتبرها مقبولة
+            if status in VALID_MEMBER_STATUSES or status is None:
+                verified.append(ch_id)
+        new_ids = []
+        if verified:
+            # 2. احتساب غير مكرر: إدراج (user_id, channel_id) في subscription_credits — المحتسب سابقاً يُتجاهل
+            owner_docs = await db.adb.channels.find({"channel_id": {"$in": verified}}, {"channel_id": 1, "owner_id": 1, "title": 1, "username": 1}).to_list()
+            owners = {d["channel_id"]: d.get("owner_id") for d in owner_docs}
+            new_ids = await credits.record_credits(user_id, owners, source="points_pool")
+        joined = len(new_ids)
+        awarded = POINTS_PER_SUB * joined
+        if new_ids:
+            # 3. رصيد المستخدم + السجل (credit_many) وعدادات القنوات (bulk_write) والإجماليات بالتوازي
+            # تحديث achieved_members لإبلاغ المالك لاحقاً؛ لاحظ: هذا قد يزيد حتى لو pending — مقبول كما طلبت
+            await asyncio.gather(
+                ledger.credit_many([(user_id, POINTS_PER_SUB, "pool_subscribe", ch_id) for ch_id in new_ids]),
+                db.adb.channels.bulk_write([UpdateOne({"channel_id": ch_id}, {"$inc": {"achieved_members": 1}}) for ch_id in new_ids], ordered=False),
+            )
+            # إعلام المالكين عبر طابور التنبيهات (ملخص واحد لكل مالك بدل رسالة لكل مشترك)
+            display = query.from_user.first_name or f"user:{user_id}"
+            titles = {d["channel_id"]: d.get("title") or d.get("username") or "" for d in owner_docs}
+            for ch_id in new_ids:
+                notify.push(context.bot, owners.get(ch_id), "fund", titles.get(ch_id, ""), display)
         context.user_data.pop('points_ch_list', None)
         text = f"✅ تم إضافة <b>{awarded}</b> نقطة إلى حسابك.\n• نتيجة الاشتراك: <b>{joined}</b> قناة."
+        if len(verified) > joined:
+            text += f"\n• <b>{len(verified) - joined}</b> قناة احتُسبت لك سابقاً."
         kb = [[InlineKeyboardButton("التالي", callback_data="fund_points")], [InlineKeyboardButton("🏠 رجوع", callback_data="fund_back")]]
         await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(kb), parse_mode=ParseMode.HTML)
         return
@@ -504,8 +551,6 @@ async def manage_funding(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # ------------------ معالجة الرابط المرسل لإضافة قناة ------------------
 async def handle_channel_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    if not context.user_data.get('awaiting_funding_link'):
-        return
     text = update.message.text.strip()
     status_msg = await update.message.reply_text("⏳ جاري التحقق من القناة وصلاحيات البوت...")
     username = text.replace("https://t.me/", "").replace("http://t.me/", "").replace("@", "").split('/')[0]
@@ -516,6 +561,8 @@ async def handle_channel_link(update: Update, context: ContextTypes.DEFAULT_TYPE
             return
         me = await context.bot.get_me()
         member = await _safe_get_chat_member(context.bot, chat.id, me.id)
+        if member:
+            remember_bot_member(chat.id, member)
         if not member:
             await status_msg.edit_text("❌ البوت ليس داخل القناة. ارفعه كمشرف ثم أعد المحاولة.")
             return
@@ -541,8 +588,9 @@ async def handle_channel_link(update: Update, context: ContextTypes.DEFAULT_TYPE
             "in_points_pool": False,
             "created_at": datetime.utcnow()
         }
-        db.db.channels.update_one({"channel_id": chat.id}, {"$set": doc}, upsert=True)
-        context.user_data.pop('awaiting_funding_link', None)
+        before = await db.adb.channels.find_one_and_update({"channel_id": chat.id}, {"$set": doc}, projection=STATS_PROJECTION, upsert=True)
+        await db.track_stats("channels", before, doc)
+        clear_state(context, "funding_link")
         kb = [[InlineKeyboardButton("📂 عرض قنواتي", callback_data="fund_list")], [InlineKeyboardButton("🏠 رجوع", callback_data="fund_back")]]
         await status_msg.edit_text(f"✅ تم حفظ القناة: <b>{doc['title']}</b>\n• الأعضاء: <code>{mcount}</code>\n\nيمكنك تفعيل التمويل من (عرض قنواتي).", parse_mode=ParseMode.HTML, reply_markup=InlineKeyboardMarkup(kb))
     except Exception as e:
@@ -551,19 +599,17 @@ async def handle_channel_link(update: Update, context: ContextTypes.DEFAULT_TYPE
 
 # ------------------ إعلام المالك عند انضمام عضو (سطر واحد) ------------------
 async def notify_owner_on_join(bot, channel_id, new_user_display: str):
-    ch = db.db.channels.find_one({"channel_id": channel_id})
+    ch = await db.adb.channels.find_one_and_update(
+        {"channel_id": channel_id},
+        {"$inc": {"achieved_members": 1, "member_count": 1}},
+        projection={"owner_id": 1, "title": 1, "username": 1}
+    )
     if not ch:
         return
     owner = ch.get("owner_id")
-    db.db.channels.update_one({"channel_id": channel_id}, {"$inc": {"achieved_members": 1, "member_count": 1}})
-    db.db.users.update_one({"user_id": owner}, {"$inc": {"total_received_members": 1}}, upsert=True)
-    owner_doc = db.db.users.find_one({"user_id": owner}) or {}
-    total_received = owner_doc.get("total_received_members", 0)
-    note = f"🔔 تم تمويل قناتك بعضو جديد — {new_user_display}. الإجمالي: {total_received}"
-    try:
-        await _safe_send(bot, owner, note)
-    except Exception:
-        pass
+    res = await db.adb.users.update_one({"user_id": owner}, {"$inc": {"total_received_members": 1}}, upsert=True)
+    await db.bump_stats(channels_members=1, users=1 if res.upserted_id is not None else 0)
+    notify.push(bot, owner, "fund", ch.get("title") or ch.get("username") or "", new_user_display)
 
 # ------------------ وظائف مساعدة إدارية ------------------
 async def admin_add_to_pool(application, channel_identifier, owner_id, cost=POOL_COST):
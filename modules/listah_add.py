@@ -1,9 +1,11 @@
 import sys, os, asyncio, re
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import ContextTypes, CallbackQueryHandler, MessageHandler, filters
+from telegram.ext import ContextTypes, CallbackQueryHandler
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from db import db
+from db import db, STATS_PROJECTION
+from permissions import remember_bot_member
+from router import register_state, set_state, clear_state
 
 # الزر الذي سيظهر في القائمة الرئيسية تلقائياً
 MAIN_BUTTON = "➕إضافة قناة للاعلان"
@@ -11,13 +13,13 @@ MAIN_BUTTON = "➕إضافة قناة للاعلان"
 async def setup(application):
     # ربط ضغطة الزر
     application.add_handler(CallbackQueryHandler(start_add_process, pattern="^add_to_list$"))
-    # ربط مستقبل الروابط بأولوية عالية جداً (Group -1 لضمان الاستجابة قبل الموديولات الأخرى)
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_incoming_link), group=-1)
+    # ربط مستقبل الروابط بحالة الانتظار في الموجه (لا تصله إلا رسائل من ضغط زر الإضافة)
+    register_state("list_link", handle_incoming_link)
 
 async def show_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """تظهر عند الضغط على الزر من القائمة الرئيسية (Keyboard)"""
     user_id = update.effective_user.id
-    context.user_data['waiting_for_list_link'] = True # تفعيل وضع الانتظار
+    set_state(context, "list_link") # تفعيل وضع الانتظار
     
     text = (
         "➕ **إضافة قناة لنظام اللستة**\n"
@@ -32,15 +34,11 @@ async def show_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def start_add_process(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """تظهر عند الضغط على الزر المدمج (Inline)"""
     query = update.callback_query
-    context.user_data['waiting_for_list_link'] = True
+    set_state(context, "list_link")
     await query.edit_message_text("📥 أرسل رابط القناة الآن (أو اليوزر @) لإضافتها للستة:")
 
 async def handle_incoming_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """المعالج الرئيسي الذي يفرض نفسه عند إرسال رابط"""
-    # التحقق هل المستخدم ضغط على زر الإضافة أولاً؟
-    if not context.user_data.get('waiting_for_list_link'):
-        return # إذا لم يضغط الزر، نتجاهل الرسالة لتذهب لموديولات أخرى مثل التمويل
-
+    """يستقبل الرابط بعد ضغط زر الإضافة (حالة list_link في الموجه)"""
     user_id = update.effective_user.id
     text = update.message.text.strip()
     
@@ -66,6 +64,7 @@ async def handle_incoming_link(update: Update, context: ContextTypes.DEFAULT_TYP
 
         # فحص الصلاحيات
         member = await context.bot.get_chat_member(chat.id, context.bot.id)
+        remember_bot_member(chat.id, member)
         if member.status not in ['administrator', 'creator']:
             await wait_msg.edit_text("❌ **البوت ليس مشرفاً!**\nارفع البوت مشرفاً في القناة أولاً ثم أعد المحاولة.")
             return
@@ -79,22 +78,21 @@ async def handle_incoming_link(update: Update, context: ContextTypes.DEFAULT_TYP
         members_count = await context.bot.get_chat_member_count(chat.id)
         
         # حفظ البيانات في قاعدة البيانات
-        db.db.list_channels.update_one(
-            {"channel_id": chat.id},
-            {"$set": {
-                "owner_id": user_id,
-                "username": f"@{username}",
-                "title": chat.title,
-                "member_count": members_count,
-                "list_active": False, # تبدأ غير مفعلة حتى يفعلها المستخدم
-                "yield_score": 0,
-                "total_clicks": 0,
-                "ad_text": "لم يتم ضبط نص الإعلان بعد"
-            }}, upsert=True
-        )
+        fields = {
+            "owner_id": user_id,
+            "username": f"@{username}",
+            "title": chat.title,
+            "member_count": members_count,
+            "list_active": False, # تبدأ غير مفعلة حتى يفعلها المستخدم
+            "yield_score": 0,
+            "total_clicks": 0,
+            "ad_text": "لم يتم ضبط نص الإعلان بعد"
+        }
+        before = await db.adb.list_channels.find_one_and_update({"channel_id": chat.id}, {"$set": fields}, projection=STATS_PROJECTION, upsert=True)
+        await db.track_stats("list_channels", before, fields)
 
         # إيقاف وضع الانتظار
-        context.user_data['waiting_for_list_link'] = False
+        clear_state(context, "list_link")
 
         # رسالة النجاح النهائية
         success_text = (
@@ -1,40 +1,29 @@
 import sys, os, asyncio
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import ContextTypes, CallbackQueryHandler, ConversationHandler, MessageHandler, filters
+from telegram.ext import ContextTypes, CallbackQueryHandler, filters
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from db import db
+from router import register_state, set_state, clear_state
 
 MAIN_BUTTON = "🔄 إدارة اعلان قناتك"
-# حالات الحوار (Conversation States)
-SET_AD_TEXT, SET_AD_PHOTO, SET_GOAL = range(3)
+# حالات الحوار (حالات انتظار في الموجه)
+SET_AD_TEXT, SET_AD_PHOTO, SET_GOAL = "list_ad_text", "list_ad_photo", "list_goal"
 
 async def setup(application):
     # معالج الأزرار التفاعلية بنظام Regex شامل
     application.add_handler(CallbackQueryHandler(manage_actions, pattern="^(manage_list_|toggle_list_|view_ad_|list_main).*$"))
     
     # حوار إعداد الإعلان (نص + صورة + هدف)
-    conv = ConversationHandler(
-        entry_points=[
-            CallbackQueryHandler(ask_ad_text, pattern="^set_ad_"),
-            CallbackQueryHandler(ask_goal, pattern="^set_goal_")
-        ],
-        states={
-            SET_AD_TEXT: [MessageHandler(filters.TEXT & ~filters.COMMAND, save_ad_text)],
-            SET_AD_PHOTO: [
-                MessageHandler(filters.PHOTO, save_ad_photo),
-                MessageHandler(filters.TEXT & filters.Regex("^تخطي$"), skip_photo)
-            ],
-            SET_GOAL: [MessageHandler(filters.TEXT & ~filters.COMMAND, save_goal)]
-        },
-        fallbacks=[CallbackQueryHandler(show_main, pattern="^list_main$")],
-        allow_reentry=True
-    )
-    application.add_handler(conv)
+    application.add_handler(CallbackQueryHandler(ask_ad_text, pattern="^set_ad_"))
+    application.add_handler(CallbackQueryHandler(ask_goal, pattern="^set_goal_"))
+    register_state(SET_AD_TEXT, save_ad_text)
+    register_state(SET_AD_PHOTO, receive_ad_photo, filters.PHOTO | (filters.TEXT & filters.Regex("^تخطي$")))
+    register_state(SET_GOAL, save_goal)
 
 async def show_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    channels = list(db.db.list_channels.find({"owner_id": user_id}))
+    channels = await db.adb.list_channels.find({"owner_id": user_id}).to_list()
     
     if not channels:
         msg = "📂 **لا توجد قنوات مضافة.**\nاستخدم زر '➕ إضافة قناة' أولاً."
@@ -52,14 +41,18 @@ async def manage_actions(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     data = query.data
     
-    if data == "list_main": return await show_main(update, context)
+    if data == "list_main":
+        for state in (SET_AD_TEXT, SET_AD_PHOTO, SET_GOAL): clear_state(context, state)
+        return await show_main(update, context)
     
     ch_id = int(data.split("_")[-1])
-    ch = db.db.list_channels.find_one({"channel_id": ch_id})
+    ch = await db.adb.list_channels.find_one({"channel_id": ch_id})
 
     if data.startswith("toggle_list_"):
         new_st = not ch.get("list_active", False)
-        db.db.list_channels.update_one({"channel_id": ch_id}, {"$set": {"list_active": new_st}})
+        res = await db.adb.list_channels.update_one({"channel_id": ch_id}, {"$set": {"list_active": new_st}})
+        if res.modified_count:
+            await db.bump_stats(list_active=1 if new_st else -1)
         alert = "🚀 تم تفعيل النشر! سيظهر إعلانك في القنوات الأخرى فوراً." if new_st else "🛑 تم إيقاف النشر."
         await query.answer(alert, show_alert=True)
         return await show_manage_panel(query, ch_id)
@@ -70,7 +63,7 @@ async def manage_actions(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await show_manage_panel(query, ch_id)
 
 async def show_manage_panel(query, ch_id):
-    ch = db.db.list_channels.find_one({"channel_id": ch_id})
+    ch = await db.adb.list_channels.find_one({"channel_id": ch_id})
     status = "🟢 نشط (إعلانك ينشر الآن)" if ch.get("list_active") else "🔴 متوقف (إعلانك مخفي)"
     
     text = (
@@ -99,26 +92,30 @@ async def show_manage_panel(query, ch_id):
 async def ask_ad_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     context.user_data['tmp_ch'] = query.data.split("_")[-1]
+    set_state(context, SET_AD_TEXT)
     await query.edit_message_text("📝 **أرسل نص الإعلان الآن:**\n(يجب ألا يتجاوز 300 حرف، سيتم إضافة زر الانضمام تلقائياً)")
-    return SET_AD_TEXT
 
 async def save_ad_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data['ad_text'] = update.message.text[:300]
     await update.message.reply_text("📸 **أرسل صورة الإعلان الآن:**\n(أو أرسل كلمة `تخطي` إذا كنت تريد إعلاناً نصياً فقط)")
-    return SET_AD_PHOTO
+    set_state(context, SET_AD_PHOTO)
 
 async def save_ad_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     photo_id = update.message.photo[-1].file_id
     ch_id = int(context.user_data['tmp_ch'])
-    db.db.list_channels.update_one({"channel_id": ch_id}, {"$set": {"ad_text": context.user_data['ad_text'], "ad_photo": photo_id}})
+    await db.adb.list_channels.update_one({"channel_id": ch_id}, {"$set": {"ad_text": context.user_data['ad_text'], "ad_photo": photo_id}})
     await update.message.reply_text("✅ **تم حفظ الإعلان بالصورة!**", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⚙️ العودة للإدارة", callback_data=f"manage_list_{ch_id}")]]))
-    return ConversationHandler.END
+    clear_state(context, SET_AD_PHOTO)
 
 async def skip_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     ch_id = int(context.user_data['tmp_ch'])
-    db.db.list_channels.update_one({"channel_id": ch_id}, {"$set": {"ad_text": context.user_data['ad_text'], "ad_photo": None}})
+    await db.adb.list_channels.update_one({"channel_id": ch_id}, {"$set": {"ad_text": context.user_data['ad_text'], "ad_photo": None}})
     await update.message.reply_text("✅ **تم حفظ الإعلان (نص فقط)!**", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⚙️ العودة للإدارة", callback_data=f"manage_list_{ch_id}")]]))
-    return ConversationHandler.END
+    clear_state(context, SET_AD_PHOTO)
+
+async def receive_ad_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message.photo: return await save_ad_photo(update, context)
+    return await skip_photo(update, context)
 
 # --- [ عرض الإعلان (Preview) ] ---
 
@@ -141,14 +138,14 @@ async def preview_ad(query, ch):
 async def ask_goal(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     context.user_data['tmp_ch'] = query.data.split("_")[-1]
+    set_state(context, SET_GOAL)
     await query.edit_message_text("🎯 **كم عدد الأعضاء الذين تطمح لجذبهم؟**\nأرسل رقماً فقط (مثلاً: 100)")
-    return SET_GOAL
 
 async def save_goal(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.message.text.isdigit():
         await update.message.reply_text("⚠️ يرجى إرسال أرقام فقط!")
-        return SET_GOAL
+        return
     ch_id = int(context.user_data['tmp_ch'])
-    db.db.list_channels.update_one({"channel_id": ch_id}, {"$set": {"custom_target": int(update.message.text)}})
+    await db.adb.list_channels.update_one({"channel_id": ch_id}, {"$set": {"custom_target": int(update.message.text)}})
     await update.message.reply_text("✅ **تم تحديد الهدف بنجاح!**", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⚙️ العودة للإدارة", callback_data=f"manage_list_{ch_id}")]]))
-    return ConversationHandler.END
+    clear_state(context, SET_GOAL)
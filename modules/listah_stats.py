@@ -9,18 +9,17 @@ MAIN_BUTTON = "📢إحصائيات الإعلان"
 
 async def show_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    channels = list(db.db.list_channels.find({"owner_id": user_id}))
+    channels = await db.adb.list_channels.find({"owner_id": user_id}).to_list()
     
-    # حساب الجمهور الكلي للشبكة
-    all_ch = list(db.db.list_channels.find({}))
-    total_audience = sum([c.get('member_count', 0) for c in all_ch])
+    # الجمهور الكلي للشبكة من وثيقة stats_snapshot (بدل تحميل كل القنوات)
+    total_audience = (await db.get_stats_snapshot())["list_members"]
     
     text = "📈 **إحصائيات قنواتك في اللستة:**\n"
     text += f"🌍 إجمالي جمهور الشبكة: `{total_audience}` عضو\n\n"
     
     for ch in channels:
         # إحصائيات افتراضية تعتمد على السجل
-        ignored = db.db.ads_history.count_documents({"from_channel": ch['channel_id'], "status": "ignored"})
+        ignored = await db.adb.ads_history.count_documents({"from_channel": ch['channel_id'], "status": "ignored"})
         views = ch.get('yield_score', 0) * 1.5 # تقديرية بناءً على النشر
         
         text += (
@@ -4,6 +4,7 @@ from telegram.ext import ContextTypes
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from db import db
 from config import Config
+import notify
 
 MAIN_BUTTON = "👥 نظام الإحالات"
 
@@ -36,21 +37,8 @@ async def show_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def process_referral(user, referrer_id, context):
     if referrer_id and referrer_id != user.id:
         # إضافة 8 أعضاء لواجب التمويل (الأب)
-        db.db.users.update_one({"user_id": referrer_id}, {"$inc": {"funded_remaining": 8, "referrals_count": 1}})
+        await db.adb.users.update_one({"user_id": referrer_id}, {"$inc": {"funded_remaining": 8, "referrals_count": 1}})
         
-        # تنبيه للأب
-        try:
-            await context.bot.send_message(
-                chat_id=referrer_id,
-                text=f"🥳 **مبروك! انضم شخص عبر رابطك**\nلقد حصلت على تمويل لـ **8 أعضاء** إضافيين بقناتك! 🔥"
-            )
-        except: pass
-        
-        # إشعار للمشرف عن انضمام عضو جديد
-        try:
-            admin_msg = f"👤 **انضمام جديد للبوت**\n\n" \
-                        f"• الاسم: {user.first_name}\n" \
-                        f"• اليوزر: @{user.username if user.username else 'لا يوجد'}\n" \
-                        f"• المعرف: `{user.id}`"
-            await context.bot.send_message(chat_id=Config.ADMIN_ID, text=admin_msg, parse_mode="Markdown")
-        except: pass
+        # تنبيه للأب وللمشرف (طابور مجمع: لا ننتظر الإرسال ولا نغرق المشرف برسالة لكل مستخدم)
+        notify.push(context.bot, referrer_id, "referral_funding", value=8)
+        notify.push(context.bot, Config.ADMIN_ID, "new_user", detail=f"{user.first_name} (@{user.username if user.username else 'لا يوجد'} | {user.id})")
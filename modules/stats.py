@@ -1,37 +1,71 @@
 import sys, os
-from telegram import Update
-from telegram.ext import ContextTypes
+import asyncio
+import html
+import logging
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.ext import ContextTypes, CallbackQueryHandler
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from config import Config
 from db import db
+import credits
+from leases import LeaderLease
+from leaderboard import leaderboard
+from metrics import loop_cycle
+from ratelimit import use_lane, BULK
+
+logger = logging.getLogger(__name__)
 
 MAIN_BUTTON = "📊 إحصائيات التمويل"
 
-async def show_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-    
+# المطابقة الدقيقة لوثيقة stats_snapshot (العدادات بين المطابقتين تُحدَّث بـ $inc من مسارات الكتابة)
+STATS_RECONCILE_INTERVAL = getattr(Config, "STATS_RECONCILE_INTERVAL", 3600)
+leader = LeaderLease("stats_reconcile")
+
+async def setup(application):
+    """تشغيل المطابقة الدورية وتحديث لوحة المتصدرين كخدمات خلفية (تبدأ مع application.start)"""
+    application.add_handler(CallbackQueryHandler(stats_callbacks, pattern="^stats_"))
+    application.add_background("stats_reconcile", run_stats_reconciler)
+    application.add_background("leaderboard", leaderboard.run)
+
+async def run_stats_reconciler():
+    use_lane(BULK)
+    while True:
+        # نسخة واحدة فقط تطابق (العقد)؛ البقية تنتظر
+        await leader.wait()
+        try:
+            with loop_cycle("stats_reconcile"):
+                await db.reconcile_stats()
+        except Exception as e:
+            logger.error(f"Stats reconcile error: {e}")
+        await asyncio.sleep(STATS_RECONCILE_INTERVAL)
+
+REPORT_KB = InlineKeyboardMarkup([[InlineKeyboardButton("🏆 قائمة المتصدرين", callback_data="stats_top")]])
+TOP_KB = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 رجوع", callback_data="stats_back")]])
+
+async def build_report(user_id):
     # 1. بيانات المستخدم الشخصية
-    user_data = db.db.users.find_one({"user_id": user_id}) or {}
+    user_data = await db.adb.users.find_one({"user_id": user_id}) or {}
     ref_count = user_data.get("referrals_count", 0)
     funded_remaining = user_data.get("funded_remaining", 0)
-    total_received = user_data.get("total_received", 0)
+    # من سجل الاحتسابات الفريد بدل العدادات (لا يتضخم بالضغطات المتكررة)
+    total_received = await credits.count_for_owner(user_id)
 
-    # 2. إحصائيات الشبكة (استخراج عدد الأعضاء الكلي)
-    total_channels = db.db.channels.count_documents({})
-    
-    # عملية الجمع البرمجية لعدد الأعضاء
-    pipeline = [{"$group": {"_id": None, "total": {"$sum": "$member_count"}}}]
-    members_res = list(db.db.channels.aggregate(pipeline))
-    total_members = members_res[0]['total'] if members_res else 0
+    # 2. إحصائيات الشبكة من وثيقة stats_snapshot (قراءة واحدة بدل العد و $group)
+    snap = await db.get_stats_snapshot()
+    total_channels = snap["channels"]
+    total_members = snap["channels_members"]
 
-    # 3. حساب الترتيب العالمي
-    rank = db.db.users.count_documents({"referrals_count": {"$gt": ref_count}}) + 1
+    # 3. الترتيب العالمي من لوحة المتصدرين في الذاكرة (بحث ثنائي بلا استعلام)
+    await leaderboard.ensure_loaded()
+    rank = leaderboard.rank(ref_count)
+    top_percent = leaderboard.top_percent(ref_count)
 
     text = (
         "📊 **تقرير الأداء والنمو**\n"
         "━━━━━━━━━━━━━━━\n\n"
         "👤 **إحصائياتك الشخصية:**\n"
-        f"🏆 ترتيبك العالمي: `{rank}#`\n"
+        f"🏆 ترتيبك العالمي: `{rank}#` (ضمن أفضل `{top_percent:.1f}%`)\n"
         f"👥 عدد دعواتك: `{ref_count}`\n"
         f"✅ منضمون لقنواتك: `{total_received}` عضو\n"
         f"⏳ تمويل متبقي: `{funded_remaining}` عضو\n\n"
@@ -41,5 +75,29 @@ async def show_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "━━━━━━━━━━━━━━━\n"
         "💡 *شارك رابطك الآن لزيادة ترتيبك العالمي والحصول على تمويل ضخم!* 🚀"
     )
+    return text
+
+def build_top():
+    rows = []
+    for i, doc in enumerate(leaderboard.top(), start=1):
+        name = doc.get("first_name") or doc.get("username") or f"user:{doc.get('user_id')}"
+        rows.append(f"{i}. {html.escape(str(name))} — <b>{doc.get('referrals_count', 0)}</b> دعوة")
+    return (
+        f"<b>🏆 أفضل {leaderboard.top_size} في الدعوات</b>\n\n"
+        + ("\n".join(rows) or "لا توجد دعوات بعد.")
+        + "\n\n<i>تُحدَّث القائمة كل بضع دقائق.</i>"
+    )
+
+async def show_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text = await build_report(update.effective_user.id)
+    await update.message.reply_text(text, parse_mode="Markdown", reply_markup=REPORT_KB)
 
-    await update.message.reply_text(text, parse_mode="Markdown")
+async def stats_callbacks(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    if query.data == "stats_top":
+        await leaderboard.ensure_loaded()
+        await query.edit_message_text(build_top(), parse_mode="HTML", reply_markup=TOP_KB)
+    elif query.data == "stats_back":
+        text = await build_report(update.effective_user.id)
+        await query.edit_message_text(text, parse_mode="Markdown", reply_markup=REPORT_KB)
@@ -0,0 +1,156 @@
+import time
+import heapq
+import asyncio
+import logging
+from telegram.error import RetryAfter, Forbidden, BadRequest
+from config import Config
+from cache import TTLCache
+from ratelimit import retry_after_seconds, use_lane, BULK
+
+logger = logging.getLogger(__name__)
+
+# طابور تنبيهات الملاك: المعالجات تضيف الحدث (push) وتعود فوراً، وعامل خلفي يرسل.
+# أول حدث لمالك هادئ يُرسل مباشرة، وما يصل بعده خلال NOTIFY_WINDOW يُجمع في رسالة ملخص واحدة
+# ("+37 عضو جديد في قناتك خلال آخر 5 دقائق") بدل مئات الرسائل.
+NOTIFY_WINDOW = getattr(Config, "NOTIFY_WINDOW", 300)                # ثوانٍ بين رسالتين لنفس المالك
+NOTIFY_MAX_PENDING = getattr(Config, "NOTIFY_MAX_PENDING", 50000)    # حد المستلمين المنتظرين (حماية الذاكرة)
+
+# kind -> (نص الحدث المفرد، سطر الملخص)
+TEMPLATES = {
+    "join": ("🔔 انضم مستخدم جديد إلى قناتك {label}: {detail}", "🔔 +{count} عضو جديد في {label}"),
+    "fund": ("🔔 تم تمويل قناتك {label} بعضو جديد — {detail}", "🔔 +{count} عضو ممول في {label}"),
+    "referral": ("🎉 تم احتساب إحالتك! لقد كسبت {value} نقطة و {detail} عضوًا افتراضيًا كمكافأة.", "🎉 +{count} إحالة محتسبة (+{value} نقطة)"),
+    "referral_funding": ("🥳 مبروك! انضم شخص عبر رابطك\nلقد حصلت على تمويل لـ {value} أعضاء إضافيين بقناتك! 🔥", "🥳 +{count} شخص انضم عبر رابطك (تمويل لـ {value} عضو إضافي)"),
+    "new_user": ("👤 انضمام جديد للبوت: {detail}", "👤 +{count} مستخدم جديد في البوت (آخرهم {detail})"),
+    "ad_posted": ("✨ بشارة! تم نشر إعلان قناتك الآن في قناة: {detail}\nسيستمر العرض لمدة 6 ساعات ثم ينتقل لقناة أخرى.", "✨ نُشر إعلان {label} في {count} قناة (آخرها {detail})"),
+    "ad_rotated": ("🔄 تبادل: تم تحديث الإعلان في قناتك {label} بنجاح.", "🔄 تم تحديث الإعلان في {label} ({count} مرة)"),
+}
+
+def render(events, window=NOTIFY_WINDOW) -> str:
+    """events: {(kind, label): [count, value, detail]} -> نص رسالة واحدة"""
+    if len(events) == 1:
+        (kind, label), (count, value, detail) = next(iter(events.items()))
+        if count == 1:
+            return TEMPLATES[kind][0].format(label=label, detail=detail or "", value=value, count=count)
+    lines = [
+        TEMPLATES[kind][1].format(label=label, detail=detail or "", value=value, count=count)
+        for (kind, label), (count, value, detail) in events.items()
+    ]
+    return f"📬 ملخص آخر {max(1, round(window / 60))} دقيقة:\n\n" + "\n".join(lines)
+
+class Notifier:
+    """تجميع التنبيهات لكل مستلم وإرسالها من عامل خلفي واحد عبر دلاء المعدل المشتركة"""
+
+    def __init__(self, window=NOTIFY_WINDOW, max_pending=NOTIFY_MAX_PENDING):
+        self.window = window
+        self.max_pending = max_pending
+        self._pending = {}  # chat_id -> {(kind, label): [count, value, detail]}
+        self._heap = []     # (موعد الإرسال, chat_id)
+        self._last_sent = TTLCache("notify_last_sent", maxsize=max_pending, ttl=window)
+        self._wake = asyncio.Event()
+        self._bot = None
+        self._task = None
+        self.queued = 0
+        self.coalesced = 0
+        self.sent = 0
+        self.failed = 0
+
+    def push(self, bot, chat_id, kind, label="", detail=None, value=0):
+        """إضافة حدث بدون انتظار أي إرسال"""
+        if not chat_id:
+            return
+        self._bot = bot
+        events = self._pending.get(chat_id)
+        if events is None:
+            if len(self._pending) >= self.max_pending:
+                logger.warning(f"notify queue full; dropping {kind} for {chat_id}")
+                return
+            events = self._pending[chat_id] = {}
+            last = self._last_sent.get(chat_id)
+            due = time.monotonic() if last is None else last + self.window
+            heapq.heappush(self._heap, (due, chat_id))
+            self._wake.set()
+        else:
+            self.coalesced += 1
+        entry = events.setdefault((kind, label or ""), [0, 0, None])
+        entry[0] += 1
+        entry[1] += value
+        entry[2] = detail
+        self.queued += 1
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def pending(self) -> int:
+        return len(self._pending)
+
+    async def _send(self, chat_id, events) -> bool:
+        """False = أعيد للطابور بعد RetryAfter"""
+        try:
+            await self._bot.send_message(chat_id, render(events, self.window))
+            self.sent += 1
+        except RetryAfter as e:
+            # المنظم أعاد المحاولة وأوقف الدلو العام؛ نؤجل الملخص بدل إسقاطه
+            wait = retry_after_seconds(e)
+            self._requeue(chat_id, events, time.monotonic() + wait)
+            return False
+        except (Forbidden, BadRequest):
+            self.failed += 1  # المالك حظر البوت / محادثة غير موجودة
+        except Exception as e:
+            self.failed += 1
+            logger.debug(f"notify to {chat_id} failed: {e}")
+        self._last_sent.set(chat_id, time.monotonic())
+        return True
+
+    def _requeue(self, chat_id, events, due):
+        current = self._pending.get(chat_id)
+        if current is None:
+            self._pending[chat_id] = events
+            heapq.heappush(self._heap, (due, chat_id))
+            return
+        for key, (count, value, detail) in events.items():
+            entry = current.setdefault(key, [0, 0, detail])
+            entry[0] += count
+            entry[1] += value
+
+    async def _run(self):
+        use_lane(BULK)
+        while True:
+            if not self._heap:
+                self._wake.clear()
+                await self._wake.wait()
+                continue
+            due, chat_id = self._heap[0]
+            delay = due - time.monotonic()
+            if delay > 0:
+                # ننتظر الموعد أو وصول مستلم جديد بموعد أقرب
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            heapq.heappop(self._heap)
+            events = self._pending.pop(chat_id, None)
+            if events:
+                await self._send(chat_id, events)
+
+    async def flush(self):
+        """إرسال كل ما ينتظر الآن (عند الإيقاف)"""
+        if self._task and not self._task.done():
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        use_lane(BULK)
+        self._heap.clear()
+        pending, self._pending = self._pending, {}
+        for chat_id, events in pending.items():
+            await self._send(chat_id, events)
+        if self._pending:
+            logger.warning(f"notify: {len(self._pending)} digests dropped at shutdown (flood-wait)")
+            self._pending.clear()
+        logger.info(f"notify flushed (queued={self.queued}, coalesced={self.coalesced}, sent={self.sent}, failed={self.failed})")
+
+# طابور مشترك على مستوى العملية
+notifier = Notifier()
+
+def push(bot, chat_id, kind, label="", detail=None, value=0):
+    notifier.push(bot, chat_id, kind, label, detail, value)
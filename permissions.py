@@ -0,0 +1,78 @@
+import asyncio
+import logging
+from telegram.error import BadRequest, Forbidden
+from config import Config
+from cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# كاش مشترك لحالة البوت في القنوات: "هل البوت ما زال مشرفاً في القناة X؟"
+# يستخدمه checker و funding و ads_engine ومراقب الصلاحيات بدل get_chat_member(chat, bot.id) في كل مرة
+BOT_ADMIN_CACHE_SIZE = getattr(Config, "BOT_ADMIN_CACHE_SIZE", 20000)
+BOT_ADMIN_CACHE_TTL = getattr(Config, "BOT_ADMIN_CACHE_TTL", 300)
+BOT_ADMIN_NEGATIVE_TTL = getattr(Config, "BOT_ADMIN_NEGATIVE_TTL", 60)  # مدة تذكر "البوت ليس عضواً/مطرود"
+
+ADMIN_STATUSES = ("administrator", "creator")
+
+bot_member_cache = TTLCache("bot_admin", maxsize=BOT_ADMIN_CACHE_SIZE, ttl=BOT_ADMIN_CACHE_TTL)
+_inflight = {}
+_NEGATIVE = object()
+
+async def _bot_id(bot) -> int:
+    try:
+        return bot.id
+    except Exception:
+        return (await bot.get_me()).id
+
+async def _fetch_bot_member(bot, chat_id):
+    try:
+        member = await bot.get_chat_member(chat_id, await _bot_id(bot))
+    except (BadRequest, Forbidden) as e:
+        # البوت مطرود أو القناة غير موجودة -> نتذكر النتيجة السلبية لمدة أقصر
+        logger.debug(f"bot member lookup {chat_id}: {e}")
+        bot_member_cache.set(chat_id, _NEGATIVE, ttl=BOT_ADMIN_NEGATIVE_TTL)
+        return None
+    except Exception as e:
+        # أخطاء الشبكة المؤقتة لا تُخزن
+        logger.debug(f"bot member lookup {chat_id} failed: {e}")
+        return None
+    bot_member_cache.set(chat_id, member)
+    return member
+
+async def get_bot_member(bot, chat_id):
+    """
+    عضوية البوت في القناة (ChatMember) أو None.
+    الطلبات المتزامنة لنفس القناة تشترك في استدعاء Telegram واحد.
+    """
+    cached = bot_member_cache.get(chat_id)
+    if cached is not None:
+        return None if cached is _NEGATIVE else cached
+    fut = _inflight.get(chat_id)
+    if fut is None:
+        fut = _inflight[chat_id] = asyncio.ensure_future(_fetch_bot_member(bot, chat_id))
+        fut.add_done_callback(lambda _f: _inflight.pop(chat_id, None))
+    return await asyncio.shield(fut)
+
+def remember_bot_member(chat_id, member):
+    """تحديث الكاش مباشرة من تحديث my_chat_member (بدون استدعاء API)"""
+    if member is None or getattr(member, "status", None) in ("left", "kicked"):
+        bot_member_cache.set(chat_id, _NEGATIVE, ttl=BOT_ADMIN_NEGATIVE_TTL)
+    else:
+        bot_member_cache.set(chat_id, member)
+
+def invalidate_bot_member(chat_id):
+    bot_member_cache.invalidate(chat_id)
+
+def is_admin_member(member, need_post: bool = False, need_invite: bool = False) -> bool:
+    """تقييم العضوية حسب الصلاحيات المطلوبة (الخاصيات الغائبة أو None لا تُعتبر نقصاً)"""
+    if not member or getattr(member, "status", None) not in ADMIN_STATUSES:
+        return False
+    # Telegram يرسل can_post_messages=None لمشرفي المجموعات (الصلاحية خاصة بالقنوات) -> فقط False صريحة تعني المنع
+    if need_post and getattr(member, "can_post_messages", None) is False:
+        return False
+    if need_invite and getattr(member, "can_invite_users", None) is False:
+        return False
+    return True
+
+async def bot_is_admin_in(bot, chat_id, need_post: bool = False, need_invite: bool = False) -> bool:
+    return is_admin_member(await get_bot_member(bot, chat_id), need_post=need_post, need_invite=need_invite)
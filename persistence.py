@@ -0,0 +1,229 @@
+import pickle
+import asyncio
+import logging
+import datetime
+from copy import deepcopy
+import bson
+from bson.binary import Binary
+from pymongo import ReplaceOne, DeleteOne
+from telegram.ext import BasePersistence, PersistenceInput
+from config import Config
+from db import db
+
+logger = logging.getLogger(__name__)
+
+# حفظ user_data / chat_data / bot_data / حالات المحادثة في MongoDB حتى لا تضيع الحالات الجارية
+# (قائمة الاشتراك الإجباري، الإحالة، انتظار الروابط...) عند إعادة التشغيل أو عند تشغيل أكثر من نسخة.
+# الكتابة مؤجلة: التغييرات تُعلَّم "متسخة" وتُكتب دفعة واحدة (bulk_write) بدل كتابة عند كل تغيير.
+PERSISTENCE_UPDATE_INTERVAL = getattr(Config, "PERSISTENCE_UPDATE_INTERVAL", 5)  # ثوانٍ بين دورات PTB
+PERSISTENCE_FLUSH_DELAY = getattr(Config, "PERSISTENCE_FLUSH_DELAY", 1.0)        # تجميع التغييرات قبل الكتابة
+PERSISTENCE_LOAD_DAYS = getattr(Config, "PERSISTENCE_LOAD_DAYS", 14)            # تحميل الحالات الحديثة فقط عند الإقلاع
+PERSISTENCE_REFRESH = getattr(Config, "PERSISTENCE_REFRESH", False)              # إعادة القراءة قبل كل تحديث (عند تعدد النسخ بلا تقسيم)
+PERSISTENCE_RETRY_MAX = getattr(Config, "PERSISTENCE_RETRY_MAX", 60)             # أقصى انتظار بين محاولات الكتابة الفاشلة
+
+COLLECTIONS = {
+    "user_data": "state_user_data",
+    "chat_data": "state_chat_data",
+    "bot_data": "state_bot_data",
+    "conversations": "state_conversations",
+    "callback_data": "state_callback_data",
+}
+BOT_DATA_ID = "bot"
+CALLBACK_DATA_ID = "callback"
+
+def encode_data(data):
+    """القيمة كما هي إن كانت قابلة للتحويل إلى BSON، وإلا pickle"""
+    try:
+        bson.encode({"d": data})
+        return data, False
+    except Exception:
+        return Binary(pickle.dumps(data)), True
+
+def decode_data(doc):
+    if doc is None:
+        return None
+    if doc.get("pickled"):
+        return pickle.loads(doc["data"])
+    return doc.get("data")
+
+class MongoPersistence(BasePersistence):
+    """تنفيذ BasePersistence فوق db.adb مع تتبع التغييرات وكتابة مؤجلة مجمعة"""
+
+    def __init__(self, store_data=None, update_interval=PERSISTENCE_UPDATE_INTERVAL, flush_delay=PERSISTENCE_FLUSH_DELAY):
+        super().__init__(store_data=store_data or PersistenceInput(callback_data=False), update_interval=update_interval)
+        self.flush_delay = flush_delay
+        self._snapshots = {}  # (kind, _id) -> آخر نسخة كُتبت بنجاح (لتجاهل التحديثات غير المتغيرة)
+        self._dirty = {}      # (kind, _id) -> وثيقة جديدة أو None للحذف
+        self._inflight = {}   # الدفعة التي تُكتب الآن
+        self._flush_task = None
+        self._retry_delay = 0
+        self._flush_lock = asyncio.Lock()
+        self.writes = 0
+        self.flushes = 0
+
+    # ---------------- التتبع والكتابة ----------------
+    def _mark(self, kind, key, data, force=False):
+        ident = (kind, key)
+        pending = ident in self._dirty or ident in self._inflight
+        if data is not None and not pending and self._snapshots.get(ident) == data:
+            return  # لم يتغير شيء منذ آخر كتابة
+        if data is None and ident not in self._snapshots and not pending and not force:
+            return  # فارغ ولم يُحفظ أصلاً
+        self._dirty[ident] = data
+        self._schedule_flush()
+
+    def _schedule_flush(self, delay=None):
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.ensure_future(self._delayed_flush(delay))
+
+    async def _delayed_flush(self, delay=None):
+        await asyncio.sleep(self.flush_delay if delay is None else delay)
+        # shield: إلغاء المهمة أثناء الكتابة لا يُضيع الدفعة المسحوبة
+        await asyncio.shield(self._write_dirty())
+
+    async def _write_dirty(self, retry=True):
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+            dirty, self._dirty = self._dirty, {}
+            self._inflight = dirty
+            now = datetime.datetime.utcnow()
+            ops = {}
+            # نسخة لكل وثيقة: منها تُبنى الكتابة (ترميز BSON يتم لاحقاً في خيط المنفذ بينما المعالجات
+            # تعدل القاموس الحي) وتصبح snapshot بعد نجاح الكتابة فقط — فما يُقارن به هو ما خُزن فعلاً
+            written = {}
+            for (kind, key), data in dirty.items():
+                if data is None:
+                    written[(kind, key)] = None
+                    ops.setdefault(kind, []).append(DeleteOne({"_id": key}))
+                    continue
+                data = written[(kind, key)] = deepcopy(data)
+                value, pickled = encode_data(data)
+                doc = {"_id": key, "data": value, "pickled": pickled, "updated_at": now}
+                ops.setdefault(kind, []).append(ReplaceOne({"_id": key}, doc, upsert=True))
+            failed = False
+            try:
+                for kind, batch in ops.items():
+                    try:
+                        await db.adb[COLLECTIONS[kind]].bulk_write(batch, ordered=False)
+                        self.writes += len(batch)
+                    except Exception:
+                        failed = True
+                        logger.exception(f"persistence flush failed for {kind}")
+                        # إعادة التغييرات للطابور لمحاولة لاحقة (ما لم تُستبدل بأحدث منها)
+                        for (k, key), data in dirty.items():
+                            if k == kind:
+                                self._dirty.setdefault((k, key), data)
+                        continue
+                    for (k, key), data in written.items():
+                        if k != kind:
+                            continue
+                        if data is None:
+                            self._snapshots.pop((k, key), None)
+                        else:
+                            self._snapshots[(k, key)] = data
+            finally:
+                self._inflight = {}
+            self.flushes += 1
+        if failed and retry:
+            # إعادة المحاولة بتأخير متضاعف حتى PERSISTENCE_RETRY_MAX
+            self._retry_delay = min(PERSISTENCE_RETRY_MAX, max(self.flush_delay, self._retry_delay * 2 or 1))
+            self._flush_task = asyncio.ensure_future(self._delayed_flush(self._retry_delay))
+        else:
+            self._retry_delay = 0
+
+    async def _load_many(self, kind):
+        since = datetime.datetime.utcnow() - datetime.timedelta(days=PERSISTENCE_LOAD_DAYS)
+        result = {}
+        async for doc in db.adb[COLLECTIONS[kind]].find({"updated_at": {"$gte": since}}):
+            data = decode_data(doc)
+            result[doc["_id"]] = data
+            self._snapshots[(kind, doc["_id"])] = deepcopy(data)
+        return result
+
+    async def _load_one(self, kind, key):
+        return decode_data(await db.adb[COLLECTIONS[kind]].find_one({"_id": key}))
+
+    # ---------------- user_data ----------------
+    async def get_user_data(self):
+        return await self._load_many("user_data")
+
+    async def update_user_data(self, user_id, data):
+        # user_data الفارغ لا يُحفظ
+        self._mark("user_data", user_id, data if data else None)
+
+    async def refresh_user_data(self, user_id, user_data):
+        if not PERSISTENCE_REFRESH or ("user_data", user_id) in self._dirty:
+            return
+        stored = await self._load_one("user_data", user_id)
+        if stored is not None and stored != user_data:
+            user_data.clear()
+            user_data.update(stored)
+            self._snapshots[("user_data", user_id)] = deepcopy(stored)
+
+    async def drop_user_data(self, user_id):
+        self._mark("user_data", user_id, None, force=True)
+
+    # ---------------- chat_data ----------------
+    async def get_chat_data(self):
+        return await self._load_many("chat_data")
+
+    async def update_chat_data(self, chat_id, data):
+        self._mark("chat_data", chat_id, data if data else None)
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        if not PERSISTENCE_REFRESH or ("chat_data", chat_id) in self._dirty:
+            return
+        stored = await self._load_one("chat_data", chat_id)
+        if stored is not None and stored != chat_data:
+            chat_data.clear()
+            chat_data.update(stored)
+            self._snapshots[("chat_data", chat_id)] = deepcopy(stored)
+
+    async def drop_chat_data(self, chat_id):
+        self._mark("chat_data", chat_id, None, force=True)
+
+    # ---------------- bot_data ----------------
+    async def get_bot_data(self):
+        data = await self._load_one("bot_data", BOT_DATA_ID)
+        if data is not None:
+            self._snapshots[("bot_data", BOT_DATA_ID)] = deepcopy(data)
+        return data or {}
+
+    async def update_bot_data(self, data):
+        self._mark("bot_data", BOT_DATA_ID, data)
+
+    async def refresh_bot_data(self, bot_data):
+        return
+
+    # ---------------- callback_data (غير مستخدم افتراضياً) ----------------
+    async def get_callback_data(self):
+        return await self._load_one("callback_data", CALLBACK_DATA_ID)
+
+    async def update_callback_data(self, data):
+        self._mark("callback_data", CALLBACK_DATA_ID, data)
+
+    # ---------------- حالات ConversationHandler ----------------
+    async def get_conversations(self, name):
+        result = {}
+        async for doc in db.adb[COLLECTIONS["conversations"]].find({"name": name}):
+            result[tuple(doc["key"])] = decode_data(doc)
+        return result
+
+    async def update_conversation(self, name, key, new_state):
+        # حالات المحادثة نادرة ومهمة -> تُكتب مباشرة
+        _id = f"{name}:{':'.join(map(str, key))}"
+        coll = db.adb[COLLECTIONS["conversations"]]
+        if new_state is None:
+            await coll.delete_one({"_id": _id})
+            return
+        value, pickled = encode_data(new_state)
+        await coll.replace_one({"_id": _id}, {"_id": _id, "name": name, "key": list(key), "data": value, "pickled": pickled, "updated_at": datetime.datetime.utcnow()}, upsert=True)
+
+    # ---------------- الإيقاف ----------------
+    async def flush(self):
+        """كتابة كل ما تبقى قبل الإيقاف"""
+        if self._flush_task and not self._flush_task.done():
+            self._flush_task.cancel()
+        await self._write_dirty(retry=False)
+        logger.info(f"persistence flushed (writes={self.writes}, flushes={self.flushes})")
@@ -0,0 +1,95 @@
+import asyncio
+import logging
+import datetime
+from typing import Iterable, Optional, Tuple
+from pymongo import ReturnDocument, UpdateOne
+from db import db
+
+logger = logging.getLogger(__name__)
+
+# دفتر النقاط: كل حركة على users.points تتم بعملية ذرية واحدة (بدون قراءة ثم كتابة)
+# وتُسجل في points_ledger (سجل إلحاقي فقط) للمراجعة وتتبع الأرصدة.
+LEDGER_COLLECTION = "points_ledger"
+LEDGER_BATCH = 1000  # حجم دفعة المنح الجماعي (credit_all)
+
+def _entry(user_id, delta, reason, ref=None, balance=None):
+    return {
+        "user_id": user_id,
+        "delta": delta,
+        "reason": reason,
+        "ref": ref,
+        "balance": balance,
+        "at": datetime.datetime.utcnow(),
+    }
+
+async def _append(entries):
+    if not entries:
+        return
+    try:
+        await db.adb[LEDGER_COLLECTION].insert_many(entries, ordered=False)
+    except Exception:
+        # السجل للمراجعة فقط — فشله لا يلغي الحركة نفسها
+        logger.exception("points ledger append failed")
+
+async def balance(user_id) -> int:
+    doc = await db.adb.users.find_one({"user_id": user_id}, {"points": 1})
+    return (doc or {}).get("points", 0)
+
+async def debit(user_id, amount: int, reason: str, ref=None) -> Optional[int]:
+    """خصم amount فقط إذا كان الرصيد كافياً (شرط points >= amount في نفس العملية). يعيد الرصيد الجديد أو None"""
+    doc = await db.adb.users.find_one_and_update(
+        {"user_id": user_id, "points": {"$gte": amount}},
+        {"$inc": {"points": -amount}},
+        projection={"points": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    if doc is None:
+        return None
+    await _append([_entry(user_id, -amount, reason, ref, doc.get("points"))])
+    return doc.get("points")
+
+async def credit(user_id, amount: int, reason: str, ref=None, projection=None, inc=None):
+    """إضافة amount وإعادة وثيقة المستخدم بعد التحديث (مع projection اختيارية، و inc لعدادات أخرى في نفس العملية)"""
+    fields = {"points": 1, **(projection or {})}
+    doc = await db.adb.users.find_one_and_update(
+        {"user_id": user_id},
+        {"$inc": {"points": amount, **(inc or {})}},
+        projection=fields,
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    await _append([_entry(user_id, amount, reason, ref, (doc or {}).get("points"))])
+    return doc
+
+async def credit_many(credits: Iterable[Tuple[int, int, str, object]]) -> int:
+    """
+    إضافة عدة حركات (user_id, amount, reason, ref) دفعة واحدة:
+    bulk_write واحدة على users (مجمعة لكل مستخدم) + insert_many واحدة للسجل، بالتوازي.
+    """
+    credits = [c for c in credits if c[1]]
+    if not credits:
+        return 0
+    totals = {}
+    for user_id, amount, _, _ in credits:
+        totals[user_id] = totals.get(user_id, 0) + amount
+    ops = [UpdateOne({"user_id": uid}, {"$inc": {"points": amt}}, upsert=True) for uid, amt in totals.items()]
+    entries = [_entry(uid, amt, reason, ref) for uid, amt, reason, ref in credits]
+    await asyncio.gather(db.adb.users.bulk_write(ops, ordered=False), _append(entries))
+    return sum(totals.values())
+
+async def credit_all(amount: int, reason: str, ref=None, batch_size=LEDGER_BATCH) -> int:
+    """منح amount لكل المستخدمين عبر credit_many على دفعات (حركة في السجل لكل مستخدم)؛ يعيد عدد المستخدمين"""
+    count = 0
+    batch = []
+    async for doc in db.adb.users.find({}, {"_id": 0, "user_id": 1}):
+        if doc.get("user_id") is None:
+            continue
+        batch.append((doc["user_id"], amount, reason, ref))
+        if len(batch) >= batch_size:
+            await credit_many(batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        await credit_many(batch)
+        count += len(batch)
+    return count
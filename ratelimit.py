@@ -0,0 +1,198 @@
+import time
+import asyncio
+import logging
+import contextvars
+from collections import OrderedDict
+from telegram.error import RetryAfter, TelegramError
+from telegram.ext import BaseRateLimiter
+from config import Config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# حدود Telegram التقريبية: ~30 رسالة/ثانية للبوت كله، ورسالة/ثانية لكل محادثة خاصة، و20/دقيقة لكل مجموعة أو قناة
+GLOBAL_RATE = getattr(Config, "TG_GLOBAL_RATE", 25)
+PRIVATE_CHAT_RATE = getattr(Config, "TG_PRIVATE_CHAT_RATE", 1)
+GROUP_CHAT_RATE = getattr(Config, "TG_GROUP_CHAT_RATE", 20 / 60)
+RATE_MAX_RETRIES = getattr(Config, "TG_RATE_MAX_RETRIES", 3)  # إعادة المحاولات التلقائية بعد RetryAfter
+
+def retry_after_seconds(exc) -> float:
+    """قيمة RetryAfter بالثواني (PTB قد يعيدها int أو timedelta)"""
+    value = getattr(exc, "retry_after", 1)
+    if hasattr(value, "total_seconds"):
+        return float(value.total_seconds())
+    return float(value)
+
+class TokenBucket:
+    """دلو رموز: معدل rate رمز/ثانية وسعة capacity للدفعات القصيرة"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(1.0, rate))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now):
+        if now > self._updated:
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+    async def acquire(self, tokens=1):
+        # القفل يجعل المنتظرين يمرون بالترتيب (FIFO)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._refill(now)
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self._tokens) / self.rate)
+
+    def pause(self, seconds):
+        """إيقاف الدلو مؤقتاً (عند RetryAfter من Telegram)"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0.0
+        self._updated = self._paused_until  # لا نجمع رموزاً خلال فترة الإيقاف
+
+class PriorityBucket(TokenBucket):
+    """
+    دلو بمسارين: التفاعلي (ردود المستخدمين) يأخذ الرموز أولاً، والخلفي (بث، إعلانات، تنظيف)
+    ينتظر ما دام هناك طلب تفاعلي منتظر. كل مسار بترتيب FIFO داخله.
+    """
+
+    def __init__(self, rate, capacity=None):
+        super().__init__(rate, capacity)
+        self._bulk_lock = asyncio.Lock()
+        self._urgent_waiting = 0
+
+    async def acquire(self, tokens=1, urgent=True):
+        if urgent:
+            self._urgent_waiting += 1
+        try:
+            async with (self._lock if urgent else self._bulk_lock):
+                while True:
+                    now = time.monotonic()
+                    if now < self._paused_until:
+                        await asyncio.sleep(self._paused_until - now)
+                        continue
+                    self._refill(now)
+                    if not urgent and self._urgent_waiting:
+                        await asyncio.sleep(1 / self.rate)
+                        continue
+                    if self._tokens >= tokens:
+                        self._tokens -= tokens
+                        return
+                    await asyncio.sleep((tokens - self._tokens) / self.rate)
+        finally:
+            if urgent:
+                self._urgent_waiting -= 1
+
+class KeyedBuckets:
+    """دلو مستقل لكل مفتاح (مثلاً لكل chat_id) مع حد أقصى لعدد الدلاء المحفوظة"""
+
+    def __init__(self, rate_for_key, max_keys=50000):
+        self._rate_for_key = rate_for_key
+        self._max_keys = max_keys
+        self._buckets = OrderedDict()
+
+    def get(self, key) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            rate = self._rate_for_key(key)
+            bucket = self._buckets[key] = TokenBucket(rate, capacity=max(1.0, rate))
+            while len(self._buckets) > self._max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket
+
+    async def acquire(self, key, tokens=1):
+        await self.get(key).acquire(tokens)
+
+def chat_rate(chat_id) -> float:
+    """المعرفات السالبة (وأسماء @) لمجموعات/قنوات، والموجبة لمحادثات خاصة"""
+    if isinstance(chat_id, int) and chat_id > 0:
+        return PRIVATE_CHAT_RATE
+    return GROUP_CHAT_RATE
+
+# دلاء مشتركة على مستوى العملية
+global_bucket = PriorityBucket(GLOBAL_RATE)
+chat_buckets = KeyedBuckets(chat_rate)
+
+# ---------------- منظم استدعاءات Bot API ----------------
+INTERACTIVE = "interactive"
+BULK = "bulk"
+_lane = contextvars.ContextVar("tg_lane", default=INTERACTIVE)
+
+def use_lane(lane):
+    """تحديد مسار المهمة الحالية (وما تنشئه من مهام): تستدعيه الحلقات الخلفية في بدايتها"""
+    _lane.set(lane)
+
+def current_lane():
+    return _lane.get()
+
+# الاستدعاءات التي تُرسل رسالة جديدة إلى محادثة (تخضع لحد المحادثة) — الباقي (تعديل الرسائل، getChatMember...) للحد العام فقط
+_CHAT_LIMITED_PREFIXES = ("send", "copy", "forward")
+_UNLIMITED = {"getUpdates", "getMe", "setWebhook", "deleteWebhook", "answerCallbackQuery"}
+
+class GovernorRateLimiter(BaseRateLimiter):
+    """
+    يلف كل استدعاءات application.bot: الدلو العام بمسارين + دلو لكل محادثة، و RetryAfter يوقف الدلو العام
+    ثم يعيد المحاولة تلقائياً (حتى RATE_MAX_RETRIES) بدل أن تبتلع الوحدات الخطأ وتضيع العمل.
+    rate_limit_args={"lane": BULK} في أي استدعاء يتجاوز مسار المهمة الحالية.
+    """
+
+    def __init__(self, bucket=None, chats=None, max_retries=RATE_MAX_RETRIES):
+        self.bucket = bucket or global_bucket
+        self.chats = chats or chat_buckets
+        self.max_retries = max_retries
+        self.calls = {INTERACTIVE: 0, BULK: 0}
+        self.flood_waits = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if endpoint == "getUpdates":
+            return await callback(*args, **kwargs)  # استطلاع طويل: لا يُحد ولا يُقاس
+        lane = (rate_limit_args or {}).get("lane") or _lane.get()
+        metrics.TG_CALLS.inc(endpoint, lane)
+        started = time.perf_counter()
+        try:
+            if endpoint in _UNLIMITED:
+                return await callback(*args, **kwargs)
+            return await self._governed(callback, args, kwargs, endpoint, data, lane)
+        except TelegramError as e:
+            metrics.TG_ERRORS.inc(endpoint, type(e).__name__)
+            raise
+        finally:
+            metrics.TG_SECONDS.observe(time.perf_counter() - started, endpoint)
+
+    async def _governed(self, callback, args, kwargs, endpoint, data, lane):
+        chat_id = data.get("chat_id") if endpoint.startswith(_CHAT_LIMITED_PREFIXES) else None
+        for attempt in range(self.max_retries + 1):
+            await self.bucket.acquire(urgent=lane != BULK)
+            if chat_id is not None:
+                await self.chats.acquire(chat_id)
+            self.calls[lane] = self.calls.get(lane, 0) + 1
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                wait = retry_after_seconds(e)
+                self.flood_waits += 1
+                metrics.TG_RETRY_AFTER.inc(endpoint)
+                logger.warning(f"{endpoint} flood-wait {wait}s ({lane}, attempt {attempt + 1})")
+                # الحد عند Telegram للبوت كله -> إيقاف الجميع، ودلو المحادثة أيضاً إن وُجد
+                self.bucket.pause(wait)
+                if chat_id is not None:
+                    self.chats.get(chat_id).pause(wait)
+                if attempt >= self.max_retries:
+                    raise
@@ -0,0 +1,45 @@
+import logging
+from telegram.ext import filters
+
+logger = logging.getLogger(__name__)
+
+# موجه حالات المحادثة: حالة "بانتظار X" واحدة فقط لكل مستخدم في user_data، ومعالج واحد لكل حالة.
+# main يسجل MessageHandler واحداً يمرر كل رسالة إلى dispatch بدل أن تمر على معالجات TEXT عامة في كل موديول.
+STATE_KEY = "awaiting"
+DEFAULT_FILTER = filters.TEXT & ~filters.COMMAND
+
+_consumers = {}  # state -> (message_filter, handler)
+
+def register_state(state, handler, message_filter=DEFAULT_FILTER):
+    """ربط حالة انتظار بمعالجها (يُستدعى من setup في كل موديول)"""
+    if state in _consumers and _consumers[state][1] is not handler:
+        logger.warning(f"router state '{state}' re-registered")
+    _consumers[state] = (message_filter, handler)
+
+def set_state(context, state):
+    """تحديد ما ينتظره البوت من المستخدم — تستبدل أي حالة سابقة"""
+    context.user_data[STATE_KEY] = state
+
+def get_state(context):
+    return context.user_data.get(STATE_KEY)
+
+def clear_state(context, state=None):
+    """إنهاء الانتظار (أو فقط إذا كانت الحالة الحالية هي state)"""
+    if state is None or context.user_data.get(STATE_KEY) == state:
+        context.user_data.pop(STATE_KEY, None)
+
+async def dispatch(update, context) -> bool:
+    """تمرير الرسالة لمعالج حالة المستخدم الحالية؛ False إذا لا توجد حالة أو الرسالة لا تناسبها"""
+    state = context.user_data.get(STATE_KEY) if context.user_data is not None else None
+    if state is None:
+        return False
+    consumer = _consumers.get(state)
+    if consumer is None:
+        logger.debug(f"no consumer for router state '{state}'")
+        clear_state(context)
+        return False
+    message_filter, handler = consumer
+    if not message_filter.check_update(update):
+        return False
+    await handler(update, context)
+    return True
@@ -0,0 +1,161 @@
+import signal
+import asyncio
+import logging
+import multiprocessing
+from telegram import Bot, Update
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+# وضع تعدد العمليات: عملية مشرفة تستقبل التحديثات (polling أو webhook) وتوزعها على N عملية عاملة
+# حسب user_id، فتبقى تحديثات كل مستخدم بالترتيب في نفس العملية. كل عاملة تشغل Application كاملاً
+# بدون Updater، والحلقات الخلفية (ads_engine، ads_cleaner، مراقب التمويل) تعمل في عملية واحدة عبر leases.
+SHARD_QUEUE_SIZE = getattr(Config, "SHARD_QUEUE_SIZE", 1000)
+WORKER_CONCURRENCY = getattr(Config, "WORKER_CONCURRENCY", 64)  # تحديثات متزامنة داخل العاملة (لمستخدمين مختلفين)
+WORKER_STOP_TIMEOUT = getattr(Config, "WORKER_STOP_TIMEOUT", 30)
+
+def shard_key(data: dict) -> int:
+    """معرف المستخدم صاحب التحديث (from/user)، أو المحادثة، أو update_id كحل أخير"""
+    for value in data.values():
+        if not isinstance(value, dict):
+            continue
+        user = value.get("from") or value.get("user")
+        if isinstance(user, dict) and "id" in user:
+            return int(user["id"])
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if isinstance(chat, dict) and "id" in chat:
+            return int(chat["id"])
+    return int(data.get("update_id", 0))
+
+def shard_index(data: dict, count: int) -> int:
+    return shard_key(data) % count
+
+# ---------------- العملية العاملة ----------------
+class UserLanes:
+    """معالجة متزامنة لمستخدمين مختلفين مع الحفاظ على ترتيب تحديثات المستخدم الواحد"""
+
+    def __init__(self, process, concurrency=WORKER_CONCURRENCY):
+        self._process = process
+        self._sem = asyncio.Semaphore(concurrency)
+        self._tails = {}  # key -> آخر مهمة لهذا المستخدم
+        self._tasks = set()
+
+    async def _run(self, prev, update):
+        try:
+            if prev is not None:
+                await asyncio.gather(prev, return_exceptions=True)
+            await self._process(update)
+        except Exception:
+            logger.exception("update processing failed")
+        finally:
+            self._sem.release()
+
+    async def submit(self, key, update):
+        await self._sem.acquire()
+        task = asyncio.create_task(self._run(self._tails.get(key), update))
+        self._tails[key] = task
+        self._tasks.add(task)
+
+        def _done(t, key=key):
+            self._tasks.discard(t)
+            if self._tails.get(key) is t:
+                del self._tails[key]
+        task.add_done_callback(_done)
+
+    async def drain(self):
+        if self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+async def _worker_main(index, count, queue):
+    import main
+    application = main.build_application(updater=False)
+    await main.prepare_application(application, worker=index)
+    await application.initialize()
+    await application.start()
+    lanes = UserLanes(application.process_update)
+    loop = asyncio.get_running_loop()
+    logger.info(f"worker {index}/{count} ready")
+    try:
+        while True:
+            data = await loop.run_in_executor(None, queue.get)
+            if data is None:
+                break
+            await lanes.submit(shard_key(data), Update.de_json(data, application.bot))
+        await lanes.drain()
+    finally:
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)  # كما في run_polling
+        await application.shutdown()
+        logger.info(f"worker {index}/{count} stopped")
+
+def _worker_entry(index, count, queue):
+    # الإيقاف يديره المشرف (عبر None في الطابور)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.basicConfig(format=f'%(asctime)s - w{index} - %(levelname)s - %(message)s', level=logging.INFO)
+    asyncio.run(_worker_main(index, count, queue))
+
+# ---------------- العملية المشرفة ----------------
+async def _poll(bot, forward, stop_event):
+    offset = None
+    await bot.delete_webhook(drop_pending_updates=True)
+    while not stop_event.is_set():
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=Update.ALL_TYPES)
+        except Exception as e:
+            logger.warning(f"getUpdates failed: {e}")
+            await asyncio.sleep(2)
+            continue
+        for update in updates:
+            await forward(update.to_dict())
+            offset = update.update_id + 1
+
+async def _ingest(queues):
+    loop = asyncio.get_running_loop()
+    stop_event = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+
+    async def forward(data):
+        # put يحجب عند امتلاء طابور العاملة -> ضغط عكسي على الاستقبال
+        await loop.run_in_executor(None, queues[shard_index(data, len(queues))].put, data)
+
+    async with Bot(Config.BOT_TOKEN) as bot:
+        if getattr(Config, "UPDATE_MODE", "polling") == "webhook":
+            from webhook import WebhookServer
+            server = WebhookServer(None, on_update=forward)
+            await server.start()
+            await bot.set_webhook(
+                url=Config.WEBHOOK_URL.rstrip("/") + server.path,
+                secret_token=server.secret,
+                allowed_updates=Update.ALL_TYPES,
+            )
+            await stop_event.wait()
+            await server.stop()
+        else:
+            poller = asyncio.create_task(_poll(bot, forward, stop_event))
+            await stop_event.wait()
+            poller.cancel()
+            await asyncio.gather(poller, return_exceptions=True)
+
+def run_supervisor(count: int):
+    """تشغيل count عملية عاملة وتوزيع التحديثات عليها حتى إشارة الإيقاف"""
+    ctx = multiprocessing.get_context("spawn")  # pymongo غير آمن مع fork
+    queues = [ctx.Queue(SHARD_QUEUE_SIZE) for _ in range(count)]
+    procs = [ctx.Process(target=_worker_entry, args=(i, count, q), name=f"bot-worker-{i}") for i, q in enumerate(queues)]
+    for p in procs:
+        p.start()
+    print(f"🚀 البوت يعمل الآن بـ {count} عمليات معالجة...")
+    try:
+        asyncio.run(_ingest(queues))
+    finally:
+        for q in queues:
+            q.put(None)
+        for p in procs:
+            p.join(WORKER_STOP_TIMEOUT)
+            if p.is_alive():
+                logger.warning(f"{p.name} did not stop in time; terminating")
+                p.terminate()
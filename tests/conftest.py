@@ -0,0 +1,28 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from config import Config
+
+# قاعدة في الذاكرة وإعدادات معزولة قبل أول استيراد لـ db (الاتصال يتم عند الاستيراد)
+Config.MONGO_DB_NAME = "TelegramBot_test"
+Config.MONGO_URL = "mongodb://localhost"
+Config.BOT_TOKEN = "123456:TEST"
+Config.METRICS_PORT = 0
+Config.SLOW_QUERY_MS = 0
+Config.WEBHOOK_SECRET = ""
+
+from bench.fake_api import use_mongomock
+use_mongomock()
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+@pytest.fixture
+def database():
+    from db import db
+    db.client.drop_database(Config.MONGO_DB_NAME)
+    db.ensure_indexes()
+    yield db
+    db.client.drop_database(Config.MONGO_DB_NAME)
@@ -0,0 +1,30 @@
+import asyncio
+
+def test_record_credit_is_a_noop_on_repeat(database):
+    import credits
+
+    async def run():
+        assert await credits.record_credit(1, -100, owner_id=9) is True
+        # الفهرس الفريد (user_id, channel_id): الضغطة المتكررة لا تحتسب مرة ثانية
+        assert await credits.record_credit(1, -100, owner_id=9) is False
+        assert await credits.record_credit(2, -100, owner_id=9) is True
+        assert await credits.has_credit(1, -100)
+        assert await credits.count_for_owner(9) == 2
+
+    asyncio.run(run())
+
+def test_record_credits_returns_only_first_time_channels(database):
+    import credits
+
+    async def run():
+        assert await credits.record_credit(1, -101, owner_id=9) is True
+        new = await credits.record_credits(1, {-100: 9, -101: 9, -102: 8})
+        assert sorted(new) == [-102, -100]
+        # تكرار الدفعة كاملة لا يضيف شيئاً
+        assert await credits.record_credits(1, {-100: 9, -101: 9, -102: 8}) == []
+        assert await credits.credited_channels(1, [-100, -101, -102, -103]) == {-100, -101, -102}
+        assert await credits.counts_for_channels([-100, -101, -102, -103]) == {-100: 1, -101: 1, -102: 1, -103: 0}
+        assert await credits.count_for_owner(9) == 2
+        assert database.db.subscription_credits.count_documents({}) == 3
+
+    asyncio.run(run())
@@ -0,0 +1,21 @@
+import asyncio
+import random
+
+def test_rank_and_top_percent_match_count_documents(database):
+    from leaderboard import Leaderboard
+
+    rng = random.Random(25)
+    counts = [0] * 40 + [rng.choice([1, 1, 2, 3, 5, 8, 8, 13, 40]) for _ in range(60)]
+    database.db.users.insert_many([{"user_id": i, "referrals_count": c, "first_name": f"u{i}"} for i, c in enumerate(counts)])
+    board = Leaderboard(top_size=5)
+    asyncio.run(board.refresh())
+
+    total = database.db.users.count_documents({})
+    for value in sorted(set(counts)) + [4, 41, 1000]:
+        expected = database.db.users.count_documents({"referrals_count": {"$gt": value}}) + 1
+        assert board.rank(value) == expected, value
+        assert board.top_percent(value) == min(100.0, expected / total * 100)
+
+    top = board.top()
+    assert [d["referrals_count"] for d in top] == sorted(counts, reverse=True)[:5]
+    assert board.rank(top[0]["referrals_count"]) == 1
@@ -0,0 +1,78 @@
+import asyncio
+import datetime
+
+def _expire(database, name):
+    """محاكاة توقف القائد: انتهاء العقد في القاعدة دون release"""
+    database.db.leases.update_one({"_id": name}, {"$set": {"expires_at": datetime.datetime.utcnow() - datetime.timedelta(seconds=1)}})
+
+def test_lease_is_exclusive_until_it_expires(database):
+    from leases import LeaderLease
+
+    async def run():
+        a = LeaderLease("t_loop", ttl=30, owner="a")
+        b = LeaderLease("t_loop", ttl=30, owner="b")
+        try:
+            assert await a.acquire() == 1
+            assert await b.acquire() is None
+            # التجديد يحتفظ بنفس الرمز
+            assert await a.acquire() == 1
+            assert a.held() and not b.held()
+
+            _expire(database, "t_loop")
+            assert await b.acquire() == 2
+            # القائد القديم يفقد العقد عند محاولته التالية
+            assert await a.acquire() is None
+            assert not a.held()
+            assert await b.still_current()
+        finally:
+            await a.release()
+            await b.release()
+
+    asyncio.run(run())
+
+def test_release_hands_over_without_waiting_for_ttl(database):
+    from leases import LeaderLease
+
+    async def run():
+        a = LeaderLease("t_release", ttl=30, owner="a")
+        b = LeaderLease("t_release", ttl=30, owner="b")
+        try:
+            assert await a.acquire() == 1
+            await a.release()
+            assert await b.acquire() == 2
+        finally:
+            await b.release()
+
+    asyncio.run(run())
+
+def test_fenced_writes_from_a_replaced_leader_are_rejected(database):
+    from leases import LeaderLease, fenced
+
+    async def run():
+        old = LeaderLease("t_fence", ttl=30, owner="old")
+        new = LeaderLease("t_fence", ttl=30, owner="new")
+        try:
+            coll = database.adb.list_channels
+            await coll.insert_one({"channel_id": 1, "exposure_count": 0})
+            old_token = await old.acquire()
+            res = await coll.update_one(fenced({"channel_id": 1}, old_token), {"$set": {"fence": old_token}, "$inc": {"exposure_count": 1}})
+            assert res.matched_count == 1
+
+            _expire(database, "t_fence")
+            new_token = await new.acquire()
+            assert new_token > old_token
+            res = await coll.update_one(fenced({"channel_id": 1}, new_token), {"$set": {"fence": new_token}, "$inc": {"exposure_count": 1}})
+            assert res.matched_count == 1
+
+            # القائد القديم (متوقف مؤقتاً ولم يلاحظ فقدان العقد) يكتب برمزه القديم -> لا يطابق شيئاً
+            assert old.held()
+            res = await coll.update_one(fenced({"channel_id": 1}, old_token), {"$set": {"fence": old_token}, "$inc": {"exposure_count": 1}})
+            assert res.matched_count == 0
+            assert not await old.still_current()
+            doc = await coll.find_one({"channel_id": 1})
+            assert doc["fence"] == new_token and doc["exposure_count"] == 2
+        finally:
+            await old.release()
+            await new.release()
+
+    asyncio.run(run())
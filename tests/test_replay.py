@@ -0,0 +1,86 @@
+import asyncio
+import os
+
+from config import Config
+from conftest import DATA_DIR
+
+ADMIN_ID = Config.ADMIN_ID
+USER_ID = 5001
+RECORDED_ADMIN_ID = 1000
+USERS = [ADMIN_ID, USER_ID, 5002, 5003]
+
+def _remap(value, ids):
+    """استبدال المعرفات (from.id / chat.id) في التحديثات المسجلة"""
+    if isinstance(value, dict):
+        return {k: ids.get(v, v) if k == "id" else _remap(v, ids) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_remap(v, ids) for v in value]
+    return value
+
+async def _replay(database, segments):
+    """تشغيل التطبيق كاملاً (بلا updater) خلف WebhookServer وإرسال كل مقطع ثم فحص الحالة بعده"""
+    from bench.fake_api import FakeRequest, FakeWorld
+    from main import build_application, prepare_application
+    from webhook import WebhookServer, WebhookClient
+
+    world = FakeWorld()
+    app = build_application(updater=False, request=FakeRequest(world, latency=0))
+    await prepare_application(app)
+    await app.initialize()
+    await app.start()
+    # الحلقات الخلفية تبدأ مع start() ويحتفظ التطبيق بمراجعها
+    assert {"ads_engine", "ads_cleaner", "stats_reconcile", "leaderboard", "funding_monitor", "broadcast_resume"} <= set(app.background_tasks)
+    server = WebhookServer(app, listen="127.0.0.1", port=0, workers=4)
+    await server.start()
+    client = WebhookClient(port=server.port, secret=server.secret)
+    try:
+        for updates, check in segments:
+            assert await client.replay(updates) == {200: len(updates)}
+            await server.join()
+            await check(app)
+    finally:
+        await client.close()
+        await server.stop(drain_timeout=5)
+        await app.stop()
+        await app.shutdown()
+        for task in asyncio.all_tasks() - {asyncio.current_task()}:
+            task.cancel()
+
+def test_admin_grant_all_replay(database):
+    from router import STATE_KEY
+    from webhook import load_recorded_updates
+
+    database.db.users.insert_many([{"user_id": uid, "points": 10} for uid in USERS])
+    # التحديثات المسجلة تحمل معرفاً ثابتاً للمشرف؛ نستبدله بـ Config.ADMIN_ID
+    updates = _remap(load_recorded_updates(os.path.join(DATA_DIR, "admin_grant_all.jsonl")), {RECORDED_ADMIN_ID: ADMIN_ID})
+    enter, amount, foreign, reenter, invalid = updates
+
+    def points():
+        return {d["user_id"]: d["points"] for d in database.db.users.find({}, {"_id": 0, "user_id": 1, "points": 1})}
+
+    async def awaiting_amount(app):
+        assert app.user_data[ADMIN_ID].get(STATE_KEY) == "grant_all_wait"
+
+    async def granted(app):
+        assert STATE_KEY not in app.user_data[ADMIN_ID]
+        assert points() == {uid: 35 for uid in USERS}
+        entries = list(database.db.points_ledger.find({"reason": "admin_grant_all"}))
+        assert sorted(e["user_id"] for e in entries) == sorted(USERS)
+        assert all(e["delta"] == 25 and e["ref"] == ADMIN_ID for e in entries)
+
+    async def foreign_ignored(app):
+        assert STATE_KEY not in app.user_data.get(USER_ID, {})
+
+    async def invalid_cleared(app):
+        assert STATE_KEY not in app.user_data[ADMIN_ID]
+        # الإدخال غير الصالح لا يمنح شيئاً ولا يكتب في السجل
+        assert points() == {uid: 35 for uid in USERS}
+        assert database.db.points_ledger.count_documents({"reason": "admin_grant_all"}) == len(USERS)
+
+    asyncio.run(_replay(database, [
+        ([enter], awaiting_amount),
+        ([amount], granted),
+        ([foreign], foreign_ignored),
+        ([reenter], awaiting_amount),
+        ([invalid], invalid_cleared),
+    ]))
@@ -0,0 +1,32 @@
+import asyncio
+
+UPDATE = {"update_id": 1, "message": {"message_id": 1, "date": 0, "chat": {"id": 1, "type": "private"},
+                                      "from": {"id": 1, "is_bot": False, "first_name": "u1"}, "text": "hi"}}
+
+def test_webhook_without_configured_secret_rejects_unsigned_updates():
+    from webhook import WebhookServer, WebhookClient
+
+    async def run():
+        received = []
+
+        async def on_update(data):
+            received.append(data)
+
+        server = WebhookServer(None, listen="127.0.0.1", port=0, secret="", workers=1, on_update=on_update)
+        assert server.secret  # سر مولد بدل قبول الجميع
+        await server.start()
+        try:
+            unsigned = WebhookClient(port=server.port, secret="")
+            forged = WebhookClient(port=server.port, secret="guess")
+            signed = WebhookClient(port=server.port, secret=server.secret)
+            assert await unsigned.post(UPDATE) == 401
+            assert await forged.post(UPDATE) == 401
+            assert await signed.post(UPDATE) == 200
+            await server.join()
+            for client in (unsigned, forged, signed):
+                await client.close()
+        finally:
+            await server.stop(drain_timeout=5)
+        assert received == [UPDATE]
+
+    asyncio.run(run())
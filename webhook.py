@@ -0,0 +1,280 @@
+import json
+import hmac
+import secrets
+import signal
+import asyncio
+import logging
+from typing import Iterable, Optional, Tuple
+from telegram import Update
+from config import Config
+from shard import shard_key
+
+logger = logging.getLogger(__name__)
+
+# وضع الـ Webhook: خادم HTTP محلي (asyncio) يستقبل التحديثات من Telegram ويوزعها على طوابير محدودة
+# (طابور لكل عامل، يُختار بمعرف المستخدم) فتُعالج تحديثات المستخدم الواحد بالترتيب والمستخدمون المختلفون بالتوازي.
+# عند الإيقاف نتوقف عن الاستقبال ثم نفرغ الطوابير قبل الخروج.
+WEBHOOK_LISTEN = getattr(Config, "WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = getattr(Config, "WEBHOOK_PORT", 8443)
+WEBHOOK_PATH = getattr(Config, "WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = getattr(Config, "WEBHOOK_SECRET", None)
+WEBHOOK_QUEUE_SIZE = getattr(Config, "WEBHOOK_QUEUE_SIZE", 1000)
+WEBHOOK_WORKERS = getattr(Config, "WEBHOOK_WORKERS", 32)
+WEBHOOK_DRAIN_TIMEOUT = getattr(Config, "WEBHOOK_DRAIN_TIMEOUT", 30)
+WEBHOOK_MAX_BODY = 1024 * 1024
+
+SECRET_HEADER = "x-telegram-bot-api-secret-token"
+
+_REASONS = {200: "OK", 400: "Bad Request", 401: "Unauthorized", 404: "Not Found",
+            405: "Method Not Allowed", 413: "Payload Too Large", 503: "Service Unavailable"}
+
+async def _read_request(reader) -> Optional[Tuple[str, str, dict, bytes]]:
+    """قراءة طلب HTTP/1.1 واحد: (method, path, headers, body) أو None عند إغلاق الاتصال"""
+    line = await reader.readline()
+    if not line:
+        return None
+    try:
+        method, path, _ = line.decode("latin-1").split(" ", 2)
+    except ValueError:
+        raise ValueError("bad request line")
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get("content-length") or 0)
+    if length > WEBHOOK_MAX_BODY:
+        raise OverflowError(length)
+    body = await reader.readexactly(length) if length else b""
+    return method.upper(), path.split("?", 1)[0], headers, body
+
+def _response(status: int, body: bytes = b"", keep_alive: bool = True) -> bytes:
+    head = (
+        f"HTTP/1.1 {status} {_REASONS.get(status, '')}\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+    )
+    return head.encode("latin-1") + body
+
+class WebhookServer:
+    """خادم الـ Webhook: تحقق من السر، طابور محدود لكل عامل، ترتيب لكل مستخدم وتصريف آمن عند الإيقاف"""
+
+    def __init__(self, application, listen=WEBHOOK_LISTEN, port=WEBHOOK_PORT, path=WEBHOOK_PATH,
+                 secret=WEBHOOK_SECRET, queue_size=WEBHOOK_QUEUE_SIZE, workers=WEBHOOK_WORKERS, on_update=None):
+        self.application = application
+        self.on_update = on_update  # بديل process_update (مثلاً: تمرير التحديث الخام لعملية أخرى)
+        self.listen = listen
+        self.port = port
+        self.path = path
+        # بلا سر في الإعدادات نولد سراً عشوائياً لهذا التشغيل (يُسجل لدى Telegram في set_webhook)؛
+        # لا نقبل أبداً تحديثات بلا ترويسة السر، فالمنفذ مفتوح (0.0.0.0) وتحديث مزور من ADMIN_ID يصل لأوامر الإدارة
+        if not secret:
+            secret = secrets.token_urlsafe(32)
+            logger.info("WEBHOOK_SECRET is not set; using a generated secret token for this run")
+        self.secret = secret
+        self.workers = max(1, workers)
+        # نفس المستخدم -> نفس الطابور دائماً (shard_key % workers)؛ السعة الكلية queue_size
+        self.queues = [asyncio.Queue(maxsize=max(1, queue_size // self.workers)) for _ in range(self.workers)]
+        self.accepted = 0
+        self.rejected = 0
+        self._server = None
+        self._workers = []
+        self._connections = set()
+        self._accepting = False
+
+    # ---------------- الاستقبال ----------------
+    def _authorized(self, headers) -> bool:
+        return hmac.compare_digest(headers.get(SECRET_HEADER, ""), self.secret)
+
+    def _handle(self, method, path, headers, body) -> int:
+        if method == "GET" and path in ("/", "/health"):
+            return 200
+        if path != self.path:
+            return 404
+        if method != "POST":
+            return 405
+        if not self._authorized(headers):
+            logger.warning("webhook request with invalid secret token")
+            return 401
+        if not self._accepting:
+            return 503  # أثناء الإيقاف: Telegram سيعيد الإرسال لاحقاً
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return 400
+        try:
+            # الطابور الممتلئ = ضغط زائد؛ 503 يجعل Telegram يعيد المحاولة بدل ضياع التحديث
+            self.queues[shard_key(data) % self.workers].put_nowait(data)
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return 503
+        self.accepted += 1
+        return 200
+
+    async def _on_connection(self, reader, writer):
+        self._connections.add(writer)
+        try:
+            while True:
+                try:
+                    request = await _read_request(reader)
+                except OverflowError:
+                    writer.write(_response(413, keep_alive=False))
+                    break
+                except (ValueError, asyncio.IncompleteReadError):
+                    writer.write(_response(400, keep_alive=False))
+                    break
+                if request is None:
+                    break
+                method, path, headers, body = request
+                keep_alive = headers.get("connection", "").lower() != "close"
+                writer.write(_response(self._handle(method, path, headers, body), keep_alive=keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self._connections.discard(writer)
+            try:
+                writer.close()
+            except Exception:
+                pass
+
+    # ---------------- المعالجة ----------------
+    def pending(self) -> int:
+        return sum(q.qsize() for q in self.queues)
+
+    async def join(self):
+        """انتظار معالجة كل ما استُقبل حتى الآن"""
+        await asyncio.gather(*(q.join() for q in self.queues))
+
+    async def _worker(self, queue):
+        while True:
+            data = await queue.get()
+            try:
+                if self.on_update is not None:
+                    await self.on_update(data)
+                else:
+                    await self.application.process_update(Update.de_json(data, self.application.bot))
+            except Exception:
+                logger.exception("webhook update processing failed")
+            finally:
+                queue.task_done()
+
+    # ---------------- دورة الحياة ----------------
+    async def start(self):
+        self._workers = [asyncio.create_task(self._worker(queue)) for queue in self.queues]
+        self._server = await asyncio.start_server(self._on_connection, self.listen, self.port)
+        if not self.port:
+            self.port = self._server.sockets[0].getsockname()[1]
+        self._accepting = True
+        logger.info(f"webhook server listening on {self.listen}:{self.port}{self.path}")
+
+    async def stop(self, drain_timeout=WEBHOOK_DRAIN_TIMEOUT):
+        """إيقاف الاستقبال ثم انتظار تفريغ الطوابير (حتى drain_timeout) قبل إلغاء العمال"""
+        self._accepting = False
+        if self._server:
+            self._server.close()
+            for writer in list(self._connections):
+                writer.close()  # اتصالات keep-alive الخاملة تمنع wait_closed
+            await self._server.wait_closed()
+        try:
+            await asyncio.wait_for(self.join(), timeout=drain_timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"webhook drain timed out with {self.pending()} updates pending")
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        logger.info(f"webhook server stopped (accepted={self.accepted}, rejected={self.rejected})")
+
+# ---------------- عميل محلي لإعادة تشغيل تحديثات مسجلة ----------------
+class WebhookClient:
+    """عميل HTTP بسيط يحاكي Telegram: يرسل تحديثات (dict) إلى الخادم ويعيد رموز الحالة"""
+
+    def __init__(self, host="127.0.0.1", port=WEBHOOK_PORT, path=WEBHOOK_PATH, secret=WEBHOOK_SECRET):
+        self.host = host
+        self.port = port
+        self.path = path
+        self.secret = secret
+        self._reader = None
+        self._writer = None
+
+    async def _connect(self):
+        if self._writer is None or self._writer.is_closing():
+            self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+
+    async def post(self, update: dict) -> int:
+        await self._connect()
+        body = json.dumps(update).encode()
+        head = f"POST {self.path} HTTP/1.1\r\nHost: {self.host}\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+        if self.secret:
+            head += f"X-Telegram-Bot-Api-Secret-Token: {self.secret}\r\n"
+        self._writer.write((head + "\r\n").encode("latin-1") + body)
+        await self._writer.drain()
+        status_line = await self._reader.readline()
+        length, close = 0, False
+        while True:
+            line = await self._reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            if name.strip().lower() == "content-length":
+                length = int(value.strip())
+            elif name.strip().lower() == "connection" and value.strip().lower() == "close":
+                close = True
+        if length:
+            await self._reader.readexactly(length)
+        if close:
+            await self.close()
+        return int(status_line.split()[1])
+
+    async def replay(self, updates: Iterable[dict]) -> dict:
+        """إرسال قائمة تحديثات بالترتيب؛ يعيد عدد كل رمز حالة"""
+        counts = {}
+        for update in updates:
+            status = await self.post(update)
+            counts[status] = counts.get(status, 0) + 1
+        return counts
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+def load_recorded_updates(path: str):
+    """قراءة تحديثات مسجلة (سطر JSON لكل تحديث)"""
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+async def run_webhook(application, webhook_url: str, server: Optional[WebhookServer] = None):
+    """تشغيل البوت بوضع الـ Webhook حتى إشارة الإيقاف، ثم تصريف الطابور وإغلاق التطبيق"""
+    server = server or WebhookServer(application)
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+
+    await application.initialize()
+    await application.start()
+    await server.start()
+    await application.bot.set_webhook(
+        url=webhook_url.rstrip("/") + server.path,
+        secret_token=server.secret,
+        allowed_updates=Update.ALL_TYPES,
+        max_connections=min(100, max(1, server.workers)),
+    )
+    try:
+        await stop_event.wait()
+    finally:
+        # لا نحذف الـ Webhook: التحديثات أثناء إعادة النشر تبقى عند Telegram حتى نعود
+        await server.stop()
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)  # كما في run_polling
+        await application.shutdown()